@@ -1,14 +1,29 @@
-import json
+import asyncio
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from openai import OpenAI
 from loguru import logger
 from config import OPENAI_API_KEY, OPENAI_BASE_URL, MODEL_NAME, MAX_API_RETRY, HISTORY_DIR
-from config import VISION_MODEL_NAME
+from config import VISION_MODEL_NAME, VISION_MAX_SIDE, VISION_JPEG_QUALITY, VISION_MAX_IMAGE_BYTES
+from config import TRANSCRIBE_MODEL, TRANSCRIBE_LANGUAGE, TRANSCRIBE_MAX_WORKERS, TRANSCRIBE_CHUNK_SECONDS
+from config import MEMORY_EXTRACT_ENABLED, MEMORY_EXTRACT_MODEL, MEMORY_EXTRACT_BATCH_SIZE, MEMORY_EXTRACT_FLUSH_INTERVAL
 from personas import get_persona, DEFAULT_PERSONA
-from stats import StatsManager
-from memory import MemoryManager
-from search import SearchManager
+from lazy import lazy_property
+from history_store import HistoryStore
+from models import Turn
+from usage import UsageTracker, BUDGET_EXCEEDED_REPLY
+from text_utils import join_segments
+import serialization
+from metrics import MODEL_LATENCY, DISK_SAVE_LATENCY, RETRIES, ERRORS, CACHE_HITS, CACHE_MISSES, CACHE_SIZE
+from tracing import span, set_attribute, run_in_executor
+
+
+def _trace_usage(response):
+    """把 token 用量记到当前 span 上（慢请求日志里能看到提示词大小）"""
+    usage = getattr(response, "usage", None)
+    if usage:
+        set_attribute("prompt_tokens", usage.prompt_tokens)
+        set_attribute("completion_tokens", usage.completion_tokens)
 
 
 class AIClient:
@@ -22,64 +37,109 @@ class AIClient:
         self.vision_model_name = VISION_MODEL_NAME  # 视觉模型
         self.max_retry = max_retry or MAX_API_RETRY
         
-        self.client = OpenAI(
-            api_key=self.api_key,
-            base_url=self.base_url
-        )
-        
-        # 对话历史缓存 {user_id: [messages]}
+        # 对话历史缓存 {user_id: [Turn]}（按用户在第一次对话时加载）
         self.conversations = {}
-        # 用户人设选择 {user_id: persona_key}
-        self.user_personas = {}
-        # 统计管理器
-        self.stats = StatsManager(history_dir or HISTORY_DIR)
-        # 记忆管理器
-        self.memory = MemoryManager(history_dir or HISTORY_DIR)
-        # 搜索管理器
-        self.search = SearchManager()
+        # 语音转写线程池（与聊天分开，避免长语音占满线程）
+        self.transcribe_executor = ThreadPoolExecutor(
+            max_workers=TRANSCRIBE_MAX_WORKERS,
+            thread_name_prefix="transcribe"
+        )
         # 保留最近N轮对话
         self.max_history = 10
+        # 批量任务执行器（由机器人设置；设置后后台记忆提取走批量接口）
+        self.batch_runner = None
         
         # 创建历史记录目录
         self.history_dir = Path(history_dir or HISTORY_DIR)
         self.history_dir.mkdir(exist_ok=True)
+        # 对话历史按用户追加写，定期压缩到最近 max_history 轮
+        self.history_store = HistoryStore(self.history_dir, max_messages=self.max_history * 2)
         
-        # 加载数据
-        self._load_all_histories()
-        self._load_user_personas()
-
-    def _get_history_file(self, user_id: str) -> Path:
-        """获取用户历史记录文件路径"""
-        # 使用安全的文件名
-        safe_name = "".join(c if c.isalnum() or c in ('-', '_') else '_' for c in user_id)
-        return self.history_dir / f"{safe_name}.json"
+        # OpenAI 客户端、人设、统计、记忆、搜索都是延迟属性，第一次用到或后台预热时才加载
+        CACHE_SIZE.set_function(lambda: len(self.conversations), cache="conversations")
     
+    @lazy_property
+    def client(self):
+        """OpenAI 客户端（openai 包导入较慢，延迟到第一次使用）"""
+        from openai import OpenAI
+        return OpenAI(
+            api_key=self.api_key,
+            base_url=self.base_url
+        )
+    
+    @lazy_property
+    def user_personas(self) -> dict:
+        """用户人设选择 {user_id: persona_key}"""
+        return self._load_user_personas()
+    
+    @lazy_property
+    def stats(self):
+        """统计管理器"""
+        from stats import StatsManager
+        return StatsManager(self.history_dir)
+    
+    @lazy_property
+    def usage(self):
+        """用量统计（按用户 / 人设 / 模型 / 功能）和每日额度"""
+        return UsageTracker(self.history_dir / "usage")
+    
+    @lazy_property
+    def memory(self):
+        """记忆管理器（启动时要重放修改日志）"""
+        from memory import MemoryManager
+        memory = MemoryManager(self.history_dir)
+        if MEMORY_EXTRACT_ENABLED:
+            from memory_extractor import MemoryExtractor
+            memory.extractor = MemoryExtractor(
+                self.client,
+                memory,
+                model=MEMORY_EXTRACT_MODEL,
+                batch_size=MEMORY_EXTRACT_BATCH_SIZE,
+                flush_interval=MEMORY_EXTRACT_FLUSH_INTERVAL
+            )
+            memory.extractor.batch_runner = self.batch_runner
+            memory.extractor.usage = self.usage
+        return memory
+    
+    @lazy_property
+    def search(self):
+        """搜索管理器"""
+        from search import SearchManager
+        return SearchManager()
+    
+    def warm_up(self):
+        """后台预热：提前初始化各组件，避免第一个用户等待"""
+        for name in ("client", "user_personas", "stats", "usage", "memory", "search"):
+            try:
+                getattr(self, name)
+            except Exception as e:
+                logger.warning(f"预热 {name} 失败: {e}")
+
     def _get_personas_file(self) -> Path:
         """获取用户人设配置文件路径"""
         return self.history_dir / "user_personas.json"
     
-    def _load_user_personas(self):
+    def _load_user_personas(self) -> dict:
         """加载用户人设配置"""
         personas_file = self._get_personas_file()
         
         if personas_file.exists():
             try:
-                with open(personas_file, 'r', encoding='utf-8') as f:
-                    self.user_personas = json.load(f)
-                logger.info(f"已加载 {len(self.user_personas)} 个用户的人设配置")
+                user_personas = serialization.load_file(personas_file)
+                logger.info(f"已加载 {len(user_personas)} 个用户的人设配置")
+                return user_personas
             except Exception as e:
                 logger.warning(f"加载用户人设配置失败: {e}")
-                self.user_personas = {}
-        else:
-            self.user_personas = {}
+        return {}
     
     def _save_user_personas(self):
         """保存用户人设配置"""
         personas_file = self._get_personas_file()
         
         try:
-            with open(personas_file, 'w', encoding='utf-8') as f:
-                json.dump(self.user_personas, f, ensure_ascii=False, indent=2)
+            with DISK_SAVE_LATENCY.time(store="personas"):
+                with open(personas_file, 'wb') as f:
+                    f.write(serialization.dumps(self.user_personas, pretty=True))
         except Exception as e:
             logger.error(f"保存用户人设配置失败: {e}")
     
@@ -95,116 +155,134 @@ class AIClient:
     
     def _load_history(self, user_id: str):
         """加载单个用户的对话历史"""
-        history_file = self._get_history_file(user_id)
-        
-        if history_file.exists():
-            try:
-                with open(history_file, 'r', encoding='utf-8') as f:
-                    self.conversations[user_id] = json.load(f)
-                logger.debug(f"加载历史记录: {user_id}")
-            except Exception as e:
-                logger.warning(f"加载历史记录失败 [{user_id}]: {e}")
-                self.conversations[user_id] = []
-        else:
+        try:
+            self.conversations[user_id] = self.history_store.load(user_id)
+            logger.debug(f"加载历史记录: {user_id}")
+        except Exception as e:
+            logger.warning(f"加载历史记录失败 [{user_id}]: {e}")
             self.conversations[user_id] = []
     
-    def _load_all_histories(self):
-        """加载所有历史记录"""
-        if not self.history_dir.exists():
-            return
-        
-        # 需要跳过的配置文件
-        skip_files = {"user_personas.json", "user_stats.json", "user_memories.json"}
-        
-        count = 0
-        for history_file in self.history_dir.glob("*.json"):
-            # 跳过配置文件
-            if history_file.name in skip_files:
-                continue
-                
-            try:
-                with open(history_file, 'r', encoding='utf-8') as f:
-                    user_id = history_file.stem
-                    self.conversations[user_id] = json.load(f)
-                    count += 1
-            except Exception as e:
-                logger.warning(f"加载历史记录失败 [{history_file.name}]: {e}")
-        
-        if count > 0:
-            logger.info(f"已加载 {count} 个用户的历史记录")
-    
     def _save_history(self, user_id: str):
-        """保存单个用户的对话历史"""
-        history_file = self._get_history_file(user_id)
+        """重写单个用户的对话历史"""
+        try:
+            with span("history.save"), DISK_SAVE_LATENCY.time(store="history"):
+                self.history_store.rewrite(user_id, self.conversations.get(user_id, []))
+        except Exception as e:
+            logger.error(f"保存历史记录失败 [{user_id}]: {e}")
+    
+    def _append_history(self, user_id: str, user_message: str, reply: str):
+        """记录一轮对话：加入内存中的历史（只保留最近 max_history 轮），磁盘上只追加这两条"""
+        turn = [Turn("user", user_message), Turn("assistant", reply)]
+        history = self.conversations.setdefault(user_id, [])
+        history.extend(turn)
+        if len(history) > self.max_history * 2:
+            history = self.conversations[user_id] = history[-self.max_history * 2:]
         
         try:
-            with open(history_file, 'w', encoding='utf-8') as f:
-                json.dump(self.conversations.get(user_id, []), f, ensure_ascii=False, indent=2)
+            with span("history.save"), DISK_SAVE_LATENCY.time(store="history"):
+                self.history_store.append(user_id, turn, history)
         except Exception as e:
             logger.error(f"保存历史记录失败 [{user_id}]: {e}")
 
-    async def transcribe_audio(self, audio_bytes) -> str:
-        """语音转文字"""
+    def _transcribe(self, audio_bytes, filename: str, mime_type: str, user_id: str = "") -> str:
+        """调用语音转写 API（直接上传内存中的数据）"""
+        audio_bytes.seek(0)
+        with span("model.transcribe", model=TRANSCRIBE_MODEL), MODEL_LATENCY.time(model=TRANSCRIBE_MODEL):
+            transcript = self.client.audio.transcriptions.create(
+                model=TRANSCRIBE_MODEL,
+                file=(filename, audio_bytes, mime_type),
+                language=TRANSCRIBE_LANGUAGE
+            )
+        # whisper-1 不返回 token 用量，只记调用次数
+        usage = getattr(transcript, "usage", None)
+        self.usage.record("transcribe", TRANSCRIBE_MODEL, getattr(usage, "input_tokens", 0) or 0,
+                          getattr(usage, "output_tokens", 0) or 0, user_id)
+        return transcript.text
+    
+    async def transcribe_audio(self, audio_bytes, duration: int = 0, filename: str = "voice.ogg",
+                               mime_type: str = "audio/ogg", user_id: str = "") -> str:
+        """语音转文字（不写临时文件，长语音可切分后并行转写）"""
         try:
-            # 保存临时文件
-            import tempfile
-            with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as temp_file:
-                temp_file.write(audio_bytes.read())
-                temp_path = temp_file.name
-            
-            # 调用 Whisper API
-            with open(temp_path, "rb") as audio_file:
-                transcript = self.client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    language="zh"
+            # 长语音切分（只支持 ogg 语音消息）
+            chunks = [audio_bytes]
+            if TRANSCRIBE_CHUNK_SECONDS and duration > TRANSCRIBE_CHUNK_SECONDS and mime_type == "audio/ogg":
+                from audio_utils import split_audio
+                chunks = await run_in_executor(
+                    self.transcribe_executor, split_audio, audio_bytes, TRANSCRIBE_CHUNK_SECONDS
                 )
             
-            # 删除临时文件
-            import os
-            os.unlink(temp_path)
+            # 在独立的线程池中转写，不占用聊天线程
+            texts = await asyncio.gather(*(
+                run_in_executor(self.transcribe_executor, self._transcribe, chunk, filename, mime_type, user_id)
+                for chunk in chunks
+            ))
             
-            return transcript.text
+            # 切分点两边是英文等按空格分词的文字时，用空格隔开
+            return join_segments(texts)
             
         except Exception as e:
+            ERRORS.inc(where="transcribe", type=type(e).__name__)
             logger.error(f"语音转文字失败: {e}")
             return None
     
-    async def chat_with_image(self, user_id: str, message: str, image_bytes) -> str:
-        """与 AI 对话（带图片）"""
-        import base64
-        
-        # 获取或初始化对话历史
-        if user_id not in self.conversations:
-            self._load_history(user_id)
-        
-        history = self.conversations[user_id]
-        
-        # 首次对话，记录对话次数（历史为空表示新对话）
-        if len(history) == 0:
-            self.stats.record_conversation(user_id)
+    def _prepare_prompt(self, user_id: str, message: str):
+        """准备对话历史和系统提示词（顺带记录统计），返回 (history, system_prompt)"""
+        with span("prompt.assemble"):
+            # 获取或初始化对话历史
+            with span("history.load"):
+                if user_id not in self.conversations:
+                    CACHE_MISSES.inc(cache="history")
+                    self._load_history(user_id)
+                else:
+                    CACHE_HITS.inc(cache="history")
+            
+            history = self.conversations[user_id]
+            
+            # 获取用户当前人设
+            persona_key = self.get_user_persona(user_id)
+            persona = get_persona(persona_key)
+            current_prompt = persona['prompt']
+            
+            # 获取记忆上下文
+            with span("memory.context"):
+                memory_context = self.memory.get_memory_context(user_id, message)
+            if memory_context:
+                current_prompt = f"{current_prompt}\n\n{memory_context}"
+            
+            set_attribute("history_messages", len(history))
+            set_attribute("prompt_chars", len(current_prompt))
         
-        # 获取用户当前人设
-        persona_key = self.get_user_persona(user_id)
-        persona = get_persona(persona_key)
-        current_prompt = persona['prompt']
+        with span("stats.record"):
+            # 首次对话，记录对话次数（历史为空表示新对话）
+            if len(history) == 0:
+                self.stats.record_conversation(user_id)
+            
+            # 记录消息统计
+            self.stats.record_message(user_id, persona_key)
         
-        # 获取记忆上下文
-        memory_context = self.memory.get_memory_context(user_id)
-        if memory_context:
-            current_prompt = f"{current_prompt}\n\n{memory_context}"
+        return history, current_prompt
+    
+    async def chat_with_image(self, user_id: str, message: str, image_bytes) -> str:
+        """与 AI 对话（带图片）"""
+        if not self.usage.check_budget(user_id):
+            return BUDGET_EXCEEDED_REPLY
         
-        # 记录消息统计
-        self.stats.record_message(user_id, persona_key)
+        # 将图片转为 base64（超过大小上限会抛出 ImageTooLargeError）
+        from image_utils import build_image_url
+        # 缩放和编码放到线程池，不阻塞事件循环
+        with span("image.encode"):
+            image_url = await run_in_executor(
+                None, build_image_url,
+                image_bytes, VISION_MAX_IMAGE_BYTES, VISION_MAX_SIDE, VISION_JPEG_QUALITY
+            )
         
-        # 将图片转为 base64
-        image_base64 = base64.b64encode(image_bytes.read()).decode('utf-8')
+        history, current_prompt = self._prepare_prompt(user_id, message)
         
         # 构建消息（包含历史对话）
         messages = [{"role": "system", "content": current_prompt}]
         
         # 添加历史对话
-        messages.extend(history)
+        messages.extend(turn.to_dict() for turn in history)
         
         # 添加当前图片消息
         messages.append({
@@ -214,7 +292,7 @@ class AIClient:
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": f"data:image/jpeg;base64,{image_base64}"
+                        "url": image_url
                     }
                 }
             ]
@@ -225,32 +303,30 @@ class AIClient:
         for attempt in range(self.max_retry):
             try:
                 # 使用视觉模型（图片识别专用）
-                response = self.client.chat.completions.create(
-                    model=self.vision_model_name,  # 使用视觉模型
-                    messages=messages,
-                    max_tokens=1000,
-                    temperature=0.7,
-                    timeout=90  # 视觉模型可能需要更长时间
-                )
+                with span("model.call", model=self.vision_model_name, attempt=attempt), \
+                        MODEL_LATENCY.time(model=self.vision_model_name):
+                    response = self.client.chat.completions.create(
+                        model=self.vision_model_name,  # 使用视觉模型
+                        messages=messages,
+                        max_tokens=1000,
+                        temperature=0.7,
+                        timeout=90  # 视觉模型可能需要更长时间
+                    )
+                    _trace_usage(response)
+                self.usage.record_response(response, "vision", self.vision_model_name,
+                                           user_id, self.get_user_persona(user_id))
                 
                 reply = response.choices[0].message.content.strip()
                 
                 # 保存文字交互到历史记录（不保存图片base64）
-                history.append({"role": "user", "content": f"[发送了图片] {message}"})
-                history.append({"role": "assistant", "content": reply})
-                
-                # 限制历史长度
-                if len(history) > self.max_history * 2:
-                    self.conversations[user_id] = history[-self.max_history * 2:]
-                
-                # 保存历史记录
-                self._save_history(user_id)
+                self._append_history(user_id, f"[发送了图片] {message}", reply)
                 
                 return reply
                 
             except Exception as e:
                 last_error = e
                 error_msg = str(e)
+                ERRORS.inc(where="vision", type=type(e).__name__)
                 
                 # 检查是否是模型不存在的错误
                 if "does not exist" in error_msg or "Model not found" in error_msg:
@@ -261,6 +337,7 @@ class AIClient:
                 if "timeout" in error_msg.lower() or "timed out" in error_msg.lower():
                     logger.warning(f"图片识别超时 ({attempt + 1}/{self.max_retry})")
                     if attempt < 1:
+                        RETRIES.inc(operation="vision")
                         time.sleep(2)
                         continue
                     else:
@@ -270,6 +347,7 @@ class AIClient:
                 if attempt < self.max_retry - 1:
                     wait_time = 2 ** attempt
                     logger.warning(f"AI 图片识别失败，重试 ({attempt + 1}/{self.max_retry})，等待 {wait_time}s")
+                    RETRIES.inc(operation="vision")
                     time.sleep(wait_time)
                 else:
                     logger.error(f"AI 图片识别失败，已达最大重试次数")
@@ -280,34 +358,17 @@ class AIClient:
         else:
             return "图片识别失败了|||请稍后再试"
     
-    def chat(self, user_id: str, message: str) -> str:
+    def chat(self, user_id: str, message: str, extract_memory: bool = True) -> str:
         """与 AI 对话（带重试机制）"""
-        # 获取或初始化对话历史
-        if user_id not in self.conversations:
-            self._load_history(user_id)
-        
-        history = self.conversations[user_id]
-        
-        # 首次对话，记录对话次数（历史为空表示新对话）
-        if len(history) == 0:
-            self.stats.record_conversation(user_id)
-        
-        # 获取用户当前人设
-        persona_key = self.get_user_persona(user_id)
-        persona = get_persona(persona_key)
-        current_prompt = persona['prompt']
+        # 额度用完的用户不发请求，也不记入历史和统计
+        if not self.usage.check_budget(user_id):
+            return BUDGET_EXCEEDED_REPLY
         
-        # 获取记忆上下文
-        memory_context = self.memory.get_memory_context(user_id)
-        if memory_context:
-            current_prompt = f"{current_prompt}\n\n{memory_context}"
-        
-        # 记录消息统计
-        self.stats.record_message(user_id, persona_key)
+        history, current_prompt = self._prepare_prompt(user_id, message)
         
         # 构建消息列表
         messages = [{"role": "system", "content": current_prompt}]
-        messages.extend(history)
+        messages.extend(turn.to_dict() for turn in history)
         messages.append({"role": "user", "content": message})
 
         # 重试机制
@@ -315,37 +376,39 @@ class AIClient:
         for attempt in range(self.max_retry):
             try:
                 # 调用 AI（设置合理的超时）
-                response = self.client.chat.completions.create(
-                    model=self.model_name,
-                    messages=messages,
-                    max_tokens=1000,
-                    temperature=0.7,
-                    timeout=60  # 增加到60秒，避免频繁超时
-                )
+                with span("model.call", model=self.model_name, attempt=attempt), \
+                        MODEL_LATENCY.time(model=self.model_name):
+                    response = self.client.chat.completions.create(
+                        model=self.model_name,
+                        messages=messages,
+                        max_tokens=1000,
+                        temperature=0.7,
+                        timeout=60  # 增加到60秒，避免频繁超时
+                    )
+                    _trace_usage(response)
+                self.usage.record_response(response, "chat", self.model_name, user_id, self.get_user_persona(user_id))
                 
                 reply = response.choices[0].message.content.strip()
                 
-                # 更新对话历史
-                history.append({"role": "user", "content": message})
-                history.append({"role": "assistant", "content": reply})
+                # 更新对话历史（只追加这一轮）
+                self._append_history(user_id, message, reply)
                 
-                # 限制历史长度
-                if len(history) > self.max_history * 2:
-                    self.conversations[user_id] = history[-self.max_history * 2:]
-                
-                # 保存历史记录
-                self._save_history(user_id)
+                # 交给后台提取记忆（不阻塞回复）
+                if extract_memory:
+                    self.memory.extract_and_save(user_id, message, reply)
                 
                 return reply
                 
             except Exception as e:
                 last_error = e
                 error_type = type(e).__name__
+                ERRORS.inc(where="chat", type=error_type)
                 
                 # 超时错误不重试太多次
                 if "timeout" in str(e).lower() or "timed out" in str(e).lower():
                     logger.warning(f"AI 调用超时 ({attempt + 1}/{self.max_retry}): {e}")
                     if attempt < 1:  # 超时只重试1次
+                        RETRIES.inc(operation="chat")
                         time.sleep(2)
                         continue
                     else:
@@ -355,6 +418,7 @@ class AIClient:
                 if attempt < self.max_retry - 1:
                     wait_time = 2 ** attempt  # 指数退避：1s, 2s, 4s
                     logger.warning(f"AI 调用失败，重试 ({attempt + 1}/{self.max_retry})，等待 {wait_time}s: {error_type}")
+                    RETRIES.inc(operation="chat")
                     time.sleep(wait_time)
                 else:
                     logger.error(f"AI 调用失败，已达最大重试次数: {error_type} - {e}")
@@ -367,9 +431,41 @@ class AIClient:
         
         return f"抱歉，我暂时无法回复（{last_error}），请稍后再试~"
 
+    def complete(self, prompt: str, max_tokens: int = 1000, temperature: float = 0.7,
+                 feature: str = "complete") -> str:
+        """单次补全（不带人设、不读写对话历史，可以在多个线程中并发调用），失败时抛出异常
+
+        feature 是用量统计里的功能名（如 summary）
+        """
+        last_error = None
+        for attempt in range(self.max_retry):
+            try:
+                with span("model.call", model=self.model_name, attempt=attempt), \
+                        MODEL_LATENCY.time(model=self.model_name):
+                    response = self.client.chat.completions.create(
+                        model=self.model_name,
+                        messages=[{"role": "user", "content": prompt}],
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        timeout=60
+                    )
+                    _trace_usage(response)
+                self.usage.record_response(response, feature, self.model_name)
+                return response.choices[0].message.content.strip()
+            except Exception as e:
+                last_error = e
+                ERRORS.inc(where="complete", type=type(e).__name__)
+                if attempt < self.max_retry - 1:
+                    wait_time = 2 ** attempt
+                    logger.warning(f"AI 调用失败，重试 ({attempt + 1}/{self.max_retry})，等待 {wait_time}s: {type(e).__name__}")
+                    RETRIES.inc(operation="complete")
+                    time.sleep(wait_time)
+        raise last_error
+
     def clear_history(self, user_id: str):
         """清除某用户的对话历史"""
-        if user_id in self.conversations:
+        # 历史是按需加载的，没加载过的用户也要清掉磁盘上的记录
+        if user_id in self.conversations or self.history_store.exists(user_id):
             self.conversations[user_id] = []
             self._save_history(user_id)
             logger.info(f"已清空历史记录: {user_id}")
@@ -0,0 +1,40 @@
+"""
+音频处理模块
+把长语音切分成多段，便于并行转写
+"""
+import io
+from loguru import logger
+
+try:
+    from pydub import AudioSegment
+except ImportError:  # pydub 可选（还需要系统安装 ffmpeg），没有就不切分
+    AudioSegment = None
+
+
+def split_audio(audio_bytes: io.BytesIO, chunk_seconds: int, audio_format: str = "ogg") -> list:
+    """按固定时长切分音频，返回 [BytesIO]；无法切分时返回 [原音频]"""
+    if AudioSegment is None or chunk_seconds <= 0:
+        return [audio_bytes]
+
+    try:
+        audio_bytes.seek(0)
+        audio = AudioSegment.from_file(audio_bytes, format=audio_format)
+    except Exception as e:
+        logger.warning(f"音频解码失败，不切分: {e}")
+        return [audio_bytes]
+    finally:
+        audio_bytes.seek(0)
+
+    chunk_ms = chunk_seconds * 1000
+    if len(audio) <= chunk_ms:
+        return [audio_bytes]
+
+    chunks = []
+    for start in range(0, len(audio), chunk_ms):
+        out = io.BytesIO()
+        audio[start:start + chunk_ms].export(out, format="ogg", codec="libopus")
+        out.seek(0)
+        chunks.append(out)
+
+    logger.debug(f"语音已切分为 {len(chunks)} 段")
+    return chunks
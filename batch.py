@@ -0,0 +1,305 @@
+"""
+批量任务模块
+把不着急的模型调用（夜间群总结、后台记忆提取等）攒起来，作为一个 OpenAI Batch 任务提交，
+定时查询结果，再按任务类型交给对应的处理函数写回去。批量接口价格通常只有实时调用的一半
+
+模式：
+- api：使用 /v1/files + /v1/batches（OpenAI 兼容的批量接口）
+- local：在本地逐个调用 chat.completions（服务商不支持批量接口时使用，结果立即写回）
+"""
+import io
+import threading
+import time
+import uuid
+from pathlib import Path
+from loguru import logger
+from storage import atomic_write_json
+import serialization
+from metrics import ERRORS
+
+# 批量接口相对实时调用的价格折扣
+BATCH_DISCOUNT = 0.5
+
+# 表示服务商不支持批量接口的 HTTP 状态码（其余错误当作暂时性的，下次再提交）
+_UNSUPPORTED_STATUS = (404, 405, 501)
+
+
+class BatchRunner:
+    """批量任务执行器"""
+
+    def __init__(self, client_getter, mode: str = "api", state_dir: str = "batches",
+                 completion_window: str = "24h", usage_getter=None):
+        # 延迟获取 OpenAI 客户端（不让批量模块拖慢启动）
+        self._client_getter = client_getter
+        # 延迟获取用量统计（按任务类型记 token 用量）
+        self._usage_getter = usage_getter
+        self.mode = mode
+        self.completion_window = completion_window
+        self.state_dir = Path(state_dir)
+        self.state_dir.mkdir(exist_ok=True)
+        self.state_file = self.state_dir / "state.json"
+
+        # 结果处理函数 {类型: func(payload, 回复文本)}
+        self._handlers = {}
+        self._lock = threading.Lock()
+        # 同一时间只有一个线程在提交（任务在拿到批次 ID 或执行完之前一直留在待提交队列里）
+        self._submit_lock = threading.Lock()
+
+        # 待提交的任务 [{"id", "kind", "payload", "body"}]，已提交的批次 {batch_id: {...}}
+        self.queued = []
+        self.batches = {}
+        # 累计统计
+        self.totals = {"batches": 0, "requests": 0, "succeeded": 0, "failed": 0,
+                       "prompt_tokens": 0, "completion_tokens": 0, "turnaround_seconds": 0.0}
+        self._load_state()
+
+    def _load_state(self):
+        if not self.state_file.exists():
+            return
+        try:
+            data = serialization.load_file(self.state_file)
+            self.queued = data.get("queued", [])
+            self.batches = data.get("batches", {})
+            self.totals.update(data.get("totals", {}))
+            if self.queued or self.batches:
+                logger.info(f"📦 恢复批量任务：{len(self.queued)} 个待提交，{len(self.batches)} 个批次处理中")
+        except Exception as e:
+            logger.error(f"加载批量任务状态失败: {e}")
+
+    def _save_state(self):
+        """保存状态（调用时需持有 self._lock）"""
+        try:
+            atomic_write_json(self.state_file, {
+                "queued": self.queued, "batches": self.batches, "totals": self.totals
+            })
+        except Exception as e:
+            logger.error(f"保存批量任务状态失败: {e}")
+
+    def register(self, kind: str, handler):
+        """注册某类任务的结果处理函数：handler(payload, text)，text 为 None 表示失败"""
+        self._handlers[kind] = handler
+
+    def add(self, kind: str, body: dict, payload: dict = None) -> str:
+        """加入一个待提交的任务（body 是 chat.completions 的请求参数），返回任务 ID"""
+        job_id = f"{kind}-{uuid.uuid4().hex[:12]}"
+        with self._lock:
+            self.queued.append({"id": job_id, "kind": kind, "payload": payload or {}, "body": body})
+            self._save_state()
+        return job_id
+
+    @property
+    def pending(self) -> int:
+        """还没拿到结果的任务数"""
+        with self._lock:
+            return len(self.queued) + sum(len(b["jobs"]) for b in self.batches.values())
+
+    def submit(self):
+        """提交所有待提交的任务，返回批次 ID（本地模式直接执行，返回 None）
+
+        任务在批次 ID 记下来（或本地执行完交给处理函数）之后才移出待提交队列，
+        中途出错或崩溃的任务下次还会再提交
+        """
+        with self._submit_lock:
+            with self._lock:
+                jobs = list(self.queued)
+            if not jobs:
+                return None
+
+            if self.mode == "api":
+                try:
+                    return self._submit_api(jobs)
+                except Exception as e:
+                    ERRORS.inc(where="batch_submit", type=type(e).__name__)
+                    if getattr(e, "status_code", None) not in _UNSUPPORTED_STATUS:
+                        # 超时、限流、服务端错误等：任务留在队列里，下次再提交
+                        logger.warning(f"提交批量任务失败，稍后重试: {e}")
+                        return None
+                    # 服务商不支持批量接口，之后都在本地执行
+                    logger.warning(f"服务商不支持批量接口，改为本地逐个执行: {e}")
+                    self.mode = "local"
+
+            self._run_local(jobs)
+            return None
+
+    def _dequeue(self, job_ids):
+        """把已经提交或执行完的任务移出待提交队列（调用时需持有 self._lock）"""
+        job_ids = set(job_ids)
+        self.queued = [job for job in self.queued if job["id"] not in job_ids]
+
+    def _submit_api(self, jobs: list) -> str:
+        client = self._client_getter()
+        data = b"".join(serialization.dumps({
+            "custom_id": job["id"],
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": job["body"],
+        }) + b"\n" for job in jobs)
+
+        input_file = client.files.create(file=("batch.jsonl", io.BytesIO(data)), purpose="batch")
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=self.completion_window,
+        )
+
+        with self._lock:
+            self.batches[batch.id] = {
+                "submitted_at": time.time(),
+                "jobs": {job["id"]: {"kind": job["kind"], "payload": job["payload"], "model": job["body"].get("model", "")}
+                         for job in jobs},
+            }
+            # 批次和出队在同一次保存里，不会丢任务（在这之前崩溃的话会重复提交一次）
+            self._dequeue(job["id"] for job in jobs)
+            self.totals["batches"] += 1
+            self.totals["requests"] += len(jobs)
+            self._save_state()
+        logger.info(f"📦 已提交批量任务 {batch.id}：{len(jobs)} 个请求")
+        return batch.id
+
+    def _run_local(self, jobs: list):
+        """本地逐个执行（没有批量接口时的等价实现）"""
+        client = self._client_getter()
+        start = time.time()
+        with self._lock:
+            self.totals["batches"] += 1
+            self.totals["requests"] += len(jobs)
+        for job in jobs:
+            try:
+                response = client.chat.completions.create(**job["body"])
+                usage = response.usage
+                self._deliver(job["kind"], job["payload"], response.choices[0].message.content,
+                              usage.prompt_tokens if usage else 0, usage.completion_tokens if usage else 0,
+                              job["body"].get("model", ""))
+            except Exception as e:
+                logger.warning(f"批量任务 {job['id']} 执行失败: {e}")
+                self._deliver(job["kind"], job["payload"], None)
+            with self._lock:
+                self._dequeue([job["id"]])
+                self._save_state()
+        with self._lock:
+            self.totals["turnaround_seconds"] += time.time() - start
+            self._save_state()
+
+    def poll(self) -> int:
+        """查询已提交的批次，处理完成的结果，返回完成的批次数"""
+        with self._lock:
+            batch_ids = list(self.batches)
+        if not batch_ids:
+            return 0
+
+        client = self._client_getter()
+        finished = 0
+        for batch_id in batch_ids:
+            try:
+                batch = client.batches.retrieve(batch_id)
+            except Exception as e:
+                ERRORS.inc(where="batch_poll", type=type(e).__name__)
+                logger.warning(f"查询批量任务 {batch_id} 失败: {e}")
+                continue
+
+            if batch.status in ("validating", "in_progress", "finalizing", "cancelling"):
+                continue
+
+            info = self.batches[batch_id]
+            jobs = dict(info["jobs"])
+            if batch.status == "completed":
+                for file_id in (batch.output_file_id, batch.error_file_id):
+                    if file_id:
+                        self._collect(client, file_id, jobs)
+            else:
+                logger.warning(f"批量任务 {batch_id} 结束，状态: {batch.status}")
+
+            # 没有结果的任务算失败（过期、取消等）
+            for job in jobs.values():
+                self._deliver(job["kind"], job["payload"], None)
+
+            with self._lock:
+                self.totals["turnaround_seconds"] += time.time() - info["submitted_at"]
+                del self.batches[batch_id]
+                self._save_state()
+            finished += 1
+            logger.info(f"📦 批量任务 {batch_id} 已完成：{self.format_report()}")
+        return finished
+
+    def _collect(self, client, file_id: str, jobs: dict):
+        """读取结果文件，把每条结果交给对应的处理函数"""
+        try:
+            content = client.files.content(file_id).text
+        except Exception as e:
+            logger.error(f"下载批量任务结果失败 [{file_id}]: {e}")
+            return
+
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = serialization.loads(line)
+            except serialization.DecodeError:
+                continue
+            job = jobs.pop(record.get("custom_id"), None)
+            if job is None:
+                continue
+
+            response = record.get("response") or {}
+            body = response.get("body") or {}
+            if response.get("status_code") == 200 and body.get("choices"):
+                usage = body.get("usage") or {}
+                self._deliver(job["kind"], job["payload"], body["choices"][0]["message"]["content"],
+                              usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0),
+                              job.get("model") or body.get("model", ""))
+            else:
+                logger.warning(f"批量任务 {record.get('custom_id')} 失败: {record.get('error') or body}")
+                self._deliver(job["kind"], job["payload"], None)
+
+    def _deliver(self, kind: str, payload: dict, text, prompt_tokens: int = 0, completion_tokens: int = 0,
+                 model: str = ""):
+        """把结果交给处理函数并记录统计"""
+        with self._lock:
+            if text is None:
+                self.totals["failed"] += 1
+            else:
+                self.totals["succeeded"] += 1
+                self.totals["prompt_tokens"] += prompt_tokens
+                self.totals["completion_tokens"] += completion_tokens
+        if text is not None and self._usage_getter is not None:
+            self._usage_getter().record(kind, model, prompt_tokens, completion_tokens)
+
+        handler = self._handlers.get(kind)
+        if handler is None:
+            logger.warning(f"没有处理 {kind} 类批量任务的函数，结果已丢弃")
+            return
+        try:
+            handler(payload, text)
+        except Exception as e:
+            ERRORS.inc(where=f"batch_{kind}", type=type(e).__name__)
+            logger.error(f"处理批量任务结果失败 [{kind}]: {e}")
+
+    def report(self) -> dict:
+        """吞吐量和费用统计"""
+        with self._lock:
+            totals = dict(self.totals)
+            queued = len(self.queued)
+            in_flight = sum(len(b["jobs"]) for b in self.batches.values())
+
+        done = totals["succeeded"] + totals["failed"]
+        tokens = totals["prompt_tokens"] + totals["completion_tokens"]
+        discount = BATCH_DISCOUNT if self.mode == "api" else 0.0
+        return {
+            "mode": self.mode,
+            "queued": queued,
+            "in_flight": in_flight,
+            **totals,
+            "avg_turnaround_seconds": round(totals["turnaround_seconds"] / totals["batches"], 1)
+            if totals["batches"] else 0.0,
+            "requests_per_minute": round(done / totals["turnaround_seconds"] * 60, 1)
+            if totals["turnaround_seconds"] else 0.0,
+            "total_tokens": tokens,
+            # 按实时价格折算节省的 token 数
+            "saved_tokens_equivalent": int(tokens * discount),
+        }
+
+    def format_report(self) -> str:
+        r = self.report()
+        return (f"{r['succeeded']}/{r['requests']} 成功，{r['failed']} 失败，"
+                f"{r['total_tokens']} tokens（约节省 {r['saved_tokens_equivalent']}），"
+                f"平均 {r['avg_turnaround_seconds']}s/批")
@@ -0,0 +1,100 @@
+"""
+批量任务基准
+用假 OpenAI 服务对比同一批总结请求：实时逐个调用 vs 通过批量接口提交，输出吞吐量、HTTP 请求数和折算费用
+
+示例：
+    python -m benchmarks.bench_batch
+    python -m benchmarks.bench_batch --requests 200 --latency lognormal:-0.5,0.5 --batch-latency 2
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.fake_telegram import SAMPLE_TEXTS
+
+
+def make_bodies(count: int) -> list:
+    """生成模拟的群总结请求"""
+    bodies = []
+    for i in range(count):
+        history = "\n".join(f"[10-01 12:{j:02d}] user{j}: {SAMPLE_TEXTS[(i + j) % len(SAMPLE_TEXTS)]}"
+                            for j in range(40))
+        bodies.append({
+            "model": "fake",
+            "messages": [{"role": "user", "content": f"请总结以下群聊消息的重点内容：\n{history}"}],
+            "max_tokens": 300,
+        })
+    return bodies
+
+
+def run_interactive(client, bodies: list) -> dict:
+    start = time.perf_counter()
+    tokens = 0
+    for body in bodies:
+        response = client.chat.completions.create(**body)
+        tokens += response.usage.total_tokens
+    wall = time.perf_counter() - start
+    return {"wall_seconds": round(wall, 3), "requests_per_sec": round(len(bodies) / wall, 2),
+            "total_tokens": tokens, "cost_tokens_equivalent": tokens}
+
+
+def run_batch(client, bodies: list, poll_interval: float) -> dict:
+    from batch import BatchRunner
+
+    results = []
+    with tempfile.TemporaryDirectory() as state_dir:
+        runner = BatchRunner(lambda: client, mode="api", state_dir=state_dir)
+        runner.register("summary", lambda payload, text: results.append(text))
+
+        start = time.perf_counter()
+        for i, body in enumerate(bodies):
+            runner.add("summary", body, {"chat_id": -i})
+        runner.submit()
+        while runner.pending:
+            time.sleep(poll_interval)
+            runner.poll()
+        wall = time.perf_counter() - start
+        report = runner.report()
+
+    return {"wall_seconds": round(wall, 3), "requests_per_sec": round(len(bodies) / wall, 2),
+            "total_tokens": report["total_tokens"],
+            "cost_tokens_equivalent": report["total_tokens"] - report["saved_tokens_equivalent"],
+            "succeeded": report["succeeded"], "failed": report["failed"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量任务基准")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--latency", default="fixed:0.05", help="实时调用的延迟分布")
+    parser.add_argument("--batch-latency", type=float, default=1.0, help="假批量接口完成一个批次的耗时（秒）")
+    parser.add_argument("--poll-interval", type=float, default=0.2)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from loguru import logger
+    logger.remove()
+    from openai import OpenAI
+
+    server = FakeOpenAIServer(latency=args.latency, batch_latency=args.batch_latency).start()
+    client = OpenAI(api_key="bench", base_url=server.base_url)
+    bodies = make_bodies(args.requests)
+
+    before = server.requests
+    interactive = run_interactive(client, bodies)
+    interactive["http_requests"] = server.requests - before
+
+    before = server.requests
+    batch = run_batch(client, bodies, args.poll_interval)
+    batch["http_requests"] = server.requests - before
+    server.stop()
+
+    print(json.dumps({"params": vars(args), "interactive": interactive, "batch": batch},
+                     ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+群消息缓存内存基准
+对比旧格式（dict + ISO 时间字符串 + 列表）和 GroupMonitor 的紧凑缓存，每条消息占用多少字节
+
+示例：
+    python -m benchmarks.bench_group_cache
+    python -m benchmarks.bench_group_cache --messages 200000 --groups 500 --users 2000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime
+
+from benchmarks.fake_telegram import SAMPLE_TEXTS
+
+
+def make_workload(args) -> list:
+    """生成 (chat_id, user_id, username, text) 列表（文本是独立的新字符串，和真实消息一样）"""
+    random.seed(args.seed)
+    workload = []
+    for i in range(args.messages):
+        chat_id = -(1000 + random.randrange(args.groups))
+        user_id = 10_000_000 + random.randrange(args.users)
+        text = f"{random.choice(SAMPLE_TEXTS)} {i}"
+        workload.append((chat_id, user_id, f"user{user_id}", text))
+    return workload
+
+
+def measure(build) -> tuple:
+    """返回 (分配的字节数, 耗时秒)"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    start = time.perf_counter()
+    keep = build()
+    elapsed = time.perf_counter() - start
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del keep
+    return allocated, elapsed
+
+
+def bench_legacy(workload: list):
+    """旧实现：defaultdict(list) 里存 dict，时间戳是 ISO 字符串"""
+    cache = defaultdict(list)
+    for chat_id, user_id, username, text in workload:
+        # 用户名每次都是 Telegram 反序列化出来的新字符串
+        cache[chat_id].append({
+            "user_id": int(str(user_id)),
+            "username": "".join(username),
+            "message": text,
+            "timestamp": datetime.now().isoformat()
+        })
+    return cache
+
+
+def bench_compact(workload: list, storage_dir: str):
+    """新实现：GroupMonitor 的环形缓冲区（关掉落盘，只测缓存本身）"""
+    from group_monitor import GroupMonitor
+
+    monitor = GroupMonitor(storage_dir, wal_fsync_interval=0, max_cache_bytes=1 << 62)
+    monitor.save_every = 1 << 62
+    monitor.max_cache_size = 1 << 30
+    monitor.wal.append = lambda record: None
+    monitor.search_index.add = lambda *args: None
+    for chat_id, user_id, username, text in workload:
+        monitor.record_message(chat_id, int(str(user_id)), "".join(username), text)
+    return monitor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="群消息缓存内存基准")
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--groups", type=int, default=200)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from loguru import logger
+    logger.remove()
+
+    workload = make_workload(args)
+    text_bytes = sum(sys.getsizeof(text) for _, _, _, text in workload)
+
+    legacy_bytes, legacy_seconds = measure(lambda: bench_legacy(workload))
+    with tempfile.TemporaryDirectory() as storage_dir:
+        compact_bytes, compact_seconds = measure(lambda: bench_compact(workload, storage_dir))
+
+    # 正文本身在两种实现里都是同一批字符串，不计入
+    report = {
+        "params": vars(args),
+        "message_text_bytes_per_message": round(text_bytes / args.messages, 1),
+        "legacy": {
+            "bytes_per_message": round(legacy_bytes / args.messages, 1),
+            "us_per_message": round(legacy_seconds / args.messages * 1e6, 2),
+        },
+        "compact": {
+            "bytes_per_message": round(compact_bytes / args.messages, 1),
+            "us_per_message": round(compact_seconds / args.messages * 1e6, 2),
+        },
+    }
+    report["saving"] = f"{(1 - compact_bytes / legacy_bytes) * 100:.0f}%" if legacy_bytes else "n/a"
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+序列化基准
+用和真实文件同样结构的数据，对比各个 JSON 后端（json / orjson / msgspec，装了哪个测哪个）的编码、解码耗时和文件大小
+
+示例：
+    python -m benchmarks.bench_serialization
+    python -m benchmarks.bench_serialization --users 5000 --group-messages 5000 --repeat 20
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.fake_telegram import SAMPLE_TEXTS
+
+
+def make_shapes(args) -> dict:
+    """生成各类文件的数据 {名称: (数据, 结构名, 是否缩进)}，缩进和实际写盘时一致"""
+    random.seed(args.seed)
+    now = datetime.now()
+    filler = "这是一段比较长的历史消息，用来模拟真实对话里的上下文内容。"
+
+    history = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"{i} {filler * random.randint(1, 4)}"}
+        for i in range(20)
+    ]
+
+    users = {}
+    for user_id in range(args.users):
+        days = random.randint(1, 90)
+        persona_usage = {p: random.randint(1, 500) for p in random.sample(
+            ["xiaogao", "fengzi", "assistant", "funny", "scholar"], random.randint(1, 3))}
+        users[str(10_000_000 + user_id)] = {
+            "total_messages": random.randint(1, 5000),
+            "total_conversations": random.randint(1, 200),
+            "first_use": (now - timedelta(days=days)).isoformat(),
+            "last_use": now.isoformat(),
+            "persona_usage": persona_usage,
+            "favorite_persona": max(persona_usage, key=persona_usage.get),
+            "daily": {"start": (now - timedelta(days=days - 1)).strftime("%Y-%m-%d"),
+                      "counts": [random.randint(0, 80) for _ in range(days)], "weeks": {}, "months": {}},
+        }
+    stats = {
+        "users": users,
+        "daily_totals": {"start": (now - timedelta(days=89)).strftime("%Y-%m-%d"),
+                         "counts": [random.randint(1000, 9000) for _ in range(90)], "weeks": {}, "months": {}},
+    }
+
+    memories = {
+        f"记忆{i}": {"value": f"关于用户的第{i}条信息，{filler[:20]}",
+                   "created_at": now.isoformat(), "updated_at": now.isoformat()}
+        for i in range(args.memories)
+    }
+
+    group_messages = [
+        {"user_id": 10_000_000 + random.randrange(200), "username": f"user{random.randrange(200)}",
+         "message": random.choice(SAMPLE_TEXTS),
+         "timestamp": (now - timedelta(seconds=args.group_messages - i)).isoformat()}
+        for i in range(args.group_messages)
+    ]
+
+    return {
+        "history_line": (history[0], "HistoryRecord", False),
+        "history": (history, "HISTORY", False),
+        "user_stats": (stats, "STATS", False),
+        "memory_snapshot": (memories, "MEMORIES", False),
+        "group_day_file": (group_messages, "GROUP_MESSAGES", True),
+    }
+
+
+def timed(func, repeat: int) -> float:
+    """最快一次的耗时（微秒）"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return round(best * 1e6, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="序列化基准")
+    parser.add_argument("--users", type=int, default=1000, help="stats.json 中的用户数")
+    parser.add_argument("--memories", type=int, default=50, help="每个用户的记忆条数")
+    parser.add_argument("--group-messages", type=int, default=2000, help="一个群一天的消息数")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from loguru import logger
+    logger.remove()
+    import serialization
+
+    shapes = make_shapes(args)
+    report = {"params": vars(args), "backends": serialization.available_backends(), "results": {}}
+    for shape, (data, schema_name, pretty) in shapes.items():
+        schema = getattr(serialization, schema_name)
+        # 短小的数据多跑几次，结果才稳定
+        repeat = args.repeat * 100 if shape == "history_line" else args.repeat
+        results = {}
+        for name in serialization.available_backends():
+            backend = serialization.get_backend(name)
+            encoded = backend.dumps(data, pretty)
+            results[name] = {
+                "encode_us": timed(lambda: backend.dumps(data, pretty), repeat),
+                "decode_us": timed(lambda: backend.loads(encoded), repeat),
+                "bytes": len(encoded),
+            }
+        if serialization.msgspec is not None:
+            decoder = serialization.msgspec.json.Decoder(schema)
+            encoded = serialization.get_backend("msgspec").dumps(data, pretty)
+            results["msgspec"]["typed_decode_us"] = timed(lambda: decoder.decode(encoded), repeat)
+
+        baseline = results["json"]
+        for name, result in results.items():
+            if name != "json":
+                result["encode_speedup"] = round(baseline["encode_us"] / max(result["encode_us"], 0.1), 1)
+                result["decode_speedup"] = round(baseline["decode_us"] / max(result["decode_us"], 0.1), 1)
+        report["results"][shape] = results
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
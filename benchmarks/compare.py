@@ -0,0 +1,66 @@
+"""
+对比两次基准测试结果
+
+示例：
+    python -m benchmarks.compare before.json after.json
+    python -m benchmarks.compare before.json after.json --fail-threshold 10   # 退化超过 10% 时返回非零
+"""
+import argparse
+import json
+import sys
+
+# (字段, 数值越大越好)
+LATENCY_FIELDS = [("p50_ms", False), ("p95_ms", False), ("p99_ms", False)]
+TOP_FIELDS = [("throughput_per_sec", True), ("peak_rss_mb", False)]
+
+
+def load(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return {r["scenario"]: r for r in json.load(f)["results"]}
+
+
+def change(old: float, new: float) -> float:
+    """变化百分比"""
+    if not old:
+        return 0.0
+    return (new - old) / old * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对比两次基准测试结果")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--fail-threshold", type=float, default=0,
+                        help="任一指标退化超过该百分比时返回 1（0 表示不检查）")
+    args = parser.parse_args()
+
+    before, after = load(args.before), load(args.after)
+    regressions = []
+
+    for scenario in before:
+        if scenario not in after:
+            continue
+        old, new = before[scenario], after[scenario]
+        print(f"\n📊 {scenario}")
+
+        rows = [(field, old.get(field, 0), new.get(field, 0), higher) for field, higher in TOP_FIELDS]
+        for kind in old["latency"]:
+            if kind in new["latency"]:
+                for field, higher in LATENCY_FIELDS:
+                    rows.append((f"{kind}.{field}", old["latency"][kind][field], new["latency"][kind][field], higher))
+
+        for name, old_value, new_value, higher_is_better in rows:
+            pct = change(old_value, new_value)
+            worse = pct < 0 if higher_is_better else pct > 0
+            mark = "⚠️" if worse and abs(pct) >= (args.fail_threshold or 5) else "  "
+            print(f"  {mark} {name:<28} {old_value:>12} -> {new_value:<12} ({pct:+.1f}%)")
+            if args.fail_threshold and worse and abs(pct) > args.fail_threshold:
+                regressions.append(f"{scenario}.{name}")
+
+    if regressions:
+        print(f"\n❌ 性能退化: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
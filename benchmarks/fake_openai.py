@@ -0,0 +1,244 @@
+"""
+本地假 OpenAI 服务
+兼容 /v1/chat/completions 和 /v1/audio/transcriptions，延迟按配置的分布随机生成；
+另外支持批量接口（/v1/files、/v1/batches），批次在后台按 batch_latency 秒完成
+
+单独运行：
+    python -m benchmarks.fake_openai --port 8765 --latency lognormal:-1.5,0.5
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def parse_latency(spec: str):
+    """解析延迟分布，返回一个采样函数（秒）
+
+    支持：
+    - fixed:0.2
+    - uniform:0.1,0.5
+    - normal:0.3,0.1
+    - lognormal:-1.5,0.5（mu,sigma，中位数 e^mu 秒）
+    """
+    kind, _, args = spec.partition(":")
+    params = [float(x) for x in args.split(",") if x]
+
+    if kind == "fixed":
+        return lambda: params[0]
+    if kind == "uniform":
+        return lambda: random.uniform(params[0], params[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(params[0], params[1]))
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(params[0], params[1])
+    raise ValueError(f"未知的延迟分布: {spec}")
+
+
+class FakeOpenAIServer:
+    """假 OpenAI 服务（后台线程运行）"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: str = "fixed:0.05",
+                 reply: str = "好的|||收到|||还有别的吗", batch_latency: float = 0.5):
+        self.sample_latency = parse_latency(latency)
+        self.reply = reply
+        self.batch_latency = batch_latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        # 批量接口：上传的文件 {file_id: bytes}，批次 {batch_id: dict}
+        self.files = {}
+        self.batches = {}
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                with server._lock:
+                    server.requests += 1
+
+                time.sleep(server.sample_latency())
+
+                if self.path.endswith("/chat/completions"):
+                    payload = server.chat_response(body)
+                elif self.path.endswith("/audio/transcriptions"):
+                    payload = {"text": "这是一段测试语音"}
+                elif self.path.endswith("/files"):
+                    payload = server.upload_file(self.headers.get("Content-Type", ""), body)
+                elif self.path.endswith("/batches"):
+                    payload = server.create_batch(json.loads(body))
+                else:
+                    self.send_error(404)
+                    return
+                self._send_json(payload)
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                parts = self.path.rstrip("/").split("/")
+                if len(parts) >= 2 and parts[-2] == "batches" and parts[-1] in server.batches:
+                    self._send_json(server.batches[parts[-1]])
+                elif parts[-1] == "content" and parts[-2] in server.files:
+                    data = server.files[parts[-2]]
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/octet-stream")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                else:
+                    self.send_error(404)
+
+            def _send_json(self, payload):
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def chat_response(self, body: bytes) -> dict:
+        """构造 chat.completions 响应"""
+        try:
+            request = json.loads(body)
+        except json.JSONDecodeError:
+            request = {}
+
+        prompt_chars = sum(
+            len(m["content"]) if isinstance(m.get("content"), str) else 100
+            for m in request.get("messages", [])
+        )
+        content = self.reply
+        if request.get("response_format", {}).get("type") == "json_object":
+            content = '{"memories": []}'
+
+        prompt_tokens = prompt_chars // 2
+        completion_tokens = len(content)
+        return {
+            "id": f"chatcmpl-fake-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "fake"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }
+
+    def upload_file(self, content_type: str, body: bytes) -> dict:
+        """处理 multipart 上传，返回文件对象"""
+        message = BytesParser().parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body
+        )
+        data, filename, purpose = b"", "upload", "batch"
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            if name == "file":
+                data = part.get_payload(decode=True)
+                filename = part.get_filename() or filename
+            elif name == "purpose":
+                purpose = part.get_payload(decode=True).decode("utf-8")
+        return self._store_file(data, filename, purpose)
+
+    def _store_file(self, data: bytes, filename: str, purpose: str) -> dict:
+        file_id = f"file-{uuid.uuid4().hex[:16]}"
+        with self._lock:
+            self.files[file_id] = data
+        return {"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed"}
+
+    def create_batch(self, request: dict) -> dict:
+        """创建批次，后台线程在 batch_latency 秒后生成结果文件"""
+        batch_id = f"batch_{uuid.uuid4().hex[:16]}"
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": request["endpoint"],
+            "input_file_id": request["input_file_id"],
+            "completion_window": request.get("completion_window", "24h"),
+            "status": "in_progress",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        with self._lock:
+            self.batches[batch_id] = batch
+        threading.Thread(target=self._run_batch, args=(batch,), daemon=True).start()
+        return batch
+
+    def _run_batch(self, batch: dict):
+        time.sleep(self.batch_latency)
+        lines = self.files.get(batch["input_file_id"], b"").decode("utf-8").splitlines()
+        output = []
+        for line in lines:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = self.chat_response(json.dumps(item["body"]).encode("utf-8"))
+            output.append(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex[:12]}",
+                "custom_id": item["custom_id"],
+                "response": {"status_code": 200, "request_id": response["id"], "body": response},
+                "error": None,
+            }, ensure_ascii=False))
+        out_file = self._store_file(("\n".join(output) + "\n").encode("utf-8"), "output.jsonl", "batch_output")
+        with self._lock:
+            batch.update({
+                "status": "completed",
+                "completed_at": int(time.time()),
+                "output_file_id": out_file["id"],
+                "request_counts": {"total": len(output), "completed": len(output), "failed": 0},
+            })
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="fake-openai", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地假 OpenAI 服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", default="fixed:0.05", help="延迟分布，如 lognormal:-1.5,0.5")
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(args.host, args.port, args.latency)
+    print(f"假 OpenAI 服务已启动: {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+假 Telegram 更新生成器
+构造处理器用到的最小 Update / Context 对象，不需要连接 Telegram
+"""
+import asyncio
+import random
+import time
+
+BOT_ID = 10000
+BOT_USERNAME = "bench_bot"
+
+SAMPLE_TEXTS = [
+    "在吗", "今天天气怎么样", "我叫小明，是个程序员", "推荐一本书吧", "哈哈哈哈哈",
+    "晚上吃什么好", "Python 的装饰器怎么用", "我喜欢打篮球", "周末有什么安排", "最近好累啊",
+    "明天几点开会", "这个方案大家觉得怎么样", "收到", "+1", "我觉得可以先做前端再做后端",
+]
+
+
+class FakeBot:
+    def __init__(self):
+        self.id = BOT_ID
+        self.username = BOT_USERNAME
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.first_name = f"用户{user_id}"
+        self.username = f"user{user_id}"
+
+
+class FakeChat:
+    def __init__(self, chat_id: int, chat_type: str = "private", title: str = None):
+        self.id = chat_id
+        self.type = chat_type
+        self.title = title
+
+    async def send_action(self, action):
+        await asyncio.sleep(0)
+
+
+class FakeMessage:
+    """记录机器人发出的回复"""
+
+    def __init__(self, chat: FakeChat, user: FakeUser, text: str = None):
+        self.chat = chat
+        self.from_user = user
+        self.text = text
+        self.caption = None
+        self.reply_to_message = None
+        self.photo = []
+        self.voice = None
+        self.audio = None
+        self.replies = []
+        self.first_reply_at = None
+
+    async def reply_text(self, text, **kwargs):
+        if self.first_reply_at is None:
+            self.first_reply_at = time.perf_counter()
+        self.replies.append(text)
+        await asyncio.sleep(0)
+        return self
+
+
+class FakeUpdate:
+    def __init__(self, message: FakeMessage):
+        self.message = message
+        self.effective_message = message
+        self.effective_user = message.from_user
+        self.callback_query = None
+
+
+class FakeContext:
+    def __init__(self, args=None):
+        self.args = args or []
+        self.bot = FakeBot()
+        self.error = None
+
+
+def text_update(user_id: int, text: str = None, chat_id: int = None, chat_type: str = "private",
+                mention: bool = False):
+    """生成一条文字消息更新"""
+    user = FakeUser(user_id)
+    if chat_type == "private":
+        chat = FakeChat(chat_id or user_id, "private")
+    else:
+        chat = FakeChat(chat_id, chat_type, title=f"群{chat_id}")
+
+    text = text or random.choice(SAMPLE_TEXTS)
+    if mention:
+        text = f"@{BOT_USERNAME} {text}"
+    return FakeUpdate(FakeMessage(chat, user, text)), FakeContext()
+
+
+def command_update(user_id: int, chat_id: int, args: list, chat_type: str = "supergroup"):
+    """生成一条命令更新（/summary、/search 等）"""
+    user = FakeUser(user_id)
+    chat = FakeChat(chat_id, chat_type, title=f"群{chat_id}")
+    return FakeUpdate(FakeMessage(chat, user, "/cmd")), FakeContext(args)
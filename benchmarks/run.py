@@ -0,0 +1,262 @@
+"""
+基准测试入口
+用本地假 OpenAI 服务和假 Telegram 更新驱动 TelegramBot，输出吞吐量、延迟分位数和内存峰值
+
+示例：
+    python -m benchmarks.run                                   # 运行全部场景
+    python -m benchmarks.run -s many_users -s summary_heavy --output bench.json
+    python -m benchmarks.run --latency lognormal:-1.5,0.5 --concurrency 32
+    python -m benchmarks.run --telegram-limits                 # 按真实的 Telegram 限流和人设节奏发送
+
+注意：peak_rss_mb 是整个进程的峰值，需要准确对比内存时请每次只运行一个场景。
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.fake_telegram import text_update, command_update
+
+
+def percentile(values: list, q: float) -> float:
+    """分位数（最近秩法）"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(values: list) -> dict:
+    """延迟列表 -> 统计结果（毫秒）"""
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+        "max_ms": round(max(values) * 1000, 3) if values else 0.0,
+    }
+
+
+def peak_rss_mb() -> float:
+    """进程内存峰值（MB）"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位是 KB，macOS 是字节
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+# ========== 场景 ==========
+# 每个场景返回 [(类别, 处理器, update, context)]，由 runner 并发执行
+
+def scenario_many_users(bot, args):
+    """大量私聊用户，每人发几条消息"""
+    jobs = []
+    for round_ in range(args.messages):
+        for user_id in range(1, args.users + 1):
+            update, context = text_update(user_id)
+            jobs.append(("message", bot.handle_message, update, context))
+    return jobs
+
+
+def scenario_hot_groups(bot, args):
+    """少数热门群，大量群消息，其中一部分 @ 机器人"""
+    jobs = []
+    groups = [-(1000 + i) for i in range(args.groups)]
+    for _ in range(args.messages * args.users):
+        chat_id = random.choice(groups)
+        user_id = random.randint(1, args.users)
+        mention = random.random() < 0.1
+        update, context = text_update(user_id, chat_id=chat_id, chat_type="supergroup", mention=mention)
+        jobs.append(("group_message", bot.handle_message, update, context))
+    return jobs
+
+
+def scenario_large_histories(bot, args):
+    """每个用户都有满额历史记录和大量记忆"""
+    from models import Turn
+
+    filler = "这是一段比较长的历史消息，用来模拟真实对话里的上下文内容。" * 4
+    for user_id in range(1, args.users + 1):
+        uid = str(user_id)
+        bot.ai.conversations[uid] = [
+            Turn("user" if i % 2 == 0 else "assistant", f"{i} {filler}")
+            for i in range(bot.ai.max_history * 2)
+        ]
+        bot.ai._save_history(uid)
+        for i in range(args.memories):
+            bot.ai.memory.add_memory(uid, f"记忆{i}", f"关于用户的第{i}条信息，{filler[:20]}")
+    bot.ai.memory.flush()
+    # 模拟重启：清空内存缓存，强制从磁盘加载
+    bot.ai.conversations.clear()
+
+    return scenario_many_users(bot, args)
+
+
+def scenario_summary_heavy(bot, args):
+    """群里有大量历史消息，频繁 /summary 和 /search"""
+    groups = [-(2000 + i) for i in range(args.groups)]
+    for chat_id in groups:
+        for i in range(args.group_history):
+            user_id = random.randint(1, args.users)
+            update, _ = text_update(user_id, chat_id=chat_id, chat_type="supergroup")
+            bot.group_monitor.record_message(chat_id, user_id, update.effective_user.username, update.message.text)
+    bot.group_monitor.save_all()
+
+    jobs = []
+    for _ in range(args.messages * 5):
+        chat_id = random.choice(groups)
+        mode = random.choice([[], ["quick"], ["6h"]])
+        update, context = command_update(1, chat_id, mode)
+        jobs.append(("summary", bot.summary_command, update, context))
+        update, context = command_update(1, chat_id, ["Python", "教程"])
+        jobs.append(("search", bot.search_command, update, context))
+    return jobs
+
+
+SCENARIOS = {
+    "many_users": scenario_many_users,
+    "hot_groups": scenario_hot_groups,
+    "large_histories": scenario_large_histories,
+    "summary_heavy": scenario_summary_heavy,
+}
+
+
+def fake_search(query, max_results=3):
+    """替代联网搜索（基准测试不访问外网）"""
+    time.sleep(0.01)
+    return [{"title": query, "snippet": f"{query} 的搜索结果", "url": "https://example.com"}] * max_results
+
+
+def build_bot(args):
+    """在当前目录创建机器人（配置已通过环境变量指向假服务）"""
+    import telegram_bot
+    from sender import SendScheduler
+
+    bot = telegram_bot.TelegramBot()
+    bot.ai.search.search_web = fake_search
+
+    if not args.telegram_limits:
+        # 只测机器人自身的吞吐，不受 Telegram 限流和人设节奏影响
+        bot.sender = SendScheduler(global_rate=1e9, chat_rate=1e9, group_rate_per_min=1e9, burst=1e9)
+        telegram_bot.get_pacing = lambda persona_key: {}
+    return bot
+
+
+async def run_jobs(jobs: list, concurrency: int) -> tuple:
+    """并发执行，返回 ({类别: [耗时]}, [首条回复耗时], 总耗时)"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = defaultdict(list)
+    first_reply = []
+
+    async def run_one(kind, handler, update, context):
+        async with semaphore:
+            start = time.perf_counter()
+            await handler(update, context)
+            latencies[kind].append(time.perf_counter() - start)
+            if update.message.first_reply_at is not None:
+                first_reply.append(update.message.first_reply_at - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_one(*job) for job in jobs))
+    return latencies, first_reply, time.perf_counter() - start
+
+
+def run_scenario(name: str, args, server: FakeOpenAIServer) -> dict:
+    """运行单个场景"""
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        setup_start = time.perf_counter()
+        bot = build_bot(args)
+        jobs = SCENARIOS[name](bot, args)
+        setup_seconds = time.perf_counter() - setup_start
+
+        requests_before = server.requests
+        latencies, first_reply, wall = asyncio.run(run_jobs(jobs, args.concurrency))
+        bot.stop()
+    finally:
+        os.chdir(cwd)
+
+    total = sum(len(v) for v in latencies.values())
+    return {
+        "scenario": name,
+        "updates": total,
+        "wall_seconds": round(wall, 3),
+        "throughput_per_sec": round(total / wall, 2) if wall else 0.0,
+        "setup_seconds": round(setup_seconds, 3),
+        "latency": {kind: summarize(values) for kind, values in latencies.items()},
+        "time_to_first_reply": summarize(first_reply),
+        "model_requests": server.requests - requests_before,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Telegram AI 机器人基准测试")
+    parser.add_argument("-s", "--scenario", action="append", choices=list(SCENARIOS),
+                        help="要运行的场景（可多次指定，默认全部）")
+    parser.add_argument("--users", type=int, default=50, help="用户数")
+    parser.add_argument("--messages", type=int, default=4, help="每个用户的消息数")
+    parser.add_argument("--groups", type=int, default=5, help="群数")
+    parser.add_argument("--group-history", type=int, default=2000, help="summary_heavy 场景每个群的历史消息数")
+    parser.add_argument("--memories", type=int, default=30, help="large_histories 场景每个用户的记忆数")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时处理的更新数")
+    parser.add_argument("--latency", default="fixed:0.05", help="假模型延迟分布，如 lognormal:-1.5,0.5")
+    parser.add_argument("--telegram-limits", action="store_true", help="启用真实的 Telegram 限流和人设发送节奏")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="结果 JSON 文件路径（默认只输出到终端）")
+    parser.add_argument("--verbose", action="store_true", help="显示机器人日志")
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(latency=args.latency).start()
+
+    # 必须在导入机器人模块之前设置
+    os.environ.update({
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": server.base_url,
+        "HISTORY_DIR": "chat_history",
+        "METRICS_PORT": "0",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    from loguru import logger
+    if not args.verbose:
+        logger.remove()
+        logger.add(sys.stderr, level="WARNING")
+
+    results = []
+    for name in args.scenario or list(SCENARIOS):
+        print(f"▶ 运行场景 {name} ...", file=sys.stderr)
+        results.append(run_scenario(name, args, server))
+
+    server.stop()
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "verbose")},
+        "results": results,
+    }
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"✓ 结果已保存到 {args.output}", file=sys.stderr)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
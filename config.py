@@ -16,8 +16,68 @@ MODEL_NAME = os.getenv("MODEL_NAME", "gpt-4o-mini")
 # 视觉模型（图片识别）
 VISION_MODEL_NAME = os.getenv("VISION_MODEL_NAME", os.getenv("MODEL_NAME", "gpt-4o-mini"))
 
+# 图片识别：按最长边选择 Telegram 提供的图片尺寸
+VISION_TARGET_SIZE = int(os.getenv("VISION_TARGET_SIZE", "1024"))
+
+# 图片识别：本地缩放后的最长边（需要安装 Pillow，0 表示不缩放）
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "1024"))
+
+# 图片识别：重新编码的 JPEG 质量
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+
+# 图片识别：单张图片大小上限（字节）
+VISION_MAX_IMAGE_BYTES = int(os.getenv("VISION_MAX_IMAGE_BYTES", str(10 * 1024 * 1024)))
+
+# ========== 语音转写配置 ==========
+TRANSCRIBE_MODEL = os.getenv("TRANSCRIBE_MODEL", "whisper-1")
+TRANSCRIBE_LANGUAGE = os.getenv("TRANSCRIBE_LANGUAGE", "zh")
+
+# 同时进行的语音转写数
+TRANSCRIBE_MAX_WORKERS = int(os.getenv("TRANSCRIBE_MAX_WORKERS", "4"))
+
+# 长语音按多少秒切分并行转写（需要安装 pydub 和 ffmpeg，0 表示不切分）
+TRANSCRIBE_CHUNK_SECONDS = int(os.getenv("TRANSCRIBE_CHUNK_SECONDS", "0"))
+
 # ========== 机器人配置 ==========
 BOT_NAME = os.getenv("BOT_NAME", "AI 助手")
+# 管理员用户 ID（逗号分隔，可以使用 /profile 等管理命令）
+ADMIN_USER_IDS = {int(x) for x in os.getenv("ADMIN_USER_IDS", "").split(",") if x.strip()}
+
+# ========== 发送限流配置（Telegram 限制） ==========
+# 全局每秒最多发送条数
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+
+# 私聊每个聊天每秒最多发送条数
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+
+# 群聊每个群每分钟最多发送条数
+SEND_GROUP_RATE_PER_MIN = float(os.getenv("SEND_GROUP_RATE_PER_MIN", "20"))
+
+# 每个聊天允许的突发条数
+SEND_BURST = int(os.getenv("SEND_BURST", "3"))
+
+# ========== 运行指标配置 ==========
+# 指标服务地址（Prometheus 格式，访问 /metrics；端口为 0 则不启动）
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+# ========== 请求追踪配置 ==========
+# 采样率（0~1，0 为关闭）
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+# 导出方式：jsonl（本地文件）或 otel（OpenTelemetry，需要自行安装并配置 SDK）
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "jsonl")
+# JSONL 追踪文件
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+
+# ========== 性能分析配置 ==========
+# 超过该耗时（毫秒）的请求自动记录各阶段耗时和提示词大小（0 为关闭）
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "5000"))
+# 启动后立即采样分析的秒数（0 为不采样，也可以用管理员命令 /profile 随时开启）
+PROFILE_ON_START = float(os.getenv("PROFILE_ON_START", "0"))
+# 采样间隔（毫秒）
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+# 采样结果目录（折叠栈文件，可用 flamegraph.pl / speedscope 查看）
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
 
 # 代理配置（如果需要）
 PROXY_URL = os.getenv("PROXY_URL", "")
@@ -27,3 +87,82 @@ MAX_API_RETRY = int(os.getenv("MAX_API_RETRY", "3"))
 
 # 历史记录目录
 HISTORY_DIR = os.getenv("HISTORY_DIR", "chat_history")
+
+# ========== 落盘与关闭配置 ==========
+# 统计数据最长多久写一次盘（秒，退出时也会写）
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "10"))
+# 群消息预写日志 fsync 间隔（秒，进程被强杀最多丢失这么久的消息；0 表示每条都 fsync）
+GROUP_WAL_FSYNC_INTERVAL = float(os.getenv("GROUP_WAL_FSYNC_INTERVAL", "1"))
+# 所有群未保存消息缓存的内存上限（字节），超过时把最久没说话的群先落盘
+GROUP_CACHE_MAX_BYTES = int(os.getenv("GROUP_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# JSON 编解码后端：auto（装了 orjson / msgspec 就用）/ orjson / msgspec / json
+SERIALIZATION_BACKEND = os.getenv("SERIALIZATION_BACKEND", "auto").lower()
+
+# ========== 使用统计配置 ==========
+# 按天保留计数的天数，更早的合并成按周计数
+STATS_DAILY_DAYS = int(os.getenv("STATS_DAILY_DAYS", "90"))
+# 按周保留计数的周数，更早的合并成按月计数
+STATS_WEEKLY_WEEKS = int(os.getenv("STATS_WEEKLY_WEEKS", "52"))
+
+# ========== 用量与额度配置 ==========
+# 每个用户每天的 token 额度（聊天、识图、语音都算，0 为不限制，管理员不受限制）
+USER_DAILY_TOKEN_BUDGET = int(os.getenv("USER_DAILY_TOKEN_BUDGET", "0"))
+# 按 用户 / 人设 / 模型 / 功能 的用量明细保留天数（每日汇总一直保留）
+USAGE_DETAIL_DAYS = int(os.getenv("USAGE_DETAIL_DAYS", "30"))
+
+# ========== 群消息保留配置 ==========
+# 群消息默认保留天数（群管理员可以用 /retention 单独设置）
+GROUP_RETENTION_DAYS = int(os.getenv("GROUP_RETENTION_DAYS", "7"))
+# 过期消息压缩成的小时汇总保留天数
+GROUP_AGGREGATE_RETENTION_DAYS = int(os.getenv("GROUP_AGGREGATE_RETENTION_DAYS", "180"))
+# 退出时等待处理中请求的最长时间（秒）
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "10"))
+
+# ========== 群消息总结配置 ==========
+# 空闲时预先总结活跃群的间隔（分钟），0 为关闭；开启后 /summary 通常只需要合并少量新消息
+SUMMARY_PRESUMMARIZE_INTERVAL = float(os.getenv("SUMMARY_PRESUMMARIZE_INTERVAL", "0"))
+# 新消息达到多少条才预先总结
+SUMMARY_PRESUMMARIZE_MIN_MESSAGES = int(os.getenv("SUMMARY_PRESUMMARIZE_MIN_MESSAGES", "20"))
+# 发给 AI 的聊天记录 token 上限（超过时在本地去重、过滤后挑出最有代表性的消息）
+SUMMARY_PROMPT_TOKENS = int(os.getenv("SUMMARY_PROMPT_TOKENS", "2000"))
+
+# ========== 批量任务配置 ==========
+# 不着急的模型调用（夜间群总结、后台记忆提取）的执行方式：off 关闭 / api 使用批量接口 / local 本地逐个执行
+BATCH_MODE = os.getenv("BATCH_MODE", "off").lower()
+# 查询批量任务结果、提交攒下的任务的间隔（秒）
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "300"))
+# 每天几点提交活跃群的夜间总结
+BATCH_SUMMARY_HOUR = int(os.getenv("BATCH_SUMMARY_HOUR", "2"))
+
+# ========== 每日摘要配置 ==========
+# 每天几点开始给订阅的群发送每日摘要（群管理员用 /digest on 订阅）
+DIGEST_HOUR = int(os.getenv("DIGEST_HOUR", "9"))
+# 在多少分钟内发完（各群的发送时间均匀错开）
+DIGEST_WINDOW_MINUTES = float(os.getenv("DIGEST_WINDOW_MINUTES", "30"))
+# 同时生成/发送摘要的群数上限
+DIGEST_CONCURRENCY = int(os.getenv("DIGEST_CONCURRENCY", "8"))
+
+# ========== 记忆配置 ==========
+# 每次对话最多注入的记忆条数
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "5"))
+
+# 注入记忆的 token 上限
+MEMORY_MAX_TOKENS = int(os.getenv("MEMORY_MAX_TOKENS", "300"))
+
+# 本地向量模型（可选，需要安装 sentence-transformers，留空则只用关键词检索）
+MEMORY_EMBEDDING_MODEL = os.getenv("MEMORY_EMBEDDING_MODEL", "")
+
+# 记忆修改日志达到多少条后合并进快照
+MEMORY_COMPACT_THRESHOLD = int(os.getenv("MEMORY_COMPACT_THRESHOLD", "200"))
+
+# 后台自动提取记忆（从聊天中批量提取用户信息）
+MEMORY_EXTRACT_ENABLED = os.getenv("MEMORY_EXTRACT_ENABLED", "true").lower() == "true"
+
+# 记忆提取模型（建议用便宜的小模型，默认同 MODEL_NAME）
+MEMORY_EXTRACT_MODEL = os.getenv("MEMORY_EXTRACT_MODEL", MODEL_NAME)
+
+# 每批最多处理的消息数
+MEMORY_EXTRACT_BATCH_SIZE = int(os.getenv("MEMORY_EXTRACT_BATCH_SIZE", "20"))
+
+# 攒批最长等待时间（秒）
+MEMORY_EXTRACT_FLUSH_INTERVAL = float(os.getenv("MEMORY_EXTRACT_FLUSH_INTERVAL", "30"))
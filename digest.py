@@ -0,0 +1,160 @@
+"""
+每日摘要模块
+订阅了每日摘要的群，每天在固定的时间窗口内生成并发送最近一天的群聊总结：
+生成时限制并发数，发送按时间窗口错开；每个群的结果写进当天的运行日志，重启后从中断处继续
+"""
+import asyncio
+from datetime import datetime, timedelta
+from pathlib import Path
+from loguru import logger
+from storage import WriteAheadLog, atomic_write_json
+import serialization
+
+
+class DigestManager:
+    """每日摘要管理器"""
+
+    def __init__(self, state_dir="digests", max_attempts: int = 3, keep_days: int = 7, retry_delay: float = 60):
+        self.state_dir = Path(state_dir)
+        self.state_dir.mkdir(exist_ok=True)
+        # 同一个群一天内最多尝试几次（失败后在本次运行中隔一会儿重试，重启后继续时也算在内）
+        self.max_attempts = max_attempts
+        # 重试前等待的秒数（第 n 次失败后等 n 倍）
+        self.retry_delay = retry_delay
+        # 运行日志保留天数
+        self.keep_days = keep_days
+
+        # 订阅的群 {chat_id: {"title", "since"}}
+        self.subscriptions_file = self.state_dir / "subscriptions.json"
+        self.subscriptions = self._load_subscriptions()
+        self.running = False
+
+    def _load_subscriptions(self) -> dict:
+        if self.subscriptions_file.exists():
+            try:
+                data = serialization.load_file(self.subscriptions_file)
+                return {int(chat_id): info for chat_id, info in data.items()}
+            except Exception as e:
+                logger.warning(f"加载每日摘要订阅失败: {e}")
+        return {}
+
+    def _save_subscriptions(self, subscriptions: dict):
+        atomic_write_json(self.subscriptions_file, {str(k): v for k, v in subscriptions.items()})
+        self.subscriptions = subscriptions
+
+    def is_subscribed(self, chat_id: int) -> bool:
+        return chat_id in self.subscriptions
+
+    def subscribe(self, chat_id: int, title: str):
+        """订阅每日摘要"""
+        subscriptions = dict(self.subscriptions)
+        subscriptions[chat_id] = {"title": title, "since": datetime.now().isoformat()}
+        self._save_subscriptions(subscriptions)
+        logger.info(f"群 {chat_id}（{title}）订阅了每日摘要")
+
+    def unsubscribe(self, chat_id: int) -> bool:
+        """取消订阅，返回之前是否订阅过"""
+        if chat_id not in self.subscriptions:
+            return False
+        subscriptions = dict(self.subscriptions)
+        del subscriptions[chat_id]
+        self._save_subscriptions(subscriptions)
+        logger.info(f"群 {chat_id} 取消了每日摘要")
+        return True
+
+    def _log_path(self, day: str) -> Path:
+        return self.state_dir / f"run_{day}.log"
+
+    def has_run(self, day: str) -> bool:
+        """这一天的摘要是否已经开始发送过"""
+        return self._log_path(day).exists()
+
+    @staticmethod
+    def _progress(log: WriteAheadLog) -> tuple:
+        """从运行日志读出 (已完成的群, {群: 失败次数})"""
+        done = set()
+        attempts = {}
+        for record in log.replay():
+            if record["ok"]:
+                done.add(record["c"])
+            else:
+                attempts[record["c"]] = attempts.get(record["c"], 0) + 1
+        return done, attempts
+
+    def _cleanup_logs(self):
+        """删除过期的运行日志"""
+        cutoff = (datetime.now() - timedelta(days=self.keep_days)).strftime("%Y-%m-%d")
+        for path in self.state_dir.glob("run_*.log"):
+            if path.stem[4:] < cutoff:
+                path.unlink(missing_ok=True)
+
+    async def run(self, day: str, build, send, concurrency: int = 8, window: float = 1800) -> dict:
+        """给所有订阅的群生成并发送摘要
+
+        build(chat_id, title) -> 摘要文字（没有消息时返回空），send(chat_id, text)，都是协程函数；
+        第 i 个群在 window 秒内的第 i 个时间点开始，同时最多 concurrency 个群在生成/发送
+        """
+        if self.running:
+            logger.warning("每日摘要正在发送中，跳过本次")
+            return None
+        self.running = True
+        self._cleanup_logs()
+
+        log = WriteAheadLog(self._log_path(day))
+        done, attempts = self._progress(log)
+        subscriptions = self.subscriptions
+        todo = [chat_id for chat_id in subscriptions
+                if chat_id not in done and attempts.get(chat_id, 0) < self.max_attempts]
+        result = {"total": len(todo), "sent": 0, "skipped": 0, "failed": 0}
+        if not todo:
+            log.close()
+            self.running = False
+            return result
+
+        if done or attempts:
+            logger.info(f"🗞 继续发送 {day} 的每日摘要：已完成 {len(done)} 个群，剩余 {len(todo)} 个")
+        else:
+            logger.info(f"🗞 开始发送 {day} 的每日摘要：{len(todo)} 个群，{window / 60:.0f} 分钟内发完")
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        spacing = window / len(todo)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def process(i: int, chat_id: int):
+            # 错峰：按顺序均匀分布在时间窗口内
+            delay = start + i * spacing - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            while True:
+                async with semaphore:
+                    try:
+                        text = await build(chat_id, subscriptions[chat_id]["title"])
+                        if text:
+                            await send(chat_id, text)
+                            result["sent"] += 1
+                        else:
+                            result["skipped"] += 1
+                        log.append({"c": chat_id, "ok": True})
+                        return
+                    except Exception as e:
+                        attempts[chat_id] = attempts.get(chat_id, 0) + 1
+                        log.append({"c": chat_id, "ok": False, "e": f"{type(e).__name__}: {e}"[:200]})
+                        # 用完次数或者已经取消订阅（比如机器人被移出群）就不再重试
+                        if attempts[chat_id] >= self.max_attempts or chat_id not in self.subscriptions:
+                            result["failed"] += 1
+                            logger.warning(f"群 {chat_id} 的每日摘要发送失败: {e}")
+                            return
+                        logger.warning(f"群 {chat_id} 的每日摘要发送失败（第 {attempts[chat_id]} 次），稍后重试: {e}")
+                # 等待时不占用并发名额
+                await asyncio.sleep(self.retry_delay * attempts[chat_id])
+
+        try:
+            await asyncio.gather(*(process(i, chat_id) for i, chat_id in enumerate(todo)))
+        finally:
+            log.close()
+            self.running = False
+
+        logger.info(f"🗞 每日摘要发送完成：发送 {result['sent']} 个群，无消息跳过 {result['skipped']} 个，"
+                    f"失败 {result['failed']} 个，用时 {loop.time() - start:.0f}s")
+        return result
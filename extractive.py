@@ -0,0 +1,136 @@
+"""
+抽取式预筛选模块
+在调用 AI 总结之前，先在本地去掉重复和没有信息量的消息，再按 TF-IDF 中心度给消息打分，
+在 token 预算内挑出最有代表性的消息，让提示词更短、总结更准
+"""
+import math
+import re
+from collections import Counter
+from text_utils import tokenize, estimate_tokens
+
+# 常见的无信息量短回复
+_FILLER = {
+    "好", "好的", "好滴", "嗯", "嗯嗯", "哦", "哦哦", "噢", "对", "对的", "是", "是的", "行", "可以",
+    "收到", "谢谢", "感谢", "多谢", "哈", "哈哈", "呵呵", "嘿嘿", "笑死", "草", "绝了", "牛", "牛逼",
+    "ok", "okay", "yes", "no", "lol", "thx", "thanks", "+1", "1", "666", "?", "？",
+}
+
+# 表情包、贴纸等转成的占位文本，如 "[贴纸]"、"[Sticker]"
+_PLACEHOLDER = re.compile(r"^\s*[\[【(（][^\]】)）]{1,12}[\]】)）]\s*$")
+
+# 比较重复时忽略空白和标点
+_NOISE = re.compile(r"[\s\W_]+")
+# 完全重复的判断还忽略数字（"第1次"、"第2次"）
+_DIGITS = re.compile(r"\d+")
+
+# 近似重复：和最近保留的消息 token 重合度达到该比例即视为重复
+_DUPLICATE_JACCARD = 0.8
+# 只和最近保留的这么多条比较（刷屏的重复消息一般挨在一起）
+_DUPLICATE_WINDOW = 10
+
+
+def is_low_information(text: str) -> bool:
+    """是否是没有信息量的消息（"哈哈哈"、"666"、纯表情、贴纸占位等）"""
+    if not text:
+        return True
+    if _PLACEHOLDER.match(text):
+        return True
+    normalized = _NOISE.sub("", text.lower())
+    if not normalized or normalized in _FILLER:
+        return True
+    # 单个字符，或只由一两种字符重复组成，如 "哈哈哈哈"、"2333"
+    return len(normalized) == 1 or (len(normalized) >= 3 and len(set(normalized)) <= 2)
+
+
+def _dedupe(indexed: list) -> list:
+    """去掉重复和近似重复的消息，返回 [(序号, token 列表, 重复次数)]，保留第一次出现的"""
+    kept = []
+    seen_exact = {}
+    for i, text in indexed:
+        key = _DIGITS.sub("", _NOISE.sub("", text.lower()))
+        if key in seen_exact:
+            kept[seen_exact[key]][2] += 1
+            continue
+
+        tokens = tokenize(text)
+        token_set = set(tokens)
+        duplicate_of = None
+        if token_set:
+            for j in range(len(kept) - 1, max(-1, len(kept) - 1 - _DUPLICATE_WINDOW), -1):
+                other = kept[j][3]
+                overlap = len(token_set & other)
+                if overlap and overlap / len(token_set | other) >= _DUPLICATE_JACCARD:
+                    duplicate_of = j
+                    break
+        if duplicate_of is not None:
+            kept[duplicate_of][2] += 1
+            continue
+
+        seen_exact[key] = len(kept)
+        kept.append([i, tokens, 1, token_set])
+    return [(i, tokens, count) for i, tokens, count, _ in kept]
+
+
+def _centrality_scores(docs: list) -> list:
+    """TF-IDF 中心度：每条消息和全部消息 TF-IDF 质心的余弦相似度
+
+    docs: [(token 列表, 重复次数)]，被重复多次的消息在质心中的权重更高
+    """
+    n_docs = sum(count for _, count in docs)
+    df = Counter()
+    for tokens, count in docs:
+        for token in set(tokens):
+            df[token] += count
+    idf = {token: math.log(1 + n_docs / freq) for token, freq in df.items()}
+
+    vectors = []
+    centroid = Counter()
+    for tokens, count in docs:
+        tf = Counter(tokens)
+        vector = {token: (1 + math.log(freq)) * idf[token] for token, freq in tf.items()}
+        norm = math.sqrt(sum(w * w for w in vector.values())) or 1.0
+        vector = {token: w / norm for token, w in vector.items()}
+        vectors.append(vector)
+        for token, w in vector.items():
+            centroid[token] += w * count
+
+    centroid_norm = math.sqrt(sum(w * w for w in centroid.values())) or 1.0
+    return [
+        sum(w * centroid[token] for token, w in vector.items()) / centroid_norm
+        for vector in vectors
+    ]
+
+
+def select_messages(messages: list, token_budget: int, format_line) -> list:
+    """在 token 预算内挑出最有代表性的消息，按原来的顺序返回
+
+    messages: 群消息 GroupMessage 列表（按时间排序）
+    format_line: 把一条消息格式化成提示词中的一行，用于估算 token
+    """
+    candidates = [(i, msg.message) for i, msg in enumerate(messages)
+                  if not is_low_information(msg.message)]
+    if not candidates:
+        # 全是水，退回原始消息
+        candidates = [(i, msg.message or "") for i, msg in enumerate(messages)]
+
+    unique = _dedupe(candidates)
+    costs = [estimate_tokens(format_line(messages[i])) + 1 for i, _, _ in unique]
+    if sum(costs) <= token_budget:
+        return [messages[i] for i, _, _ in unique]
+
+    scores = _centrality_scores([(tokens, count) for _, tokens, count in unique])
+    # 很短的消息信息量有限，稍微降权；同分时新的优先
+    order = sorted(
+        range(len(unique)),
+        key=lambda k: (-scores[k] * min(1.0, 0.5 + len(unique[k][1]) / 10), -k)
+    )
+
+    chosen = []
+    used = 0
+    for k in order:
+        if used + costs[k] > token_budget:
+            continue
+        used += costs[k]
+        chosen.append(unique[k][0])
+    chosen.sort()
+    return [messages[i] for i in chosen]
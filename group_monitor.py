@@ -2,88 +2,276 @@
 群消息监听模块
 监听并存储群聊消息，用于后续总结
 """
-import json
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from datetime import datetime, timedelta
-from collections import defaultdict
+from datetime import datetime, timedelta, date
+from collections import defaultdict, deque, OrderedDict
 from loguru import logger
+from config import GROUP_WAL_FSYNC_INTERVAL, GROUP_CACHE_MAX_BYTES
+from config import GROUP_RETENTION_DAYS, GROUP_AGGREGATE_RETENTION_DAYS
+from storage import WriteAheadLog, atomic_write, atomic_write_json
+import serialization
+from search_index import GroupSearchIndex
+from models import GroupMessage
+from metrics import DISK_SAVE_LATENCY, GROUP_SCAN_LATENCY, CACHE_SIZE
+from tracing import traced
+
+
+# 按天保存的消息文件名：{chat_id}_{YYYY-MM-DD}.json
+_DAY_FILE_PATTERN = re.compile(r"^(-?\d+)_(\d{4}-\d{2}-\d{2})\.json$")
+
+# 每条缓存消息除正文外的大致开销（对象 + 缓冲区中的指针）
+_RECORD_OVERHEAD = sys.getsizeof(GroupMessage(0, 0, "", "")) + 8
+
+
+def _message_bytes(msg: GroupMessage) -> int:
+    return _RECORD_OVERHEAD + sys.getsizeof(msg.message)
+
+
+class ChatBuffer:
+    """单个群的环形缓冲区（满了自动丢掉最旧的，不复制列表）"""
+    
+    __slots__ = ("messages", "bytes")
+    
+    def __init__(self, max_size: int):
+        self.messages = deque(maxlen=max_size)
+        self.bytes = 0
+    
+    def append(self, msg: GroupMessage) -> int:
+        """追加消息，返回占用字节的变化量"""
+        delta = _message_bytes(msg)
+        if len(self.messages) == self.messages.maxlen:
+            delta -= _message_bytes(self.messages[0])
+        self.messages.append(msg)
+        self.bytes += delta
+        return delta
+    
+    def __len__(self):
+        return len(self.messages)
 
 
 class GroupMonitor:
     """群消息监听器"""
     
-    def __init__(self, storage_dir="group_messages"):
+    def __init__(self, storage_dir="group_messages", wal_fsync_interval=GROUP_WAL_FSYNC_INTERVAL,
+                 max_cache_bytes=GROUP_CACHE_MAX_BYTES):
         self.storage_dir = Path(storage_dir)
         self.storage_dir.mkdir(exist_ok=True)
         
-        # 内存缓存 {chat_id: [messages]}
-        self.message_cache = defaultdict(list)
+        # 未保存消息的缓存 {chat_id: ChatBuffer}，按最近活跃排序（最久没说话的群在最前面）
+        self.message_cache = OrderedDict()
+        # 所有群缓存的总字节数（估算）
+        self.cache_bytes = 0
+        # 驻留的用户 ID 和用户名（同一个人的消息共享同一个对象）
+        self._user_ids = {}
+        # 每个群最后一条消息的时间（用于找出最近活跃的群）
+        self.last_activity = {}
+        # 缓存在事件循环中修改，工作线程读消息时要加锁取快照
+        self._cache_lock = threading.Lock()
+        # 每个群的落盘序号（开始和结束各加一，奇数表示正在写文件）：
+        # 读消息时用来确认读文件期间缓存没有被移进文件
+        self._save_generation = defaultdict(int)
         
         # 配置
         self.max_cache_size = 1000  # 每个群最多缓存消息数
-        self.retention_days = 7  # 保留天数
+        self.max_cache_bytes = max_cache_bytes  # 所有群缓存的总内存上限，超过时把最冷的群落盘
+        self.save_every = 50  # 每个群攒多少条保存一次
+        self.retention_days = GROUP_RETENTION_DAYS  # 默认保留天数（可以按群单独设置）
+        self.aggregate_retention_days = GROUP_AGGREGATE_RETENTION_DAYS  # 小时汇总保留天数
+        self.max_wal_bytes = 8 * 1024 * 1024  # 预写日志超过该大小时全部落盘并清空
+        
+        # 目录索引 {chat_id: {日期}}：清理时直接查索引，不用扫描整个目录
+        self.index_file = self.storage_dir / "index.json"
+        self._index_lock = threading.Lock()
+        self.index = self._load_index()
+        
+        # 按群设置的保留天数 {chat_id: days}
+        self.retention_file = self.storage_dir / "retention.json"
+        self.retention = self._load_retention()
+        
+        # 全文索引（用于 /find），和按天文件一起落盘、一起过期
+        self.search_index = GroupSearchIndex(self.storage_dir / "search_index")
+        
+        # 预写日志：缓存中还没保存的消息先写这里，崩溃后重启时恢复
+        self.wal = WriteAheadLog(self.storage_dir / "pending.wal", fsync_interval=wal_fsync_interval)
+        self._replay_wal()
+        
+        CACHE_SIZE.set_function(
+            lambda: sum(len(buffer) for buffer in list(self.message_cache.values())),
+            cache="group_messages"
+        )
+        CACHE_SIZE.set_function(lambda: self.cache_bytes, cache="group_messages_bytes")
+    
+    def _make_message(self, timestamp: int, user_id: int, username: str, message: str) -> GroupMessage:
+        user_id = self._user_ids.setdefault(user_id, user_id)
+        return GroupMessage(timestamp, user_id, sys.intern(username), message)
+    
+    def _add_to_cache(self, chat_id: int, msg: GroupMessage) -> ChatBuffer:
+        with self._cache_lock:
+            buffer = self.message_cache.get(chat_id)
+            if buffer is None:
+                buffer = self.message_cache[chat_id] = ChatBuffer(self.max_cache_size)
+            else:
+                self.message_cache.move_to_end(chat_id)
+            self.cache_bytes += buffer.append(msg)
+        return buffer
+    
+    def _snapshot_cache(self, chat_id: int) -> tuple:
+        """取一个群缓存消息的快照，返回 (落盘次数, 消息)，在工作线程中调用"""
+        with self._cache_lock:
+            buffer = self.message_cache.get(chat_id)
+            return self._save_generation[chat_id], tuple(buffer.messages) if buffer else ()
+    
+    def _replay_wal(self):
+        """从预写日志恢复上次没来得及保存的消息"""
+        pending = defaultdict(list)
+        for record in self.wal.replay():
+            if record.get("saved"):
+                # 这个群在此之前的消息都已经保存到文件
+                pending.pop(record["c"], None)
+            else:
+                pending[record["c"]].append(record["m"])
+        
+        count = 0
+        for chat_id, rows in pending.items():
+            for row in rows:
+                if isinstance(row, dict):
+                    # 旧格式
+                    row = GroupMessage.from_dict(row).to_row()
+                msg = self._make_message(*row)
+                self._add_to_cache(chat_id, msg)
+                self.search_index.add(chat_id, msg.timestamp, msg.username, msg.message)
+            count += len(rows)
+        
+        if count:
+            logger.info(f"从预写日志恢复了 {len(pending)} 个群的 {count} 条消息")
+        elif self.wal.size:
+            self.wal.truncate()
     
     def record_message(self, chat_id: int, user_id: int, username: str, message: str):
         """记录群消息"""
-        msg_data = {
-            "user_id": user_id,
-            "username": username,
-            "message": message,
-            "timestamp": datetime.now().isoformat()
-        }
+        msg = self._make_message(int(time.time()), user_id, username, message)
         
-        # 添加到缓存
-        self.message_cache[chat_id].append(msg_data)
+        # 先写预写日志，再加到缓存
+        self.wal.append({"c": chat_id, "m": msg.to_row()})
+        buffer = self._add_to_cache(chat_id, msg)
+        self.last_activity[chat_id] = msg.timestamp
         
-        # 限制缓存大小
-        if len(self.message_cache[chat_id]) > self.max_cache_size:
-            self.message_cache[chat_id] = self.message_cache[chat_id][-self.max_cache_size:]
+        # 加入全文索引（新群没有历史文件，直接标记为不需要补建）
+        if chat_id not in self.index and not self.search_index.is_backfilled(chat_id):
+            self.search_index.mark_backfilled(chat_id)
+        self.search_index.add(chat_id, msg.timestamp, msg.username, message)
         
         # 定期保存到文件
-        if len(self.message_cache[chat_id]) % 50 == 0:
+        if len(buffer) % self.save_every == 0:
             self._save_messages(chat_id)
+            # 预写日志太大时全部落盘，让日志可以清空
+            if self.wal.size > self.max_wal_bytes:
+                self.save_all()
+        
+        # 超过内存上限时，把最久没说话的群落盘并移出缓存
+        while self.cache_bytes > self.max_cache_bytes and len(self.message_cache) > 1:
+            cold_chat_id = next(iter(self.message_cache))
+            if not self._save_messages(cold_chat_id):
+                break
     
-    def _save_messages(self, chat_id: int):
-        """保存消息到文件"""
-        if not self.message_cache[chat_id]:
-            return
+    @traced("group.save")
+    def _save_messages(self, chat_id: int) -> bool:
+        """保存消息到文件，成功后把这个群移出缓存"""
+        buffer = self.message_cache.get(chat_id)
+        if not buffer:
+            with self._cache_lock:
+                self.message_cache.pop(chat_id, None)
+            return True
         
         today = datetime.now().strftime("%Y-%m-%d")
         file_path = self.storage_dir / f"{chat_id}_{today}.json"
         
+        start = time.perf_counter()
+        with self._cache_lock:
+            self._save_generation[chat_id] += 1
         try:
             # 读取已有数据
             existing_data = []
             if file_path.exists():
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    existing_data = json.load(f)
+                existing_data = serialization.load_file(file_path, serialization.GROUP_MESSAGES)
+            
+            # 合并新数据（只在这里转换成文件格式）
+            existing_data.extend(msg.to_dict() for msg in buffer.messages)
             
-            # 合并新数据
-            existing_data.extend(self.message_cache[chat_id])
+            # 保存（先写临时文件再替换，写到一半崩溃也不会丢掉当天已有的消息，
+            # 下面记检查点、清空预写日志之前数据必须已经落盘）
+            atomic_write(file_path, serialization.dumps(existing_data, pretty=True))
             
-            # 保存
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(existing_data, f, ensure_ascii=False, indent=2)
+            # 新文件加入目录索引
+            with self._index_lock:
+                dates = self.index.setdefault(chat_id, set())
+                if today not in dates:
+                    dates.add(today)
+                    self._save_index()
             
-            # 清空缓存
-            self.message_cache[chat_id] = []
+            # 索引里的这些消息也已经在文件里了，一起落盘
+            self.search_index.flush(chat_id)
+            
+            # 移出缓存（这些消息已经在文件里了，正在读消息的线程需要重读）
+            with self._cache_lock:
+                del self.message_cache[chat_id]
+                self.cache_bytes -= buffer.bytes
+                self._save_generation[chat_id] += 1
+            DISK_SAVE_LATENCY.observe(time.perf_counter() - start, store="group_messages")
+            
+            # 记录检查点；所有群都保存完了就清空预写日志
+            if self.message_cache:
+                self.wal.append({"c": chat_id, "saved": True})
+            else:
+                self.wal.truncate()
             
             logger.debug(f"已保存群 {chat_id} 的消息")
+            return True
         except Exception as e:
+            with self._cache_lock:
+                if self._save_generation[chat_id] % 2:
+                    self._save_generation[chat_id] += 1
             logger.error(f"保存消息失败: {e}")
+            return False
     
+    @traced("group.get_messages")
     def get_messages(self, chat_id: int, hours: int = 24) -> list:
-        """获取指定时间范围内的消息"""
-        messages = []
+        """获取指定时间范围内的消息 [GroupMessage]，按时间排序（可以在工作线程中调用）"""
+        start = time.perf_counter()
         cutoff_time = datetime.now() - timedelta(hours=hours)
+        cutoff_ts = cutoff_time.timestamp()
         
-        # 从缓存获取
-        for msg in self.message_cache[chat_id]:
-            msg_time = datetime.fromisoformat(msg["timestamp"])
-            if msg_time >= cutoff_time:
-                messages.append(msg)
+        # 先取缓存快照再读文件；读文件期间这个群在落盘（缓存正在移进文件）就重读，避免漏掉或重复
+        for attempt in range(10):
+            generation, cached = self._snapshot_cache(chat_id)
+            if generation % 2 == 0:
+                messages = self._read_day_files(chat_id, hours, cutoff_ts)
+                if self._save_generation[chat_id] == generation:
+                    break
+            time.sleep(0.01 * (attempt + 1))
+        else:
+            # 一直在落盘（非常少见）：按内容去掉文件里已经有的缓存消息
+            messages = self._read_day_files(chat_id, hours, cutoff_ts)
+            saved = {(msg.timestamp, msg.user_id, msg.message) for msg in messages}
+            cached = [msg for msg in cached if (msg.timestamp, msg.user_id, msg.message) not in saved]
         
-        # 从文件获取
+        # 缓存里的总是比文件里的新，放在后面，同一秒内的顺序不会乱
+        messages.extend(msg for msg in cached if msg.timestamp >= cutoff_ts)
+        
+        # 按时间排序
+        messages.sort(key=lambda msg: msg.timestamp)
+        
+        GROUP_SCAN_LATENCY.observe(time.perf_counter() - start)
+        return messages
+    
+    def _read_day_files(self, chat_id: int, hours: int, cutoff_ts: float) -> list:
+        """从按天文件读取 cutoff_ts 之后的消息"""
+        messages = []
         days_to_check = (hours // 24) + 2  # 多检查一天以防跨天
         for i in range(days_to_check):
             date = (datetime.now() - timedelta(days=i)).strftime("%Y-%m-%d")
@@ -91,20 +279,54 @@ class GroupMonitor:
             
             if file_path.exists():
                 try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        file_messages = json.load(f)
+                    file_messages = serialization.load_file(file_path, serialization.GROUP_MESSAGES)
                     
-                    for msg in file_messages:
-                        msg_time = datetime.fromisoformat(msg["timestamp"])
-                        if msg_time >= cutoff_time:
+                    # 只在这里把文件格式转成 GroupMessage
+                    for data in file_messages:
+                        msg = GroupMessage.from_dict(data)
+                        if msg.timestamp >= cutoff_ts:
                             messages.append(msg)
                 except Exception as e:
                     logger.error(f"读取消息文件失败: {e}")
+        return messages
+    
+    @traced("group.search")
+    def search_messages(self, chat_id: int, query: str, limit: int = 10) -> list:
+        """全文搜索群消息（所有关键词都要出现），按时间从新到旧返回"""
+        if not self.search_index.is_backfilled(chat_id):
+            self._backfill_search_index(chat_id)
+        return self.search_index.search(chat_id, query, limit)
+    
+    def _backfill_search_index(self, chat_id: int):
+        """用已保存的按天文件给一个群补建索引（每个群只做一次，在工作线程中进行）"""
+        start = time.perf_counter()
         
-        # 按时间排序
-        messages.sort(key=lambda x: x["timestamp"])
+        def load_rows():
+            # 先取缓存快照再扫描文件：扫描期间落盘的消息不在快照里就一定在文件里
+            _, cached = self._snapshot_cache(chat_id)
+            pending = [(msg.timestamp, msg.username, msg.message) for msg in cached]
+            rows = []
+            with self._index_lock:
+                dates = sorted(self.index.get(chat_id, ()))
+            for date_str in dates:
+                file_path = self.storage_dir / f"{chat_id}_{date_str}.json"
+                try:
+                    for data in serialization.load_file(file_path, serialization.GROUP_MESSAGES):
+                        msg = GroupMessage.from_dict(data)
+                        rows.append((msg.timestamp, msg.username, msg.message))
+                except FileNotFoundError:
+                    continue
+                except Exception as e:
+                    logger.error(f"读取消息文件失败: {e}")
+            return rows, pending
         
-        return messages
+        count = self.search_index.rebuild(chat_id, load_rows)
+        logger.info(f"群 {chat_id} 的全文索引补建完成：{count} 条消息，"
+                    f"{(time.perf_counter() - start) * 1000:.0f}ms")
+    
+    def active_chats(self, since: float) -> list:
+        """某个时间之后有新消息的群"""
+        return [chat_id for chat_id, ts in list(self.last_activity.items()) if ts >= since]
     
     def get_chat_stats(self, chat_id: int, hours: int = 24) -> dict:
         """获取群聊统计信息"""
@@ -120,7 +342,7 @@ class GroupMonitor:
         # 统计用户消息数
         user_stats = defaultdict(int)
         for msg in messages:
-            user_stats[msg["username"]] += 1
+            user_stats[msg.username] += 1
         
         return {
             "total_messages": len(messages),
@@ -129,24 +351,161 @@ class GroupMonitor:
             "time_range": f"{hours}小时"
         }
     
-    def cleanup_old_messages(self):
-        """清理过期消息"""
-        cutoff_date = datetime.now() - timedelta(days=self.retention_days)
+    def _load_index(self) -> dict:
+        """加载目录索引；没有索引时扫描一次目录重建"""
+        if self.index_file.exists():
+            try:
+                data = serialization.load_file(self.index_file)
+                return {int(chat_id): set(dates) for chat_id, dates in data.items()}
+            except Exception as e:
+                logger.warning(f"加载群消息索引失败，重新扫描目录: {e}")
         
+        index = defaultdict(set)
         for file_path in self.storage_dir.glob("*.json"):
+            match = _DAY_FILE_PATTERN.match(file_path.name)
+            if match:
+                index[int(match.group(1))].add(match.group(2))
+        index = dict(index)
+        
+        with self._index_lock:
+            self.index = index
+            self._save_index()
+        logger.info(f"已重建群消息索引（{len(index)} 个群）")
+        return index
+    
+    def _save_index(self):
+        """保存目录索引（调用时需持有 self._index_lock）"""
+        try:
+            atomic_write_json(self.index_file, {str(chat_id): sorted(dates) for chat_id, dates in self.index.items()})
+        except Exception as e:
+            logger.error(f"保存群消息索引失败: {e}")
+    
+    def _load_retention(self) -> dict:
+        """加载按群设置的保留天数"""
+        if self.retention_file.exists():
             try:
-                # 从文件名提取日期
-                date_str = file_path.stem.split("_")[-1]
-                file_date = datetime.strptime(date_str, "%Y-%m-%d")
-                
-                if file_date < cutoff_date:
-                    file_path.unlink()
-                    logger.info(f"已删除过期消息文件: {file_path.name}")
+                data = serialization.load_file(self.retention_file)
+                return {int(chat_id): days for chat_id, days in data.items()}
             except Exception as e:
-                logger.error(f"清理文件失败: {e}")
+                logger.warning(f"加载保留天数配置失败: {e}")
+        return {}
+    
+    def get_retention(self, chat_id: int) -> int:
+        """获取群消息保留天数"""
+        return self.retention.get(chat_id, self.retention_days)
+    
+    def set_retention(self, chat_id: int, days: int):
+        """设置群消息保留天数（过期的消息会压缩成小时汇总）"""
+        retention = dict(self.retention)
+        retention[chat_id] = days
+        atomic_write_json(self.retention_file, {str(k): v for k, v in retention.items()})
+        self.retention = retention
+        logger.info(f"群 {chat_id} 的消息保留天数设为 {days} 天")
+    
+    def cleanup_old_messages(self, max_workers: int = 4) -> dict:
+        """清理过期消息：过期的按天文件压缩成小时汇总后删除
+
+        会读写大量文件，请在工作线程中调用；各个群并行处理
+        """
+        today = date.today()
+        retention = self.retention
+        
+        # 从索引找出过期的文件，不扫描目录
+        with self._index_lock:
+            expired = {}
+            for chat_id, dates in self.index.items():
+                cutoff = (today - timedelta(days=retention.get(chat_id, self.retention_days))).isoformat()
+                old_dates = sorted(d for d in dates if d < cutoff)
+                if old_dates:
+                    expired[chat_id] = old_dates
+        
+        if not expired:
+            return {"chats": 0, "files": 0}
+        
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cleanup") as pool:
+            removed = list(pool.map(lambda item: self._compact_chat(*item), expired.items()))
+        
+        with self._index_lock:
+            for chat_id, dates in zip(expired, removed):
+                remaining = self.index.get(chat_id)
+                if remaining is not None:
+                    remaining.difference_update(dates)
+                    if not remaining:
+                        del self.index[chat_id]
+            self._save_index()
+        
+        return {"chats": len(expired), "files": sum(len(dates) for dates in removed)}
+    
+    def _compact_chat(self, chat_id: int, dates: list) -> list:
+        """把一个群的过期文件汇总成每小时的统计，返回已处理的日期"""
+        aggregate_file = self.storage_dir / f"{chat_id}_hourly.json"
+        aggregates = {}
+        if aggregate_file.exists():
+            try:
+                aggregates = serialization.load_file(aggregate_file)
+            except Exception as e:
+                logger.error(f"读取小时汇总失败 [{chat_id}]: {e}")
+                return []
+        
+        done = []
+        for date_str in dates:
+            file_path = self.storage_dir / f"{chat_id}_{date_str}.json"
+            try:
+                if file_path.exists():
+                    file_messages = serialization.load_file(file_path, serialization.GROUP_MESSAGES)
+                    
+                    for msg in file_messages:
+                        # "2025-01-01T13:05:00" -> "2025-01-01T13"
+                        hour = msg["timestamp"][:13]
+                        bucket = aggregates.setdefault(hour, {"messages": 0, "chars": 0, "users": {}})
+                        bucket["messages"] += 1
+                        bucket["chars"] += len(msg["message"] or "")
+                        users = bucket["users"]
+                        users[msg["username"]] = users.get(msg["username"], 0) + 1
+                done.append(date_str)
+            except Exception as e:
+                logger.error(f"汇总消息文件失败 [{file_path.name}]: {e}")
+        
+        # 小时汇总也有保留期限
+        cutoff_hour = (datetime.now() - timedelta(days=self.aggregate_retention_days)).strftime("%Y-%m-%dT%H")
+        aggregates = {hour: bucket for hour, bucket in sorted(aggregates.items()) if hour >= cutoff_hour}
+        
+        try:
+            if aggregates:
+                atomic_write_json(aggregate_file, aggregates)
+            elif aggregate_file.exists():
+                aggregate_file.unlink()
+        except Exception as e:
+            logger.error(f"保存小时汇总失败 [{chat_id}]: {e}")
+            return []
+        
+        # 汇总安全落盘后才删除原始消息和对应的索引
+        for date_str in done:
+            (self.storage_dir / f"{chat_id}_{date_str}.json").unlink(missing_ok=True)
+        if done:
+            next_day = (date.fromisoformat(max(done)) + timedelta(days=1)).isoformat()
+            self.search_index.drop_before(chat_id, next_day)
+        logger.info(f"群 {chat_id}: {len(done)} 天的过期消息已压缩成小时汇总")
+        return done
+    
+    def get_hourly_activity(self, chat_id: int) -> dict:
+        """获取已压缩的历史活跃度 {小时: {"messages", "chars", "users"}}"""
+        aggregate_file = self.storage_dir / f"{chat_id}_hourly.json"
+        if not aggregate_file.exists():
+            return {}
+        try:
+            return serialization.load_file(aggregate_file)
+        except Exception as e:
+            logger.error(f"读取小时汇总失败 [{chat_id}]: {e}")
+            return {}
     
     def save_all(self):
         """保存所有缓存的消息"""
         for chat_id in list(self.message_cache.keys()):
-            if self.message_cache[chat_id]:
-                self._save_messages(chat_id)
+            self._save_messages(chat_id)
+        self.search_index.flush()
+    
+    def close(self):
+        """保存所有缓存的消息并关闭预写日志"""
+        self.save_all()
+        self.wal.close()
@@ -0,0 +1,99 @@
+"""
+对话历史存储模块
+每个用户一个追加写的对话日志（JSONL，一行一条消息）：每轮对话只追加新的两条消息，
+日志行数超过保留条数的若干倍时压缩成只剩最近的消息。读写的都是 Turn，只在这里和文件格式互相转换
+"""
+import threading
+from pathlib import Path
+from loguru import logger
+from storage import safe_filename, atomic_write
+import serialization
+from models import Turn
+
+
+class HistoryStore:
+    """对话历史存储（追加写 + 定期压缩）"""
+
+    def __init__(self, history_dir, max_messages: int = 20, compact_factor: int = 2):
+        self.history_dir = Path(history_dir)
+        self.history_dir.mkdir(exist_ok=True)
+        # 只保留最近这么多条消息（max_history 轮 * 2）
+        self.max_messages = max_messages
+        # 日志行数超过 max_messages * compact_factor 时压缩
+        self.compact_factor = compact_factor
+
+        # 每个用户日志当前的行数（加载过或写过的用户）
+        self._lines = {}
+        self._lock = threading.Lock()
+
+    def _log_file(self, user_id: str) -> Path:
+        return self.history_dir / f"{safe_filename(user_id)}.jsonl"
+
+    def _legacy_file(self, user_id: str) -> Path:
+        """旧格式：整个历史一个 JSON 数组"""
+        return self.history_dir / f"{safe_filename(user_id)}.json"
+
+    def exists(self, user_id: str) -> bool:
+        return self._log_file(user_id).exists() or self._legacy_file(user_id).exists()
+
+    def load(self, user_id: str) -> list:
+        """读出用户最近的对话历史"""
+        legacy_file = self._legacy_file(user_id)
+        if legacy_file.exists():
+            return self._migrate(user_id, legacy_file)
+
+        log_file = self._log_file(user_id)
+        if not log_file.exists():
+            with self._lock:
+                self._lines[user_id] = 0
+            return []
+
+        messages = []
+        damaged = False
+        with open(log_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # 崩溃时写了一半的最后一行
+                    logger.warning(f"对话日志 {log_file.name} 末尾有不完整的记录，已跳过")
+                    damaged = True
+                    break
+                try:
+                    messages.append(Turn.from_dict(serialization.loads(line, serialization.HistoryRecord)))
+                except serialization.DecodeError:
+                    logger.warning(f"对话日志 {log_file.name} 有损坏的记录，已跳过")
+                    damaged = True
+        with self._lock:
+            # 有损坏的记录时，下次写入直接重写整个日志
+            self._lines[user_id] = None if damaged else len(messages)
+        return messages[-self.max_messages:]
+
+    def _migrate(self, user_id: str, legacy_file: Path) -> list:
+        """把旧格式的历史转成对话日志"""
+        data = serialization.load_file(legacy_file, serialization.HISTORY)[-self.max_messages:]
+        messages = [Turn.from_dict(msg) for msg in data]
+        self.rewrite(user_id, messages)
+        legacy_file.unlink(missing_ok=True)
+        logger.debug(f"对话历史已转为追加日志: {user_id}")
+        return messages
+
+    def append(self, user_id: str, new_messages: list, history: list):
+        """追加新消息；history 是追加后内存中的完整历史，压缩时直接用它重写日志"""
+        with self._lock:
+            lines = self._lines.get(user_id)
+            # 没读过日志（不知道有多少行）或者行数太多，直接重写
+            if lines is None or lines + len(new_messages) > self.max_messages * self.compact_factor:
+                self._rewrite(user_id, history)
+                return
+            with open(self._log_file(user_id), 'a', encoding='utf-8') as f:
+                f.write("".join(serialization.dumps_line(msg.to_dict()) for msg in new_messages))
+            self._lines[user_id] = lines + len(new_messages)
+
+    def rewrite(self, user_id: str, messages: list):
+        """用最近的消息重写整个日志（压缩、清空历史时使用）"""
+        with self._lock:
+            self._rewrite(user_id, messages)
+
+    def _rewrite(self, user_id: str, messages: list):
+        messages = messages[-self.max_messages:]
+        atomic_write(self._log_file(user_id), "".join(serialization.dumps_line(msg.to_dict()) for msg in messages))
+        self._lines[user_id] = len(messages)
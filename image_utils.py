@@ -0,0 +1,97 @@
+"""
+图片处理模块
+按目标分辨率选图、可选本地缩放，并以流式方式编码 base64，减少大图的内存拷贝
+"""
+import binascii
+import io
+from loguru import logger
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow 可选，没有就不缩放
+    Image = None
+
+# 每次编码的原始字节数（必须是 3 的倍数，保证分块编码结果可直接拼接）
+_CHUNK_SIZE = 3 * 64 * 1024
+
+_DATA_URL_PREFIX = b"data:image/jpeg;base64,"
+
+
+class ImageTooLargeError(ValueError):
+    """图片超过单次请求的内存上限"""
+
+
+def choose_photo_size(photo_sizes, target_size: int):
+    """从 Telegram 提供的多个尺寸中，选最接近目标分辨率的那个
+
+    选最长边不小于 target_size 的最小尺寸；都不够大就用最大的。
+    """
+    sizes = sorted(photo_sizes, key=lambda p: max(p.width, p.height))
+    for photo in sizes:
+        if max(photo.width, photo.height) >= target_size:
+            return photo
+    return sizes[-1]
+
+
+def downscale(image_bytes: io.BytesIO, max_side: int, quality: int = 85) -> io.BytesIO:
+    """缩放到最长边不超过 max_side 并重新编码为 JPEG
+
+    没有安装 Pillow、图片本身够小或处理失败时，原样返回。
+    """
+    if Image is None:
+        return image_bytes
+
+    image_bytes.seek(0)
+    try:
+        with Image.open(image_bytes) as img:
+            if max(img.size) <= max_side and img.format == "JPEG":
+                return image_bytes
+            img.thumbnail((max_side, max_side))
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            out = io.BytesIO()
+            img.save(out, format="JPEG", quality=quality, optimize=True)
+    except Exception as e:
+        logger.warning(f"图片缩放失败，使用原图: {e}")
+        return image_bytes
+    finally:
+        image_bytes.seek(0)
+
+    logger.debug(f"图片已缩放: {image_bytes.getbuffer().nbytes} -> {out.tell()} 字节")
+    return out
+
+
+def encode_base64(data, prefix: bytes = b"") -> bytearray:
+    """流式 base64 编码：按块写入预先分配好的缓冲区，不产生整图大小的中间副本
+
+    prefix 预先写在缓冲区开头（比如 data URL 的头部），省得之后再拼接一次
+    """
+    with memoryview(data) as view:
+        size = view.nbytes
+        out = bytearray(len(prefix) + 4 * ((size + 2) // 3))
+        out[:len(prefix)] = prefix
+
+        pos = len(prefix)
+        for start in range(0, size, _CHUNK_SIZE):
+            encoded = binascii.b2a_base64(view[start:start + _CHUNK_SIZE], newline=False)
+            out[pos:pos + len(encoded)] = encoded
+            pos += len(encoded)
+
+    return out
+
+
+def build_image_url(image_bytes: io.BytesIO, max_bytes: int, max_side: int = 0, quality: int = 85) -> str:
+    """把图片转为 data URL（超过 max_bytes 直接拒绝；缩放和编码都比较耗 CPU，在工作线程中调用）"""
+    size = image_bytes.getbuffer().nbytes
+    if size > max_bytes:
+        raise ImageTooLargeError(f"图片大小 {size} 字节，超过上限 {max_bytes} 字节")
+
+    if max_side:
+        image_bytes = downscale(image_bytes, max_side, quality)
+
+    # getbuffer() 直接引用 BytesIO 的内部缓冲区，不拷贝
+    with image_bytes.getbuffer() as view:
+        encoded = encode_base64(view, _DATA_URL_PREFIX)
+
+    # 头部已经在缓冲区里，只在转成字符串时拷贝一次
+    return encoded.decode("ascii")
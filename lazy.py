@@ -0,0 +1,49 @@
+"""
+延迟初始化工具
+重量级的模块和数据在第一次用到时（或启动后的后台预热中）才加载，让机器人尽快开始接收消息
+"""
+import functools
+import threading
+import time
+from loguru import logger
+
+# 各组件初始化耗时 {名称: 秒}（用于启动耗时分析）
+INIT_TIMES = {}
+
+
+class lazy_property:
+    """线程安全的延迟属性：第一次访问时创建并缓存到实例上，之后直接读取实例属性，没有额外开销"""
+
+    def __init__(self, func):
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.name = func.__name__
+        self.lock = threading.RLock()
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+
+        with self.lock:
+            # 其他线程可能已经初始化好了
+            if self.name in obj.__dict__:
+                return obj.__dict__[self.name]
+
+            start = time.perf_counter()
+            value = self.func(obj)
+            obj.__dict__[self.name] = value
+
+            elapsed = time.perf_counter() - start
+            INIT_TIMES[f"{type(obj).__name__}.{self.name}"] = elapsed
+            logger.debug(f"延迟初始化 {type(obj).__name__}.{self.name}: {elapsed * 1000:.1f}ms")
+            return value
+
+
+def is_initialized(obj, name: str) -> bool:
+    """延迟属性是否已经初始化（用于关闭时跳过没用过的组件）"""
+    return name in obj.__dict__
+
+
+def format_timings(timings: dict) -> str:
+    """格式化耗时明细，如 "导入模块 120ms | 创建应用 30ms" """
+    return " | ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in timings.items())
@@ -0,0 +1,88 @@
+"""
+生命周期管理模块
+统计在途请求、收到退出信号后等它们处理完（有截止时间），再按顺序把所有缓冲数据落盘
+"""
+import asyncio
+import signal
+import threading
+import time
+from contextlib import contextmanager
+from loguru import logger
+
+
+class Lifecycle:
+    """生命周期管理器"""
+
+    def __init__(self):
+        # 在途请求数
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        # 退出时要执行的落盘函数 [(名称, 函数)]，按注册顺序执行
+        self._flushers = []
+        self._flushed = False
+        # 是否正在关闭
+        self.stopping = False
+
+    def register(self, name: str, func):
+        """注册一个退出时执行的落盘函数"""
+        self._flushers.append((name, func))
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @contextmanager
+    def track(self):
+        """标记一个在途请求"""
+        with self._lock:
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    async def drain(self, timeout: float) -> int:
+        """等待在途请求处理完，最多等 timeout 秒，返回仍未完成的数量"""
+        deadline = time.monotonic() + timeout
+        if self._in_flight:
+            logger.info(f"⏳ 等待 {self._in_flight} 个处理中的请求完成（最多 {timeout:.0f}s）...")
+        while self._in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+        if self._in_flight:
+            logger.warning(f"⚠️ 还有 {self._in_flight} 个请求没处理完，强制退出")
+        return self._in_flight
+
+    def flush_all(self):
+        """执行所有落盘函数（只执行一次，单个失败不影响其他）"""
+        if self._flushed:
+            return
+        self._flushed = True
+
+        timings = []
+        for name, func in self._flushers:
+            start = time.perf_counter()
+            try:
+                func()
+            except Exception as e:
+                logger.error(f"落盘失败 [{name}]: {e}")
+            timings.append(f"{name} {(time.perf_counter() - start) * 1000:.0f}ms")
+        logger.info(f"💾 数据已全部落盘：{' | '.join(timings)}")
+
+    def install_signal_handlers(self, loop, on_signal):
+        """在事件循环中处理 SIGINT / SIGTERM；第二次收到信号时直接退出"""
+        def handler(sig):
+            if self.stopping:
+                logger.warning("再次收到退出信号，立即退出")
+                raise SystemExit(1)
+            self.stopping = True
+            logger.info(f"收到 {sig.name}，开始关闭...")
+            loop.create_task(on_signal())
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, handler, sig)
+            except (NotImplementedError, RuntimeError):
+                # Windows 不支持，Ctrl+C 会以 KeyboardInterrupt 的形式结束轮询
+                pass
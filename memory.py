@@ -2,104 +2,271 @@
 记忆系统模块
 记录和管理用户的重要信息
 """
-import json
+import os
+import threading
+import time
 from pathlib import Path
 from datetime import datetime
 from loguru import logger
+from config import MEMORY_TOP_K, MEMORY_MAX_TOKENS, MEMORY_EMBEDDING_MODEL, MEMORY_COMPACT_THRESHOLD
+from memory_index import MemoryIndex
+from models import MemoryEntry
+from storage import atomic_write_json, safe_filename
+import serialization
+from metrics import DISK_SAVE_LATENCY, CACHE_SIZE
+from tracing import span, traced
 
 
 class MemoryManager:
-    """记忆管理器"""
+    """记忆管理器
+    
+    存储结构：
+    - memories/<user_id>.json  每个用户一个快照文件，首次访问时才加载
+    - user_memories.journal    追加写的修改日志，达到阈值后合并进快照
+    """
     
     def __init__(self, memory_dir="chat_history"):
         self.memory_dir = Path(memory_dir)
         self.memory_dir.mkdir(exist_ok=True)
-        self.memory_file = self.memory_dir / "user_memories.json"
-        self.memories = self._load_memories()
+        self.snapshot_dir = self.memory_dir / "memories"
+        self.snapshot_dir.mkdir(exist_ok=True)
+        self.journal_file = self.memory_dir / "user_memories.journal"
+        # 旧版单文件格式（启动时自动迁移）
+        self.legacy_file = self.memory_dir / "user_memories.json"
+        
+        # 已加载用户的记忆 {user_id: {key: MemoryEntry}}
+        self.memories = {}
+        # 有未合并修改的用户
+        self._dirty = set()
+        # 日志中的记录数
+        self._journal_count = 0
+        self._journal = None
+        # 后台提取线程也会写记忆，修改时需要加锁
+        self._lock = threading.RLock()
+        
+        # 记忆检索索引
+        self.index = MemoryIndex(MEMORY_EMBEDDING_MODEL)
+        # 后台记忆提取器（由 AIClient 设置）
+        self.extractor = None
+        
+        self._migrate_legacy()
+        self._replay_journal()
+        
+        CACHE_SIZE.set_function(lambda: len(self.memories), cache="memory_users")
     
-    def _load_memories(self) -> dict:
-        """加载记忆数据"""
-        if self.memory_file.exists():
+    def _get_snapshot_file(self, user_id: str) -> Path:
+        """获取用户记忆快照文件路径"""
+        return self.snapshot_dir / f"{safe_filename(user_id)}.json"
+    
+    def _load_user(self, user_id: str) -> dict:
+        """获取用户记忆（首次访问时从快照加载）"""
+        memories = self.memories.get(user_id)
+        if memories is not None:
+            return memories
+        
+        memories = {}
+        snapshot_file = self._get_snapshot_file(user_id)
+        if snapshot_file.exists():
             try:
-                with open(self.memory_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                data = serialization.load_file(snapshot_file, serialization.MEMORIES)
+                memories = {key: MemoryEntry.from_dict(value) for key, value in data.items()}
             except Exception as e:
-                logger.warning(f"加载记忆数据失败: {e}")
-                return {}
-        return {}
+                logger.warning(f"加载记忆数据失败 [{user_id}]: {e}")
+        
+        self.memories[user_id] = memories
+        return memories
     
-    def _save_memories(self):
-        """保存记忆数据"""
+    def _migrate_legacy(self):
+        """把旧版 user_memories.json 拆分为每个用户的快照"""
+        if not self.legacy_file.exists():
+            return
+        
         try:
-            with open(self.memory_file, 'w', encoding='utf-8') as f:
-                json.dump(self.memories, f, ensure_ascii=False, indent=2)
+            legacy = serialization.load_file(self.legacy_file)
+            for user_id, memories in legacy.items():
+                if memories:
+                    atomic_write_json(self._get_snapshot_file(user_id), memories)
+            self.legacy_file.replace(self.legacy_file.with_suffix(".json.bak"))
+            logger.info(f"已迁移 {len(legacy)} 个用户的记忆数据")
         except Exception as e:
-            logger.error(f"保存记忆数据失败: {e}")
+            logger.warning(f"迁移记忆数据失败: {e}")
     
-    def add_memory(self, user_id: str, key: str, value: str):
-        """添加记忆"""
-        if user_id not in self.memories:
-            self.memories[user_id] = {}
+    def _replay_journal(self):
+        """重放未合并的修改日志（日志长度有上限，启动耗时与用户数无关）"""
+        if not self.journal_file.exists():
+            return
         
-        self.memories[user_id][key] = {
-            "value": value,
-            "created_at": datetime.now().isoformat(),
-            "updated_at": datetime.now().isoformat()
-        }
+        # 最后一条完整记录的结尾位置
+        good_end = 0
+        with open(self.journal_file, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # 崩溃时最后一行可能没写完整
+                    break
+                try:
+                    entry = serialization.loads(line)
+                except serialization.DecodeError:
+                    logger.warning("记忆日志有损坏的记录，已跳过")
+                    good_end += len(line)
+                    continue
+                self._apply(entry)
+                self._journal_count += 1
+                good_end += len(line)
+            torn = f.tell() != good_end
         
-        self._save_memories()
-        logger.info(f"用户 {user_id} 添加记忆: {key} = {value}")
+        if torn:
+            # 截掉写了一半的最后一行，否则下一条记录会接在它后面，两行一起损坏
+            with open(self.journal_file, 'r+b') as f:
+                f.truncate(good_end)
+                os.fsync(f.fileno())
+            logger.warning("记忆日志末尾不完整，已截断")
+        
+        if self._journal_count:
+            logger.info(f"已重放 {self._journal_count} 条记忆修改日志")
     
-    def update_memory(self, user_id: str, key: str, value: str):
-        """更新记忆"""
-        if user_id not in self.memories:
-            self.memories[user_id] = {}
+    def _apply(self, entry: dict):
+        """把一条修改应用到内存"""
+        user_id = entry["u"]
+        memories = self._load_user(user_id)
+        
+        if entry["op"] == "set":
+            value = entry["v"]
+            # 从日志重放的是文件格式
+            memories[entry["k"]] = MemoryEntry.from_dict(value) if isinstance(value, dict) else value
+        elif entry["op"] == "del":
+            memories.pop(entry["k"], None)
+        elif entry["op"] == "clear":
+            memories.clear()
         
-        if key in self.memories[user_id]:
-            self.memories[user_id][key]["value"] = value
-            self.memories[user_id][key]["updated_at"] = datetime.now().isoformat()
-        else:
-            self.add_memory(user_id, key, value)
+        self._dirty.add(user_id)
+        self.index.invalidate(user_id)
+    
+    def _commit(self, entry: dict):
+        """应用修改并追加到日志（只写一行，不重写整个文件）"""
+        self._apply(entry)
         
-        self._save_memories()
+        try:
+            with span("memory.journal"), DISK_SAVE_LATENCY.time(store="memory_journal"):
+                if self._journal is None:
+                    self._journal = open(self.journal_file, 'a', encoding='utf-8')
+                record = dict(entry, v=entry["v"].to_dict()) if "v" in entry else entry
+                self._journal.write(serialization.dumps_line(record))
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+            self._journal_count += 1
+        except Exception as e:
+            logger.error(f"写入记忆日志失败: {e}")
+            return
+        
+        if self._journal_count >= MEMORY_COMPACT_THRESHOLD:
+            self._compact()
+    
+    @traced("memory.compact")
+    def _compact(self):
+        """把日志合并进快照：只重写有修改的用户，然后清空日志"""
+        start = time.perf_counter()
+        try:
+            for user_id in list(self._dirty):
+                snapshot_file = self._get_snapshot_file(user_id)
+                memories = self.memories.get(user_id)
+                if memories:
+                    atomic_write_json(snapshot_file, {key: entry.to_dict() for key, entry in memories.items()})
+                elif snapshot_file.exists():
+                    snapshot_file.unlink()
+                self._dirty.discard(user_id)
+            
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            # 快照都已落盘，日志可以安全清空
+            open(self.journal_file, 'w').close()
+            self._journal_count = 0
+            DISK_SAVE_LATENCY.observe(time.perf_counter() - start, store="memory_snapshot")
+            logger.debug("记忆日志已合并")
+        except Exception as e:
+            logger.error(f"合并记忆日志失败: {e}")
+    
+    def flush(self):
+        """合并所有未落盘的修改"""
+        with self._lock:
+            if self._dirty or self._journal_count:
+                self._compact()
+    
+    def add_memory(self, user_id: str, key: str, value: str):
+        """添加记忆"""
+        now = time.time()
+        with self._lock:
+            self._commit({
+                "op": "set",
+                "u": user_id,
+                "k": key,
+                "v": MemoryEntry(value, now, now)
+            })
+        logger.info(f"用户 {user_id} 添加记忆: {key} = {value}")
+    
+    def update_memory(self, user_id: str, key: str, value: str):
+        """更新记忆（不存在则添加）"""
+        now = time.time()
+        with self._lock:
+            existing = self._load_user(user_id).get(key)
+            created_at = existing.created_at if existing else now
+            self._commit({
+                "op": "set",
+                "u": user_id,
+                "k": key,
+                "v": MemoryEntry(value, created_at, now)
+            })
         logger.info(f"用户 {user_id} 更新记忆: {key} = {value}")
     
     def get_memory(self, user_id: str, key: str) -> str:
         """获取单个记忆"""
-        if user_id in self.memories and key in self.memories[user_id]:
-            return self.memories[user_id][key]["value"]
-        return None
+        with self._lock:
+            data = self._load_user(user_id).get(key)
+        return data.value if data else None
     
     def get_all_memories(self, user_id: str) -> dict:
         """获取用户所有记忆"""
-        return self.memories.get(user_id, {})
+        with self._lock:
+            return self._load_user(user_id)
     
     def delete_memory(self, user_id: str, key: str) -> bool:
         """删除记忆"""
-        if user_id in self.memories and key in self.memories[user_id]:
-            del self.memories[user_id][key]
-            self._save_memories()
-            logger.info(f"用户 {user_id} 删除记忆: {key}")
-            return True
-        return False
+        with self._lock:
+            if key not in self._load_user(user_id):
+                return False
+            self._commit({"op": "del", "u": user_id, "k": key})
+        logger.info(f"用户 {user_id} 删除记忆: {key}")
+        return True
     
     def clear_memories(self, user_id: str):
         """清空用户所有记忆"""
-        if user_id in self.memories:
-            self.memories[user_id] = {}
-            self._save_memories()
-            logger.info(f"用户 {user_id} 清空了所有记忆")
+        with self._lock:
+            if not self._load_user(user_id):
+                return
+            self._commit({"op": "clear", "u": user_id})
+        logger.info(f"用户 {user_id} 清空了所有记忆")
     
-    def get_memory_context(self, user_id: str) -> str:
-        """获取记忆上下文（用于注入到对话）"""
-        memories = self.get_all_memories(user_id)
+    def get_memory_context(self, user_id: str, query: str = "") -> str:
+        """获取记忆上下文（用于注入到对话），只挑选与当前消息相关的记忆"""
+        # 记忆和版本号在同一把锁里读取：后台提取器在这之后写入的修改会换一个版本号，不会把旧索引当成新的
+        with self._lock:
+            memories = dict(self.get_all_memories(user_id))
+            version = self.index.version(user_id)
         
         if not memories:
             return ""
         
+        relevant = self.index.search(
+            user_id, memories, version, query,
+            top_k=MEMORY_TOP_K,
+            max_tokens=MEMORY_MAX_TOKENS
+        )
+        if not relevant:
+            return ""
+        
         memory_lines = []
-        for key, data in memories.items():
-            memory_lines.append(f"- {key}: {data['value']}")
+        for key, value in relevant:
+            memory_lines.append(f"- {key}: {value}")
         
         context = "关于用户的记忆：\n" + "\n".join(memory_lines)
         return context
@@ -113,8 +280,8 @@ class MemoryManager:
         
         lines = ["🧠 我记住的关于你的信息：\n"]
         for key, data in memories.items():
-            value = data["value"]
-            created = datetime.fromisoformat(data["created_at"]).strftime("%Y-%m-%d")
+            value = data.value
+            created = datetime.fromtimestamp(data.created_at).strftime("%Y-%m-%d")
             lines.append(f"• {key}: {value}")
             lines.append(f"  （记录于 {created}）")
         
@@ -123,19 +290,6 @@ class MemoryManager:
         return "\n".join(lines)
     
     def extract_and_save(self, user_id: str, message: str, reply: str):
-        """从对话中提取并保存重要信息（简单实现）"""
-        # 简单的关键词匹配
-        keywords = {
-            "名字": ["我叫", "我的名字是", "叫我"],
-            "年龄": ["我今年", "岁了", "我的年龄"],
-            "职业": ["我是", "我做", "我的工作"],
-            "爱好": ["我喜欢", "我爱", "我的爱好"],
-            "生日": ["我的生日", "生日是"],
-        }
-        
-        for key, patterns in keywords.items():
-            for pattern in patterns:
-                if pattern in message:
-                    # 提取信息（简单实现，可以用 AI 提取更准确）
-                    # 这里只是示例，实际可以调用 AI 来提取
-                    pass
+        """从对话中提取并保存重要信息（交给后台提取器，不阻塞回复）"""
+        if self.extractor:
+            self.extractor.submit(user_id, message)
@@ -0,0 +1,256 @@
+"""
+记忆提取模块
+在后台批量调用模型，从用户消息中提取值得记住的信息并写入记忆
+"""
+import queue
+import threading
+import time
+from loguru import logger
+import serialization
+from metrics import MODEL_LATENCY, ERRORS
+
+# 可能包含个人信息的消息特征（粗筛，减少无效调用）
+PERSONAL_MARKERS = [
+    "我叫", "我的", "我是", "我今年", "我在", "我做", "我喜欢", "我爱", "我不喜欢",
+    "我讨厌", "我住", "我家", "叫我", "生日", "岁了", "本人",
+    "my ", "i'm ", "i am ", "call me"
+]
+
+EXTRACT_PROMPT = """你是信息提取器。下面的 JSON 数组是多位用户发来的消息（id 是消息编号，text 是消息原文，known_keys 是发送者已有的记忆 key），请提取其中关于发送者本人、值得长期记住的事实（如名字、年龄、职业、爱好、生日、所在城市、偏好等）。
+
+规则：
+1. 只提取发送者在这条消息里明确陈述的关于自己的事实，不要猜测；消息里提到的其他人或其他消息编号都不算
+2. key 用简短的中文名词（如：名字、爱好、城市），known_keys 里已有的 key 尽量沿用
+3. 没有可提取的信息就返回空列表
+4. 只输出 JSON，格式：{{"memories": [{{"id": 消息编号, "key": "名字", "value": "小明"}}]}}
+
+{items}
+"""
+
+
+class MemoryExtractor:
+    """后台记忆提取器：攒批后用一次模型调用处理多个用户的消息"""
+
+    def __init__(self, client, memory, model: str, batch_size: int = 20, flush_interval: float = 30.0):
+        self.client = client
+        self.memory = memory
+        self.model = model
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        # 模型是否支持 response_format（不支持时自动降级）
+        self._json_mode = True
+        # 批量任务执行器（设置后提取请求走批量接口，结果由 apply_batch_result 写回）
+        self.batch_runner = None
+        # 用量统计（由 AIClient 设置）
+        self.usage = None
+
+    @staticmethod
+    def looks_personal(message: str) -> bool:
+        """粗略判断消息是否可能包含个人信息"""
+        text = message.lower()
+        return any(marker in text for marker in PERSONAL_MARKERS)
+
+    def submit(self, user_id: str, message: str):
+        """提交一条用户消息（不阻塞）"""
+        if self._stopped.is_set() or not message or not self.looks_personal(message):
+            return
+
+        self._queue.put((user_id, message[:500]))
+        self._ensure_started()
+
+    def _ensure_started(self):
+        """按需启动后台线程"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="memory-extractor", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        """后台循环：攒够一批或到达刷新间隔就提取一次；停止后处理完队列中剩下的消息再退出"""
+        while True:
+            try:
+                if self._stopped.is_set():
+                    first = self._queue.get_nowait()
+                else:
+                    first = self._queue.get(timeout=1.0)
+            except queue.Empty:
+                if self._stopped.is_set():
+                    return
+                continue
+
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if self._stopped.is_set():
+                    # 停止时不再等新消息，把队列里剩下的直接凑成整批（不能一条消息调用一次模型）
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                    continue
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=min(timeout, 1.0)))
+                except queue.Empty:
+                    continue
+
+            self._process(batch)
+
+    def _process(self, batch: list):
+        """处理一批消息"""
+        if self.batch_runner is not None:
+            self._submit_to_batch(batch)
+            return
+        
+        try:
+            with MODEL_LATENCY.time(model=self.model):
+                facts = self.extract(batch)
+        except Exception as e:
+            ERRORS.inc(where="memory_extract", type=type(e).__name__)
+            logger.warning(f"记忆提取失败（{len(batch)} 条消息）: {e}")
+            return
+
+        self._save_facts(facts, len(batch))
+
+    def _save_facts(self, facts: list, message_count: int):
+        saved = 0
+        for user_id, key, value in facts:
+            if self.memory.get_memory(user_id, key) == value:
+                continue
+            self.memory.update_memory(user_id, key, value)
+            saved += 1
+
+        if saved:
+            logger.info(f"后台记忆提取完成：{message_count} 条消息，更新 {saved} 条记忆")
+
+    def _submit_to_batch(self, batch: list):
+        """把提取请求交给批量任务（不等结果）"""
+        body = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": self.build_prompt(batch)}],
+            "max_tokens": 800,
+            "temperature": 0,
+        }
+        if self._json_mode:
+            body["response_format"] = {"type": "json_object"}
+        # 按消息顺序记下发送者，结果只按消息编号对应回用户
+        authors = [user_id for user_id, _ in batch]
+        self.batch_runner.add("memory", body, {"authors": authors, "messages": len(batch)})
+
+    def apply_batch_result(self, payload: dict, text):
+        """写回批量任务的提取结果"""
+        if text is None:
+            return
+        if "authors" not in payload:
+            # 旧版任务只记了用户集合，无法确定每条结果属于谁，直接丢弃
+            logger.warning("丢弃一个旧格式的记忆提取批量任务结果")
+            return
+        self._save_facts(self.parse_response(text, payload["authors"]), payload["messages"])
+
+    def build_prompt(self, batch: list) -> str:
+        """构建提取提示词
+
+        消息编码成 JSON 数组，消息内容伪造不出别的条目；提示词里不出现用户 ID，
+        结果由消息编号对应回发送者（见 parse_response）
+        """
+        known_keys = {}
+        items = []
+        for index, (user_id, message) in enumerate(batch, 1):
+            if user_id not in known_keys:
+                known_keys[user_id] = list(self.memory.get_all_memories(user_id))[:20]
+            item = {"id": index, "text": message}
+            if known_keys[user_id]:
+                item["known_keys"] = known_keys[user_id]
+            items.append(item)
+
+        return EXTRACT_PROMPT.format(items=serialization.dumps(items, pretty=True).decode("utf-8"))
+
+    def extract(self, batch: list) -> list:
+        """调用模型提取记忆，返回 [(user_id, key, value)]"""
+        request = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": self.build_prompt(batch)}],
+            "max_tokens": 800,
+            "temperature": 0,
+            "timeout": 60
+        }
+
+        if self._json_mode:
+            try:
+                response = self.client.chat.completions.create(
+                    response_format={"type": "json_object"}, **request
+                )
+            except Exception as e:
+                if "response_format" not in str(e):
+                    raise
+                logger.info("模型不支持 response_format，改用普通模式提取记忆")
+                self._json_mode = False
+                response = self.client.chat.completions.create(**request)
+        else:
+            response = self.client.chat.completions.create(**request)
+
+        if self.usage is not None:
+            self.usage.record_response(response, "memory", self.model)
+
+        authors = [user_id for user_id, _ in batch]
+        return self.parse_response(response.choices[0].message.content, authors)
+
+    @staticmethod
+    def parse_response(text: str, authors: list) -> list:
+        """解析模型输出，按消息编号（从 1 开始）对应到 authors 中的发送者
+
+        模型返回的用户 ID 一律忽略，避免用户在消息里冒充别人写入记忆
+        """
+        if not text:
+            return []
+
+        # 兼容模型把 JSON 包在代码块里的情况
+        start, end = text.find("{"), text.rfind("}")
+        if start == -1 or end == -1:
+            return []
+
+        try:
+            data = serialization.loads(text[start:end + 1])
+        except serialization.DecodeError:
+            logger.warning(f"记忆提取结果不是有效 JSON: {text[:100]}")
+            return []
+
+        facts = []
+        for item in data.get("memories", []):
+            if not isinstance(item, dict):
+                continue
+            index = item.get("id")
+            if isinstance(index, str) and index.strip().isdigit():
+                index = int(index)
+            if not isinstance(index, int) or isinstance(index, bool) or not 1 <= index <= len(authors):
+                continue
+            key = str(item.get("key", "")).strip()
+            value = str(item.get("value", "")).strip()
+            if key and value and len(key) <= 20 and len(value) <= 200:
+                facts.append((authors[index - 1], key, value))
+
+        return facts
+
+    def stop(self, flush: bool = True, timeout: float = 30.0):
+        """停止后台线程；flush 为 True 时剩下的消息交给后台线程处理完，最多等待 timeout 秒"""
+        if not flush:
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+        self._stopped.set()
+
+        if not self._queue.empty():
+            self._ensure_started()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+            if self._thread.is_alive():
+                logger.warning(f"记忆提取 {timeout:.0f} 秒内没有处理完，放弃剩余的约 {self._queue.qsize()} 条消息")
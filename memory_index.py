@@ -0,0 +1,199 @@
+"""
+记忆索引模块
+为每个用户建立记忆的倒排索引（可选本地向量检索），只挑选与当前消息相关的记忆
+"""
+import math
+import threading
+from collections import OrderedDict, defaultdict
+from loguru import logger
+from text_utils import tokenize, estimate_tokens
+from metrics import CACHE_HITS, CACHE_MISSES
+
+
+class _UserIndex:
+    """单个用户的记忆索引"""
+
+    __slots__ = ("version", "postings", "doc_len", "recency", "vectors")
+
+    def __init__(self, version: int):
+        self.version = version
+        # 倒排表 {token: {key: 词频}}
+        self.postings = defaultdict(dict)
+        # 每条记忆的 token 数 {key: n}
+        self.doc_len = {}
+        # 按更新时间排序的 key（新的在前）
+        self.recency = []
+        # 向量 {key: [float]}（未启用向量检索时为空）
+        self.vectors = {}
+
+
+class MemoryIndex:
+    """记忆索引：关键词倒排索引 + 可选向量相似度，带排序缓存"""
+
+    def __init__(self, embedding_model: str = "", cache_size: int = 512):
+        self.embedding_model = embedding_model
+        self.cache_size = cache_size
+
+        # {user_id: _UserIndex}
+        self._indexes = {}
+        # 记忆版本号 {user_id: int}，记忆变化时递增
+        self._versions = defaultdict(int)
+        # 排序缓存 {(user_id, version, fallback, 查询的 token 集合): [key]}
+        self._rank_cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        # 向量模型（懒加载）
+        self._embedder = None
+        self._embedder_failed = False
+
+    def invalidate(self, user_id: str):
+        """记忆发生变化，使该用户的索引和缓存失效"""
+        with self._lock:
+            self._versions[user_id] += 1
+            self._indexes.pop(user_id, None)
+
+    def version(self, user_id: str) -> int:
+        """用户记忆的当前版本号（调用方要在复制记忆的同一把锁里读取，两者才对得上）"""
+        with self._lock:
+            return self._versions[user_id]
+
+    def _get_embedder(self):
+        """懒加载本地向量模型（需要安装 sentence-transformers）"""
+        if not self.embedding_model or self._embedder_failed:
+            return None
+        if self._embedder is None:
+            try:
+                from sentence_transformers import SentenceTransformer
+                self._embedder = SentenceTransformer(self.embedding_model)
+                logger.info(f"已加载记忆向量模型: {self.embedding_model}")
+            except Exception as e:
+                logger.warning(f"加载记忆向量模型失败，仅使用关键词检索: {e}")
+                self._embedder_failed = True
+                return None
+        return self._embedder
+
+    def _build(self, user_id: str, memories: dict, version: int) -> _UserIndex:
+        """构建用户索引"""
+        index = _UserIndex(version)
+
+        for key, data in memories.items():
+            # key 出现两次，提高命中 key 的权重
+            tokens = tokenize(key) * 2 + tokenize(data.value)
+            index.doc_len[key] = len(tokens) or 1
+            for token in tokens:
+                index.postings[token][key] = index.postings[token].get(key, 0) + 1
+
+        index.recency = sorted(
+            memories,
+            key=lambda k: memories[k].updated_at,
+            reverse=True
+        )
+
+        embedder = self._get_embedder()
+        if embedder and memories:
+            keys = list(memories)
+            texts = [f"{k}: {memories[k].value}" for k in keys]
+            try:
+                vectors = embedder.encode(texts, normalize_embeddings=True)
+                index.vectors = {k: list(v) for k, v in zip(keys, vectors)}
+            except Exception as e:
+                logger.warning(f"记忆向量编码失败: {e}")
+
+        return index
+
+    def _get_index(self, user_id: str, memories: dict, version: int) -> _UserIndex:
+        """获取（必要时重建）用户索引，version 是 memories 对应的版本号"""
+        with self._lock:
+            index = self._indexes.get(user_id)
+        if index is not None and index.version == version:
+            return index
+
+        index = self._build(user_id, memories, version)
+        with self._lock:
+            # 复制记忆之后或构建期间记忆又变了，就不缓存这个旧索引
+            if self._versions[user_id] == version:
+                self._indexes[user_id] = index
+        return index
+
+    def _rank(self, index: _UserIndex, query: str, tokens: frozenset, fallback: int) -> list:
+        """按相关度排序，返回 key 列表"""
+        scores = defaultdict(float)
+        n_docs = len(index.doc_len)
+
+        # 关键词得分（TF-IDF，按文档长度归一）
+        for token in tokens:
+            postings = index.postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + n_docs / len(postings))
+            for key, tf in postings.items():
+                scores[key] += idf * tf / math.sqrt(index.doc_len[key])
+
+        # 向量得分
+        if index.vectors:
+            embedder = self._get_embedder()
+            if embedder:
+                try:
+                    q = embedder.encode([query], normalize_embeddings=True)[0]
+                    for key, vec in index.vectors.items():
+                        sim = sum(a * b for a, b in zip(q, vec))
+                        if sim > 0.3:
+                            scores[key] += sim
+                except Exception as e:
+                    logger.warning(f"查询向量编码失败: {e}")
+
+        if not scores:
+            # 没有相关记忆时，只带上最近更新的几条
+            return index.recency[:fallback]
+
+        # 同分时新的优先
+        order = {key: i for i, key in enumerate(index.recency)}
+        return sorted(scores, key=lambda k: (-scores[k], order.get(k, 0)))
+
+    def search(self, user_id: str, memories: dict, version: int, query: str,
+               top_k: int = 5, max_tokens: int = 300, fallback: int = 2) -> list:
+        """返回与 query 相关的记忆 [(key, value)]，数量不超过 top_k，总 token 不超过 max_tokens
+
+        version 是调用方复制 memories 时一起读取的版本号（见 version()）
+        """
+        if not memories:
+            return []
+
+        index = self._get_index(user_id, memories, version)
+        tokens = frozenset(tokenize(query))
+
+        # 只用关键词时排序只取决于 token 集合（大小写、标点、语序不同的消息也能命中缓存）；
+        # 向量得分取决于完整的原文，不缓存
+        cache_key = None if index.vectors else (user_id, version, fallback, tokens)
+        ranked = None
+        if cache_key is not None:
+            with self._lock:
+                ranked = self._rank_cache.get(cache_key)
+                if ranked is not None:
+                    self._rank_cache.move_to_end(cache_key)
+                    CACHE_HITS.inc(cache="memory_rank")
+
+        if ranked is None:
+            ranked = self._rank(index, query, tokens, fallback)
+            if cache_key is not None:
+                CACHE_MISSES.inc(cache="memory_rank")
+                with self._lock:
+                    self._rank_cache[cache_key] = ranked
+                    while len(self._rank_cache) > self.cache_size:
+                        self._rank_cache.popitem(last=False)
+
+        results = []
+        used_tokens = 0
+        for key in ranked:
+            if len(results) >= top_k:
+                break
+            data = memories.get(key)
+            if data is None:
+                continue
+            cost = estimate_tokens(f"- {key}: {data.value}")
+            if used_tokens + cost > max_tokens:
+                continue
+            used_tokens += cost
+            results.append((key, data.value))
+
+        return results
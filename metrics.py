@@ -0,0 +1,262 @@
+"""
+运行指标模块
+Prometheus 文本格式的计数器 / 仪表 / 直方图，并通过本地 HTTP 端口暴露（/metrics）
+"""
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from loguru import logger
+
+# 默认延迟分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    """指标基类"""
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, "") for n in self.label_names)
+
+    def label_sets(self) -> list:
+        """已经记录过的标签组合 [{标签名: 值}]"""
+        with self._lock:
+            keys = list(self._values)
+        return [dict(zip(self.label_names, key)) for key in keys]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> list:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """计数器（只增不减）"""
+
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """仪表（可增可减，也可以在采集时通过回调取值）"""
+
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+        self._callbacks = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def set_function(self, func, **labels):
+        """采集时调用 func() 取值（用于缓存大小等）"""
+        with self._lock:
+            self._callbacks[self._key(labels)] = func
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+            callbacks = list(self._callbacks.items())
+        for key, func in callbacks:
+            try:
+                items.append((key, func()))
+            except Exception as e:
+                logger.debug(f"指标回调失败 [{self.name}]: {e}")
+        return [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in items]
+
+
+class Histogram(_Metric):
+    """直方图（用于延迟分布，可据此计算 p50/p95/p99）"""
+
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # {labels: [各分桶计数..., +Inf 计数, 总和]}
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * (len(self.buckets) + 2)
+            data[index] += 1
+            data[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """计时上下文：with HISTOGRAM.time(label=...):"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self, **labels) -> tuple:
+        """返回 (分桶上限, 各桶累计计数, 总数, 总和)"""
+        with self._lock:
+            data = list(self._values.get(self._key(labels), [0] * (len(self.buckets) + 2)))
+        cumulative = []
+        total = 0
+        for count in data[:-1]:
+            total += count
+            cumulative.append(total)
+        return self.buckets, cumulative, total, data[-1]
+
+    def percentile(self, q: float, **labels) -> float:
+        """根据分桶估算分位数（取所在分桶上限）"""
+        buckets, cumulative, total, _ = self.snapshot(**labels)
+        if total == 0:
+            return 0.0
+        rank = q * total
+        for upper, count in zip(buckets + (float("inf"),), cumulative):
+            if count >= rank:
+                return upper
+        return float("inf")
+
+    def _samples(self):
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        lines = []
+        for key, data in items:
+            cumulative = 0
+            for upper, count in zip(self.buckets + ("+Inf",), data[:-1]):
+                cumulative += count
+                le = f'le="{upper}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{labels} {data[-1]}")
+        return lines
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# 当前请求的开始时间（perf_counter），用于统计首条回复耗时
+REQUEST_START = contextvars.ContextVar("request_start", default=None)
+
+# ========== 指标定义 ==========
+HANDLER_LATENCY = Histogram("bot_handler_latency_seconds", "处理一条更新的端到端耗时", ["handler"])
+MODEL_LATENCY = Histogram("bot_model_latency_seconds", "单次模型调用耗时", ["model"])
+FIRST_SEGMENT_LATENCY = Histogram("bot_time_to_first_segment_seconds", "从收到消息到发出第一条回复的耗时")
+DISK_SAVE_LATENCY = Histogram(
+    "bot_disk_save_seconds", "写盘耗时", ["store"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+)
+GROUP_SCAN_LATENCY = Histogram(
+    "bot_group_get_messages_seconds", "GroupMonitor.get_messages 扫描耗时",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+
+RETRIES = Counter("bot_retries_total", "重试次数", ["operation"])
+CACHE_HITS = Counter("bot_cache_hits_total", "缓存命中次数", ["cache"])
+CACHE_MISSES = Counter("bot_cache_misses_total", "缓存未命中次数", ["cache"])
+ERRORS = Counter("bot_errors_total", "错误次数", ["where", "type"])
+TOKENS = Counter("bot_tokens_total", "模型消耗的 token 数", ["model", "type"])
+
+IN_FLIGHT = Gauge("bot_in_flight_requests", "正在处理的更新数", ["handler"])
+CACHE_SIZE = Gauge("bot_cache_size", "缓存大小（条目数）", ["cache"])
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """/metrics 请求处理"""
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1"):
+    """在后台线程启动指标 HTTP 服务，port 为 0 时不启动"""
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.warning(f"指标服务启动失败 ({host}:{port}): {e}")
+        return None
+
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logger.info(f"✓ 指标服务已启动: http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,230 @@
+"""
+数据模型模块
+对话历史、群消息、记忆和用户统计在内存中的紧凑表示（slots 数据类，时间统一用 epoch 秒）；
+只在读写文件时和文件里的 dict（ISO 时间字符串）互相转换
+"""
+from array import array
+from dataclasses import dataclass, field
+from datetime import date, datetime
+
+
+def to_epoch(value) -> float:
+    """ISO 时间字符串（旧数据）或 epoch 秒 -> epoch 秒"""
+    if isinstance(value, str):
+        return datetime.fromisoformat(value).timestamp()
+    return value
+
+
+def to_iso(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).isoformat()
+
+
+@dataclass(slots=True)
+class Turn:
+    """对话历史中的一条消息"""
+    role: str
+    content: str
+
+    def to_dict(self) -> dict:
+        """转成文件和 API 请求中的格式"""
+        return {"role": self.role, "content": self.content}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Turn":
+        return cls(data["role"], data["content"])
+
+
+@dataclass(slots=True)
+class GroupMessage:
+    """一条群消息（时间戳是整数秒，用户名和用户 ID 由 GroupMonitor 驻留）"""
+    timestamp: int
+    user_id: int
+    username: str
+    message: str
+
+    def to_dict(self) -> dict:
+        """转成文件中的格式"""
+        return {
+            "user_id": self.user_id,
+            "username": self.username,
+            "message": self.message,
+            "timestamp": to_iso(self.timestamp)
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "GroupMessage":
+        return cls(int(to_epoch(data["timestamp"])), data["user_id"], data["username"], data["message"])
+
+    def to_row(self) -> list:
+        """转成预写日志中的格式"""
+        return [self.timestamp, self.user_id, self.username, self.message]
+
+
+@dataclass(slots=True)
+class MemoryEntry:
+    """一条记忆"""
+    value: str
+    created_at: float
+    updated_at: float
+
+    def to_dict(self) -> dict:
+        return {"value": self.value, "created_at": to_iso(self.created_at), "updated_at": to_iso(self.updated_at)}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "MemoryEntry":
+        # 很早的数据可能没有时间
+        created_at = to_epoch(data.get("created_at") or 0)
+        return cls(data["value"], created_at, to_epoch(data.get("updated_at") or created_at))
+
+
+def _week_key(day: int) -> str:
+    """日期序号 -> 所在周周一的日期字符串"""
+    monday = date.fromordinal(day - date.fromordinal(day).weekday())
+    return monday.isoformat()
+
+
+@dataclass(slots=True)
+class DailyCounts:
+    """按天计数的时间序列
+
+    最近的天数按天存在数组里（counts[i] 是 start + i 那天的计数，start 是日期序号），
+    更早的按周（weeks，键是周一的日期）、再早的按月（months，键是 YYYY-MM）合并，文件大小不会一直增长
+    """
+    start: int = 0
+    counts: array = field(default_factory=lambda: array("I"))
+    weeks: dict = field(default_factory=dict)
+    months: dict = field(default_factory=dict)
+
+    def add(self, day: int, n: int = 1):
+        """给某天（日期序号）加上 n"""
+        counts = self.counts
+        if not counts:
+            self.start = day
+        index = day - self.start
+        if index < 0:
+            # 比数组开头还早（只有导入旧数据时会出现），在前面补零
+            counts[0:0] = array("I", [0]) * -index
+            self.start = day
+            index = 0
+        elif index >= len(counts):
+            counts.extend(array("I", [0]) * (index - len(counts) + 1))
+        counts[index] += n
+
+    def get(self, day: int) -> int:
+        index = day - self.start
+        return self.counts[index] if 0 <= index < len(self.counts) else 0
+
+    def rollup(self, today: int, keep_days: int, keep_weeks: int):
+        """超过 keep_days 天的按天计数合并成周，超过 keep_weeks 周的再合并成月"""
+        cut = min(today - keep_days + 1 - self.start, len(self.counts))
+        if cut <= 0:
+            return
+        weeks = self.weeks
+        for i, count in enumerate(self.counts[:cut]):
+            if count:
+                key = _week_key(self.start + i)
+                weeks[key] = weeks.get(key, 0) + count
+        del self.counts[:cut]
+        self.start += cut
+
+        # 周只会在上面新增，所以只在这里检查要不要合并成月
+        week_cutoff = _week_key(today - 7 * keep_weeks)
+        for key in [key for key in weeks if key < week_cutoff]:
+            month = key[:7]
+            self.months[month] = self.months.get(month, 0) + weeks.pop(key)
+
+    def recent(self, today: int, days: int) -> list:
+        """最近 days 天（含今天）每天的计数 [(日期, 计数)]，已经合并成周的天算作 0"""
+        return [(date.fromordinal(day).isoformat(), self.get(day)) for day in range(today - days + 1, today + 1)]
+
+    def total(self) -> int:
+        return sum(self.counts) + sum(self.weeks.values()) + sum(self.months.values())
+
+    def to_dict(self) -> dict:
+        return {
+            "start": date.fromordinal(self.start).isoformat() if self.counts else None,
+            "counts": self.counts.tolist(),
+            "weeks": dict(self.weeks),
+            "months": dict(self.months)
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DailyCounts":
+        start = data.get("start")
+        return cls(
+            start=date.fromisoformat(start).toordinal() if start else 0,
+            counts=array("I", data.get("counts", [])),
+            weeks=data.get("weeks", {}),
+            months=data.get("months", {})
+        )
+
+    @classmethod
+    def from_legacy(cls, daily: dict) -> "DailyCounts":
+        """旧格式 {YYYY-MM-DD: 计数} -> DailyCounts"""
+        series = cls()
+        for day, count in sorted(daily.items()):
+            series.add(date.fromisoformat(day).toordinal(), count)
+        return series
+
+
+@dataclass(slots=True)
+class GroupStats:
+    """一个群的消息量统计"""
+    title: str = ""
+    daily: DailyCounts = field(default_factory=DailyCounts)
+
+    def to_dict(self) -> dict:
+        return {"title": self.title, "daily": self.daily.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "GroupStats":
+        return cls(data.get("title", ""), DailyCounts.from_dict(data["daily"]))
+
+
+@dataclass(slots=True)
+class UserStats:
+    """一个用户的使用统计（最常用的人设随计数增量维护）"""
+    first_use: float
+    last_use: float
+    total_messages: int = 0
+    total_conversations: int = 0
+    persona_usage: dict = field(default_factory=dict)
+    favorite_persona: str = ""
+    daily: DailyCounts = field(default_factory=DailyCounts)
+
+    def add_persona(self, persona_key: str):
+        usage = self.persona_usage
+        count = usage[persona_key] = usage.get(persona_key, 0) + 1
+        if persona_key != self.favorite_persona and count > usage.get(self.favorite_persona, 0):
+            self.favorite_persona = persona_key
+
+    def to_dict(self) -> dict:
+        return {
+            "total_messages": self.total_messages,
+            "total_conversations": self.total_conversations,
+            "first_use": to_iso(self.first_use),
+            "last_use": to_iso(self.last_use),
+            "persona_usage": dict(self.persona_usage),
+            "favorite_persona": self.favorite_persona,
+            "daily": self.daily.to_dict()
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "UserStats":
+        persona_usage = data.get("persona_usage", {})
+        favorite_persona = data.get("favorite_persona")
+        if favorite_persona is None:
+            favorite_persona = max(persona_usage.items(), key=lambda x: x[1])[0] if persona_usage else ""
+        if "daily" in data:
+            daily = DailyCounts.from_dict(data["daily"])
+        else:
+            daily = DailyCounts.from_legacy(data.get("daily_messages", {}))
+        return cls(
+            first_use=to_epoch(data["first_use"]),
+            last_use=to_epoch(data["last_use"]),
+            total_messages=data.get("total_messages", 0),
+            total_conversations=data.get("total_conversations", 0),
+            persona_usage=persona_usage,
+            favorite_persona=favorite_persona,
+            daily=daily
+        )
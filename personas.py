@@ -7,6 +7,7 @@ PERSONAS = {
     "小高": {
         "name": "小高同学",
         "description": "随意自然的男生，像朋友一样聊天",
+        "pacing": {"min_delay": 0.4, "per_char": 0.05, "max_delay": 1.5},
         "prompt": """你是小高同学，像普通人一样聊天。
 
 【严格禁止】
@@ -47,6 +48,7 @@ PERSONAS = {
     "丰子": {
         "name": "丰子",
         "description": "温柔体贴的女生，聊天温和自然",
+        "pacing": {"min_delay": 0.5, "per_char": 0.05, "max_delay": 1.5},
         "prompt": """你是丰子，一个温柔的女生，聊天时比较温和体贴。
 
 【严格禁止】
@@ -94,6 +96,7 @@ PERSONAS = {
     "小助手": {
         "name": "小助手",
         "description": "专业高效的AI助理，帮你解决问题",
+        "pacing": {"min_delay": 0, "per_char": 0, "max_delay": 0},
         "prompt": """你是小助手，一个专业高效的AI助理。
 
 【严格禁止】
@@ -133,6 +136,7 @@ PERSONAS = {
     "逗比": {
         "name": "逗比",
         "description": "幽默搞笑，聊天轻松愉快",
+        "pacing": {"min_delay": 0.2, "per_char": 0.03, "max_delay": 1.0},
         "prompt": """你是逗比，一个幽默搞笑的家伙。
 
 【严格禁止】
@@ -172,6 +176,7 @@ PERSONAS = {
     "学霸": {
         "name": "学霸",
         "description": "知识渊博，严谨专业，擅长解答问题",
+        "pacing": {"min_delay": 0.1, "per_char": 0.01, "max_delay": 0.5},
         "prompt": """你是学霸，知识渊博，严谨专业。
 
 【严格禁止】
@@ -212,12 +217,20 @@ PERSONAS = {
 # 默认人设
 DEFAULT_PERSONA = "丰子"
 
+# 默认分条发送节奏（秒）：min_delay + per_char * 字数，不超过 max_delay
+DEFAULT_PACING = {"min_delay": 0.3, "per_char": 0.03, "max_delay": 1.0}
+
 
 def get_persona(persona_key: str) -> dict:
     """获取人设配置"""
     return PERSONAS.get(persona_key, PERSONAS[DEFAULT_PERSONA])
 
 
+def get_pacing(persona_key: str) -> dict:
+    """获取人设的分条发送节奏"""
+    return get_persona(persona_key).get("pacing", DEFAULT_PACING)
+
+
 def get_persona_list() -> str:
     """获取人设列表的文本描述"""
     lines = ["📋 可用人设：\n"]
@@ -0,0 +1,101 @@
+"""
+采样分析器
+定时抓取所有线程（事件循环 + 线程池）的调用栈，输出 flamegraph 可用的折叠栈文件
+
+折叠栈格式：每行 "线程;函数1;函数2;... 次数"，可直接用 flamegraph.pl 或 speedscope 打开
+"""
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from loguru import logger
+
+
+def _thread_label(name: str) -> str:
+    """线程名归类：同一个线程池的工作线程合并在一起（ThreadPoolExecutor-0_3 -> ThreadPoolExecutor-0）"""
+    return re.sub(r"_\d+$", "", name)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """采样分析器（后台线程运行，一次只能有一个采样任务）"""
+
+    def __init__(self, interval: float = 0.005, output_dir: str = "profiles"):
+        self.interval = interval
+        self.output_dir = output_dir
+        self.samples = Counter()
+        self.output_file = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: float) -> str:
+        """开始采样，返回输出文件路径（采样结束后写入）"""
+        if self.running:
+            raise RuntimeError("已有采样任务在运行")
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.output_file = os.path.join(
+            self.output_dir, f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.collapsed"
+        )
+        self.samples = Counter()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(seconds,), name="profiler", daemon=True)
+        self._thread.start()
+        logger.info(f"🔬 开始采样分析 {seconds}s（间隔 {self.interval * 1000:.0f}ms）")
+        return self.output_file
+
+    def stop(self):
+        """提前结束采样"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _run(self, seconds: float):
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(_thread_label(names.get(thread_id, str(thread_id))))
+                self.samples[";".join(reversed(stack))] += 1
+            self._stop.wait(self.interval)
+
+        self._write()
+
+    def _write(self):
+        try:
+            with open(self.output_file, "w", encoding="utf-8") as f:
+                for stack, count in self.samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            logger.info(f"✓ 采样完成，共 {sum(self.samples.values())} 个样本: {self.output_file}")
+        except Exception as e:
+            logger.error(f"写入采样结果失败: {e}")
+
+    def top_functions(self, limit: int = 10) -> list:
+        """按自身耗时（栈顶出现次数）排序的热点函数 [(函数, 占比)]"""
+        total = sum(self.samples.values())
+        if not total:
+            return []
+
+        leaf = Counter()
+        for stack, count in self.samples.items():
+            leaf[stack.rsplit(";", 1)[-1]] += count
+        return [(name, count / total) for name, count in leaf.most_common(limit)]
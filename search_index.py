@@ -0,0 +1,275 @@
+"""
+群消息全文索引模块
+按 (群, 日期) 分段的倒排索引，中文按二元组分词；新消息实时加入，随群消息一起落盘
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from loguru import logger
+from text_utils import tokenize
+from storage import atomic_write_json
+import serialization
+from metrics import CACHE_HITS, CACHE_MISSES
+
+
+class _Segment:
+    """一个群一天的索引：消息列表 + 倒排表 {token: [消息序号]}"""
+
+    __slots__ = ("docs", "postings", "dirty")
+
+    def __init__(self, docs=None, postings=None):
+        # [[时间戳, 用户名, 内容]]
+        self.docs = docs or []
+        self.postings = postings or {}
+        self.dirty = False
+
+    def add(self, timestamp: int, username: str, text: str):
+        doc_id = len(self.docs)
+        self.docs.append([timestamp, username, text])
+        for token in set(tokenize(text)):
+            self.postings.setdefault(token, []).append(doc_id)
+        self.dirty = True
+
+    def candidates(self, tokens: set):
+        """所有 token 都出现的消息序号（从最短的倒排表开始求交集）"""
+        lists = []
+        for token in tokens:
+            ids = self.postings.get(token)
+            if ids is None and len(token) == 1:
+                # 单个汉字：索引里只有二元组，合并所有包含它的二元组
+                ids = sorted({i for key, values in self.postings.items() if token in key for i in values})
+            if not ids:
+                return set()
+            lists.append(ids)
+
+        lists.sort(key=len)
+        result = set(lists[0])
+        for ids in lists[1:]:
+            result.intersection_update(ids)
+            if not result:
+                break
+        return result
+
+
+class GroupSearchIndex:
+    """群消息倒排索引（分段存储，最近用过的分段缓存在内存）"""
+
+    def __init__(self, index_dir, cache_segments: int = 256):
+        self.index_dir = Path(index_dir)
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_segments = cache_segments
+
+        # 清单：每个群有哪些日期的分段，以及哪些群已经从历史文件补建过索引
+        self.manifest_file = self.index_dir / "manifest.json"
+        self.dates = {}
+        self.backfilled = set()
+        self._load_manifest()
+
+        # 分段缓存 {(chat_id, date): _Segment}，有未保存修改的分段不会被淘汰
+        self._segments = OrderedDict()
+        self._manifest_dirty = False
+        # 正在补建索引的群 {chat_id: [补建期间新加入的消息]}
+        self._rebuilding = {}
+        # 清理和补建在工作线程中进行，其余操作在事件循环中
+        self._lock = threading.RLock()
+
+    def _load_manifest(self):
+        if not self.manifest_file.exists():
+            return
+        try:
+            data = serialization.load_file(self.manifest_file)
+            self.dates = {int(chat_id): set(dates) for chat_id, dates in data["dates"].items()}
+            self.backfilled = set(data["backfilled"])
+        except Exception as e:
+            logger.warning(f"加载搜索索引清单失败，将重新建立索引: {e}")
+
+    def _save_manifest(self):
+        atomic_write_json(self.manifest_file, {
+            "dates": {str(chat_id): sorted(dates) for chat_id, dates in self.dates.items()},
+            "backfilled": sorted(self.backfilled),
+        })
+        self._manifest_dirty = False
+
+    def _segment_file(self, chat_id: int, date: str) -> Path:
+        return self.index_dir / f"{chat_id}_{date}.json"
+
+    def _get_segment(self, chat_id: int, date: str, create: bool = False):
+        key = (chat_id, date)
+        segment = self._segments.get(key)
+        if segment is not None:
+            CACHE_HITS.inc(cache="search_segment")
+            self._segments.move_to_end(key)
+            return segment
+
+        CACHE_MISSES.inc(cache="search_segment")
+        if date in self.dates.get(chat_id, ()):
+            try:
+                data = serialization.load_file(self._segment_file(chat_id, date))
+                segment = _Segment(data["docs"], data["postings"])
+            except Exception as e:
+                logger.error(f"读取搜索索引失败 [{chat_id} {date}]: {e}")
+                segment = _Segment() if create else None
+        elif create:
+            segment = _Segment()
+            self.dates.setdefault(chat_id, set()).add(date)
+            self._manifest_dirty = True
+
+        if segment is not None:
+            self._segments[key] = segment
+            self._evict()
+        return segment
+
+    def _evict(self):
+        """淘汰最久没用的干净分段"""
+        if len(self._segments) <= self.cache_segments:
+            return
+        for key in list(self._segments):
+            if len(self._segments) <= self.cache_segments:
+                break
+            if not self._segments[key].dirty:
+                del self._segments[key]
+
+    def is_backfilled(self, chat_id: int) -> bool:
+        return chat_id in self.backfilled
+
+    def add(self, chat_id: int, timestamp: int, username: str, text: str):
+        """索引一条新消息"""
+        if not text:
+            return
+        date = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+        with self._lock:
+            self._get_segment(chat_id, date, create=True).add(timestamp, username, text)
+            captured = self._rebuilding.get(chat_id)
+            if captured is not None:
+                captured.append((timestamp, username, text))
+
+    def rebuild(self, chat_id: int, load_rows) -> int:
+        """重建一个群的索引，返回从历史文件索引的消息数
+
+        load_rows() 返回 (已保存的消息, 缓存中还没保存的消息)，都是 [(时间戳, 用户名, 内容)]。
+        读文件、分词和写分段都在锁外进行，不阻塞事件循环里的 add；
+        调用 load_rows 之前就开始记录新加入的消息，最后和缓存里的消息一起合并进来
+        """
+        with self._lock:
+            if chat_id in self._rebuilding:
+                # 另一个线程正在补建
+                return 0
+            self._rebuilding[chat_id] = []
+
+        try:
+            rows, pending = load_rows()
+
+            segments = {}
+            for timestamp, username, text in rows:
+                if text:
+                    date = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+                    segments.setdefault(date, _Segment()).add(timestamp, username, text)
+            # 已保存的消息和文件一起落盘；缓存里的消息先只放在内存中，等群消息保存时再落盘
+            for date, segment in segments.items():
+                try:
+                    atomic_write_json(self._segment_file(chat_id, date),
+                                      {"docs": segment.docs, "postings": segment.postings})
+                    segment.dirty = False
+                except Exception as e:
+                    logger.error(f"保存搜索索引失败 [{chat_id} {date}]: {e}")
+        except BaseException:
+            with self._lock:
+                self._rebuilding.pop(chat_id, None)
+            raise
+
+        with self._lock:
+            # 缓存快照、补建期间新加入的消息和历史文件可能有重叠（扫描期间刚好落盘的），去重后合并
+            seen = set(rows)
+            for row in [*pending, *self._rebuilding.pop(chat_id)]:
+                timestamp, username, text = row
+                if not text or row in seen:
+                    continue
+                seen.add(row)
+                date = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+                segments.setdefault(date, _Segment()).add(timestamp, username, text)
+
+            # 换上新的分段
+            for date in self.dates.pop(chat_id, set()):
+                self._segments.pop((chat_id, date), None)
+                if date not in segments:
+                    self._segment_file(chat_id, date).unlink(missing_ok=True)
+            if segments:
+                self.dates[chat_id] = set(segments)
+            for date, segment in segments.items():
+                if segment.dirty:
+                    self._segments[(chat_id, date)] = segment
+            self.backfilled.add(chat_id)
+            try:
+                self._save_manifest()
+            except Exception as e:
+                self._manifest_dirty = True
+                logger.error(f"保存搜索索引清单失败: {e}")
+        return len(rows)
+
+    def mark_backfilled(self, chat_id: int):
+        """新群没有历史文件，不需要补建"""
+        with self._lock:
+            self.backfilled.add(chat_id)
+            self._manifest_dirty = True
+
+    def flush(self, chat_id: int = None):
+        """保存有修改的分段（不指定群则保存全部）"""
+        with self._lock:
+            for (segment_chat_id, date), segment in self._segments.items():
+                if not segment.dirty or (chat_id is not None and segment_chat_id != chat_id):
+                    continue
+                if segment_chat_id in self._rebuilding:
+                    # 补建完成时会整体换掉，不能让旧分段覆盖已经写好的新分段
+                    continue
+                try:
+                    atomic_write_json(self._segment_file(segment_chat_id, date),
+                                      {"docs": segment.docs, "postings": segment.postings})
+                    segment.dirty = False
+                except Exception as e:
+                    logger.error(f"保存搜索索引失败 [{segment_chat_id} {date}]: {e}")
+            if self._manifest_dirty:
+                try:
+                    self._save_manifest()
+                except Exception as e:
+                    logger.error(f"保存搜索索引清单失败: {e}")
+            self._evict()
+
+    def drop_before(self, chat_id: int, cutoff_date: str):
+        """删除某个日期之前的分段（随消息保留期限一起清理）"""
+        with self._lock:
+            dates = self.dates.get(chat_id, set())
+            for date in [d for d in dates if d < cutoff_date]:
+                dates.discard(date)
+                self._segments.pop((chat_id, date), None)
+                self._segment_file(chat_id, date).unlink(missing_ok=True)
+                self._manifest_dirty = True
+            if not dates:
+                self.dates.pop(chat_id, None)
+
+    def search(self, chat_id: int, query: str, limit: int = 10) -> list:
+        """搜索一个群的消息（所有关键词都要出现），按时间从新到旧返回"""
+        tokens = set(tokenize(query))
+        terms = [term for term in query.lower().split() if term]
+        if not tokens:
+            return []
+
+        results = []
+        with self._lock:
+            for date in sorted(self.dates.get(chat_id, ()), reverse=True):
+                segment = self._get_segment(chat_id, date)
+                if segment is None:
+                    continue
+                for doc_id in sorted(segment.candidates(tokens), reverse=True):
+                    timestamp, username, text = segment.docs[doc_id]
+                    # 二元组都命中不代表关键词连续出现，再确认一遍
+                    lowered = text.lower()
+                    if all(term in lowered for term in terms):
+                        results.append({
+                            "timestamp": datetime.fromtimestamp(timestamp).isoformat(),
+                            "username": username,
+                            "message": text
+                        })
+                        if len(results) >= limit:
+                            return results
+        return results
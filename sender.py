@@ -0,0 +1,145 @@
+"""
+消息发送模块
+统一的发送调度器：按 Telegram 限流规则（每个聊天 + 全局）控制发送速度，遇到 429 自动等待重试
+"""
+import asyncio
+import time
+from telegram.error import RetryAfter
+from loguru import logger
+from metrics import RETRIES, FIRST_SEGMENT_LATENCY, REQUEST_START
+
+
+def split_reply(reply: str) -> list:
+    """按 ||| 拆分回复为多条消息"""
+    if "|||" not in reply:
+        return [reply]
+    return [p.strip() for p in reply.split("|||") if p.strip()]
+
+
+class TokenBucket:
+    """令牌桶（预约式：令牌可以预支，返回需要等待的秒数）"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """预约一个令牌，返回需要等待的秒数"""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds: float):
+        """被限流后清空令牌，seconds 秒内不再发送"""
+        self._refill(time.monotonic())
+        # 预留下一次 reserve 消耗的令牌，使其正好等待 seconds 秒
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_idle(self) -> bool:
+        """令牌已回满（长时间没有发送）"""
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class SendScheduler:
+    """发送调度器
+
+    - 全局令牌桶：默认每秒 30 条（Telegram 全局限制）
+    - 每个聊天一个令牌桶：私聊每秒 1 条，群聊每分钟 20 条，允许少量突发
+    - 同一聊天内的消息按顺序发送，不同聊天之间并行
+    - 遇到 RetryAfter（429）按服务器要求等待后重试
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1.0,
+                 group_rate_per_min: float = 20, burst: int = 3, max_retries: int = 3):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate_per_min / 60
+        self.burst = burst
+        self.max_retries = max_retries
+
+        self._global = TokenBucket(global_rate, global_rate)
+        # {chat_id: TokenBucket}
+        self._chat_buckets = {}
+        # {chat_id: asyncio.Lock}，保证同一聊天内按顺序发送
+        self._chat_locks = {}
+
+    def _get_bucket(self, chat_id: int, is_group: bool) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # 清理长时间空闲的聊天，避免无限增长
+            if len(self._chat_buckets) > 10000:
+                self._prune()
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, self.burst)
+        return bucket
+
+    def _prune(self):
+        """删除空闲聊天的令牌桶和锁"""
+        for chat_id in [c for c, b in self._chat_buckets.items() if b.is_idle()]:
+            lock = self._chat_locks.get(chat_id)
+            if lock is None or not lock.locked():
+                self._chat_buckets.pop(chat_id, None)
+                self._chat_locks.pop(chat_id, None)
+
+    async def _send_one(self, send, bucket: TokenBucket, not_before: float):
+        """发送单条消息（等待令牌，429 时重试），send 是发起发送的协程函数"""
+        for attempt in range(self.max_retries + 1):
+            delay = max(bucket.reserve(), not_before - time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+            delay = self._global.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            try:
+                return await send()
+            except RetryAfter as e:
+                retry_after = float(e.retry_after)
+                bucket.pause(retry_after)
+                if attempt >= self.max_retries:
+                    raise
+                RETRIES.inc(operation="send")
+                logger.warning(f"触发 Telegram 限流，{retry_after}s 后重试 ({attempt + 1}/{self.max_retries})")
+
+    async def send_reply(self, message, reply: str, pacing: dict = None):
+        """发送回复（自动按 ||| 拆分为多条）
+
+        pacing 为人设的发送节奏：min_delay + per_char * 字数，不超过 max_delay。
+        节奏等待与限流等待取较大值，不会叠加。
+        """
+        chat = message.chat
+        chat_id = chat.id
+        is_group = chat.type in ["group", "supergroup"]
+        pacing = pacing or {}
+
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            bucket = self._get_bucket(chat_id, is_group)
+            not_before = 0.0
+            for i, part in enumerate(split_reply(reply)):
+                if i > 0:
+                    # 模拟打字时间：下一条越长，间隔越久
+                    gap = pacing.get("min_delay", 0) + pacing.get("per_char", 0) * len(part)
+                    not_before = last_sent + min(gap, pacing.get("max_delay", gap))
+                await self._send_one(lambda part=part: message.reply_text(part), bucket, not_before)
+                last_sent = time.monotonic()
+                if i == 0:
+                    started = REQUEST_START.get()
+                    if started is not None:
+                        FIRST_SEGMENT_LATENCY.observe(time.perf_counter() - started)
+
+    async def send_message(self, bot, chat_id: int, text: str, is_group: bool = True):
+        """主动发送消息（不是回复，如每日摘要），同样受限流控制"""
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            bucket = self._get_bucket(chat_id, is_group)
+            return await self._send_one(lambda: bot.send_message(chat_id, text), bucket, 0.0)
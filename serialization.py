@@ -0,0 +1,199 @@
+"""
+序列化模块
+所有持久化路径共用的 JSON 编解码：装了 orjson 或 msgspec 时自动使用，没有就用标准库 json。
+三种后端写出的都是普通的 UTF-8 JSON，文件可以互相读取；装了 msgspec 时，按下面的结构定义解码并校验
+"""
+import json
+from typing import NotRequired, Optional, TypedDict
+from loguru import logger
+from config import SERIALIZATION_BACKEND
+
+try:
+    import orjson
+except ImportError:  # 可选
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # 可选
+    msgspec = None
+
+
+# ---------- 文件结构 ----------
+
+class HistoryRecord(TypedDict):
+    """对话历史中的一条消息（chat_history/<user>.jsonl 的一行）"""
+    role: str
+    content: str
+
+
+class DailyCountsRecord(TypedDict):
+    """按天计数的时间序列（最近按天，更早按周、按月）"""
+    start: Optional[str]
+    counts: list[int]
+    weeks: dict[str, int]
+    months: dict[str, int]
+
+
+class UserStatsRecord(TypedDict):
+    """一个用户的使用统计"""
+    total_messages: int
+    total_conversations: int
+    first_use: str
+    last_use: str
+    persona_usage: dict[str, int]
+    favorite_persona: NotRequired[str]
+    daily: NotRequired[DailyCountsRecord]
+    # 旧格式 {YYYY-MM-DD: 计数}
+    daily_messages: NotRequired[dict[str, int]]
+
+
+class GroupStatsRecord(TypedDict):
+    """一个群的消息量统计"""
+    title: str
+    daily: DailyCountsRecord
+
+
+class StatsRecord(TypedDict):
+    """使用统计文件（chat_history/stats.json）"""
+    users: dict[str, UserStatsRecord]
+    daily_totals: DailyCountsRecord
+    persona_totals: NotRequired[dict[str, int]]
+    daily_active: NotRequired[dict[str, int]]
+    weekly_active: NotRequired[dict[str, int]]
+    groups: NotRequired[dict[str, GroupStatsRecord]]
+
+
+class MemoryRecord(TypedDict):
+    """一条记忆（chat_history/memories/<user>.json 的值）"""
+    value: str
+    created_at: NotRequired[str]
+    updated_at: NotRequired[str]
+
+
+class GroupMessageRecord(TypedDict):
+    """一条群消息（group_messages/<chat>_<date>.json 的元素）"""
+    user_id: int
+    username: str
+    message: Optional[str]
+    timestamp: str
+
+
+HISTORY = list[HistoryRecord]
+STATS = StatsRecord
+# 旧版 chat_history/user_stats.json
+LEGACY_STATS = dict[str, UserStatsRecord]
+MEMORIES = dict[str, MemoryRecord]
+GROUP_MESSAGES = list[GroupMessageRecord]
+
+
+# ---------- 后端 ----------
+
+class _StdlibBackend:
+    name = "json"
+
+    @staticmethod
+    def dumps(obj, pretty: bool = False) -> bytes:
+        if pretty:
+            return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+class _OrjsonBackend:
+    name = "orjson"
+
+    @staticmethod
+    def dumps(obj, pretty: bool = False) -> bytes:
+        # 和标准库一样允许整数作为字典的键
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+        return orjson.dumps(obj, option=option)
+
+    @staticmethod
+    def loads(data):
+        return orjson.loads(data)
+
+
+class _MsgspecBackend:
+    name = "msgspec"
+
+    _encoder = None
+
+    @classmethod
+    def dumps(cls, obj, pretty: bool = False) -> bytes:
+        if cls._encoder is None:
+            cls._encoder = msgspec.json.Encoder()
+        data = cls._encoder.encode(obj)
+        return msgspec.json.format(data, indent=2) if pretty else data
+
+    @staticmethod
+    def loads(data):
+        return msgspec.json.decode(data)
+
+
+_BACKENDS = {"json": _StdlibBackend}
+if orjson is not None:
+    _BACKENDS["orjson"] = _OrjsonBackend
+if msgspec is not None:
+    _BACKENDS["msgspec"] = _MsgspecBackend
+
+
+def available_backends() -> list:
+    return list(_BACKENDS)
+
+
+def get_backend(name: str = "auto"):
+    """按名字取后端；auto 依次选 orjson、msgspec、json"""
+    if name == "auto":
+        for candidate in ("orjson", "msgspec", "json"):
+            if candidate in _BACKENDS:
+                return _BACKENDS[candidate]
+    if name not in _BACKENDS:
+        logger.warning(f"序列化后端 {name} 不可用，改用标准库 json")
+        return _StdlibBackend
+    return _BACKENDS[name]
+
+
+_backend = get_backend(SERIALIZATION_BACKEND)
+BACKEND = _backend.name
+
+# 解码失败时可能抛出的异常（orjson 的异常是 ValueError 的子类）
+DecodeError = (ValueError, msgspec.DecodeError) if msgspec is not None else (ValueError,)
+
+# 按结构解码的解码器（只有 msgspec 支持，按类型缓存）
+_decoders = {}
+
+
+def dumps(obj, pretty: bool = False) -> bytes:
+    """编码成 UTF-8 JSON（非 ASCII 字符不转义）"""
+    return _backend.dumps(obj, pretty)
+
+
+def dumps_line(obj) -> str:
+    """编码成一行紧凑的 JSON（追加写的日志用）"""
+    return _backend.dumps(obj).decode("utf-8") + "\n"
+
+
+def loads(data, schema=None):
+    """解码 JSON；装了 msgspec 且给了结构时顺带校验，结果仍然是普通的 dict / list
+
+    校验不通过时只记警告，按普通 JSON 解码（不能因为多了或少了字段就丢掉数据）
+    """
+    if schema is not None and msgspec is not None and _backend is not _StdlibBackend:
+        decoder = _decoders.get(schema)
+        if decoder is None:
+            decoder = _decoders[schema] = msgspec.json.Decoder(schema)
+        try:
+            return decoder.decode(data)
+        except msgspec.ValidationError as e:
+            logger.warning(f"数据格式和预期不一致，按普通 JSON 读取: {e}")
+    return _backend.loads(data)
+
+
+def load_file(path, schema=None):
+    """读取并解码一个 JSON 文件"""
+    with open(path, "rb") as f:
+        return loads(f.read(), schema)
@@ -2,79 +2,317 @@
 用户统计模块
 记录和查询用户使用统计数据
 """
-import json
+import heapq
+import threading
+import time
+from operator import itemgetter
 from pathlib import Path
-from datetime import datetime
-from collections import Counter
+from datetime import date, datetime
 from loguru import logger
+from config import STATS_FLUSH_INTERVAL, STATS_DAILY_DAYS, STATS_WEEKLY_WEEKS
+from storage import atomic_write
+import serialization
+from models import DailyCounts, GroupStats, UserStats
+from metrics import DISK_SAVE_LATENCY
+from tracing import span
 
 
 class StatsManager:
-    """统计管理器"""
+    """统计管理器（延迟写入：修改只标记为脏，定期或关闭时落盘）
     
-    def __init__(self, stats_dir="chat_history"):
+    存储结构（chat_history/stats.json）：
+    - users         每个用户的统计，每日消息数按天 / 周 / 月分级计数
+    - daily_totals  所有用户每天的消息总数
+    - persona_totals / daily_active / weekly_active / groups
+                    人设使用总数、每天 / 每周活跃用户数、每个群的消息量
+    全局的计数都在写入时顺带更新，看板查询不用遍历用户
+    """
+    
+    def __init__(self, stats_dir="chat_history", flush_interval=STATS_FLUSH_INTERVAL,
+                 keep_days=STATS_DAILY_DAYS, keep_weeks=STATS_WEEKLY_WEEKS, group_window_days=7):
         self.stats_dir = Path(stats_dir)
         self.stats_dir.mkdir(exist_ok=True)
-        self.stats_file = self.stats_dir / "user_stats.json"
-        self.stats = self._load_stats()
+        self.stats_file = self.stats_dir / "stats.json"
+        # 旧版格式（启动时自动迁移）
+        self.legacy_file = self.stats_dir / "user_stats.json"
+        self.keep_days = keep_days
+        self.keep_weeks = keep_weeks
+        
+        self.flush_interval = flush_interval
+        self._dirty = False
+        self._last_save = time.monotonic()
+        # 保护 self.stats（聊天在线程池中并发记录）
+        self._lock = threading.Lock()
+        # 保证同一时间只有一个线程在写文件
+        self._save_lock = threading.Lock()
+        
+        self.stats = {}
+        self.daily_totals = DailyCounts()
+        # 所有用户的人设使用次数 {persona_key: 次数}
+        self.persona_totals = {}
+        # 活跃用户数 {YYYY-MM-DD: 人数}、{周一的日期: 人数}
+        self.daily_active = {}
+        self.weekly_active = {}
+        # 群消息量 {chat_id: GroupStats}
+        self.groups = {}
+        # 最近 group_window_days 天每个群的消息数（写入时滚动更新，看板取最活跃的群时不用遍历所有群的按天计数）
+        # _group_window {chat_id: 窗口内总数}，_group_days {日期序号: {chat_id: 当天条数}}
+        self.group_window_days = group_window_days
+        self._group_window = {}
+        self._group_days = {}
+        # 保存时只重新转换有修改的用户和群，其余沿用上次转换好的结果
+        self._dirty_users = set()
+        self._dirty_groups = set()
+        self._user_records = {}
+        self._group_records = {}
+        self._load_stats()
+        self._init_group_window(date.today().toordinal())
+        if self._dirty:
+            self._save_stats()
+            if not self._dirty and self.legacy_file.exists():
+                self.legacy_file.replace(self.legacy_file.with_suffix(".json.bak"))
     
-    def _load_stats(self) -> dict:
+    def _load_stats(self):
         """加载统计数据"""
-        if self.stats_file.exists():
+        today = date.today().toordinal()
+        try:
+            if self.stats_file.exists():
+                data = serialization.load_file(self.stats_file, serialization.STATS)
+                stats = {user_id: UserStats.from_dict(user_stats) for user_id, user_stats in data["users"].items()}
+                daily_totals = DailyCounts.from_dict(data["daily_totals"])
+                groups = {int(chat_id): GroupStats.from_dict(group) for chat_id, group in data.get("groups", {}).items()}
+            elif self.legacy_file.exists():
+                stats, daily_totals = self._migrate_legacy()
+                data, groups = {}, {}
+            else:
+                return
+        except Exception as e:
+            logger.warning(f"加载统计数据失败: {e}")
+            return
+        
+        self.stats, self.daily_totals, self.groups = stats, daily_totals, groups
+        self._dirty_users, self._dirty_groups = set(stats), set(groups)
+        if "persona_totals" in data:
+            self.persona_totals = data["persona_totals"]
+            self.daily_active = data.get("daily_active", {})
+            self.weekly_active = data.get("weekly_active", {})
+        else:
+            self._backfill_totals(today)
+        
+        # 停机期间跨过的天数在这里合并
+        for series in [user_stats.daily for user_stats in stats.values()] + [group.daily for group in groups.values()]:
+            series.rollup(today, self.keep_days, self.keep_weeks)
+        daily_totals.rollup(today, self.keep_days, self.keep_weeks)
+        self._trim_active(today)
+    
+    def _backfill_totals(self, today: int):
+        """旧文件没有全局计数，从用户统计补算一次"""
+        monday = today - date.fromordinal(today).weekday()
+        day_key, week_key = date.fromordinal(today).isoformat(), date.fromordinal(monday).isoformat()
+        for user_stats in self.stats.values():
+            for persona_key, count in user_stats.persona_usage.items():
+                self.persona_totals[persona_key] = self.persona_totals.get(persona_key, 0) + count
+            if user_stats.daily.get(today):
+                self.daily_active[day_key] = self.daily_active.get(day_key, 0) + 1
+            if any(user_stats.daily.get(day) for day in range(monday, today + 1)):
+                self.weekly_active[week_key] = self.weekly_active.get(week_key, 0) + 1
+        self._dirty = True
+    
+    def _migrate_legacy(self) -> tuple:
+        """读取旧版 user_stats.json（每日消息数是一个不断增长的字典），顺带算出每日总数"""
+        legacy = serialization.load_file(self.legacy_file, serialization.LEGACY_STATS)
+        totals = {}
+        for user_stats in legacy.values():
+            for day, count in user_stats.get("daily_messages", {}).items():
+                totals[day] = totals.get(day, 0) + count
+        
+        stats = {user_id: UserStats.from_dict(user_stats) for user_id, user_stats in legacy.items()}
+        self._dirty = True
+        logger.info(f"已迁移 {len(stats)} 个用户的统计数据")
+        return stats, DailyCounts.from_legacy(totals)
+    
+    def _save_stats(self):
+        """保存统计数据
+        
+        锁内只把有修改的用户和群转换成字典（to_dict 返回的是副本），
+        序列化和原子写入都在锁外进行，不阻塞事件循环里的 record_group_message
+        """
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                for user_id in self._dirty_users:
+                    self._user_records[user_id] = self.stats[user_id].to_dict()
+                for chat_id in self._dirty_groups:
+                    self._group_records[str(chat_id)] = self.groups[chat_id].to_dict()
+                self._dirty_users.clear()
+                self._dirty_groups.clear()
+                record = {
+                    # 两个记录表只在持有 _save_lock 时修改，可以直接在锁外读
+                    "users": self._user_records,
+                    "daily_totals": self.daily_totals.to_dict(),
+                    "persona_totals": dict(self.persona_totals),
+                    "daily_active": dict(self.daily_active),
+                    "weekly_active": dict(self.weekly_active),
+                    "groups": self._group_records
+                }
+                self._dirty = False
+                self._last_save = time.monotonic()
+            
             try:
-                with open(self.stats_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                # 按天计数是长数组，缩进后每个数字占一行，所以写成紧凑格式
+                data = serialization.dumps(record)
+                with span("stats.save"), DISK_SAVE_LATENCY.time(store="stats"):
+                    atomic_write(self.stats_file, data)
             except Exception as e:
-                logger.warning(f"加载统计数据失败: {e}")
-                return {}
-        return {}
+                with self._lock:
+                    self._dirty = True
+                logger.error(f"保存统计数据失败: {e}")
     
-    def _save_stats(self):
-        """保存统计数据"""
-        try:
-            with open(self.stats_file, 'w', encoding='utf-8') as f:
-                json.dump(self.stats, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"保存统计数据失败: {e}")
+    def _mark_dirty(self):
+        """标记有修改（调用时需持有 self._lock）；距上次保存超过间隔时顺带保存"""
+        self._dirty = True
+        return time.monotonic() - self._last_save >= self.flush_interval
+    
+    def flush(self):
+        """把未保存的修改写入磁盘"""
+        self._save_stats()
     
     def _init_user_stats(self, user_id: str):
         """初始化用户统计"""
         if user_id not in self.stats:
-            self.stats[user_id] = {
-                "total_messages": 0,
-                "total_conversations": 0,
-                "first_use": datetime.now().isoformat(),
-                "last_use": datetime.now().isoformat(),
-                "persona_usage": {},
-                "daily_messages": {}
-            }
+            now = time.time()
+            self.stats[user_id] = UserStats(first_use=now, last_use=now)
     
     def record_message(self, user_id: str, persona_key: str):
         """记录一次消息"""
-        self._init_user_stats(user_id)
-        
-        user_stats = self.stats[user_id]
-        user_stats["total_messages"] += 1
-        user_stats["last_use"] = datetime.now().isoformat()
+        today = date.today().toordinal()
+        with self._lock:
+            self._init_user_stats(user_id)
+            
+            user_stats = self.stats[user_id]
+            self._dirty_users.add(user_id)
+            user_stats.total_messages += 1
+            user_stats.last_use = time.time()
+            
+            # 今天的第一条消息：计入活跃用户数
+            if not user_stats.daily.get(today):
+                self._record_active(user_stats, today)
+            
+            # 记录人设使用（顺带更新最常用的人设）
+            user_stats.add_persona(persona_key)
+            self.persona_totals[persona_key] = self.persona_totals.get(persona_key, 0) + 1
+            
+            # 记录每日消息数（跨天时把过期的按天计数合并）
+            for series in (user_stats.daily, self.daily_totals):
+                series.add(today)
+                series.rollup(today, self.keep_days, self.keep_weeks)
+            
+            due = self._mark_dirty()
         
-        # 记录人设使用
-        if persona_key not in user_stats["persona_usage"]:
-            user_stats["persona_usage"][persona_key] = 0
-        user_stats["persona_usage"][persona_key] += 1
-        
-        # 记录每日消息数
-        today = datetime.now().strftime("%Y-%m-%d")
-        if today not in user_stats["daily_messages"]:
-            user_stats["daily_messages"][today] = 0
-        user_stats["daily_messages"][today] += 1
+        if due:
+            self._save_stats()
+    
+    def _record_active(self, user_stats: UserStats, today: int):
+        """用户今天第一次发消息时调用（调用时需持有 self._lock）：计入当天和本周的活跃用户数"""
+        day_key = date.fromordinal(today).isoformat()
+        if day_key not in self.daily_active:
+            self._trim_active(today)
+        self.daily_active[day_key] = self.daily_active.get(day_key, 0) + 1
         
-        self._save_stats()
+        # 本周之前几天都没发过消息，才算本周新增的活跃用户
+        monday = today - date.fromordinal(today).weekday()
+        if not any(user_stats.daily.get(day) for day in range(monday, today)):
+            week_key = date.fromordinal(monday).isoformat()
+            self.weekly_active[week_key] = self.weekly_active.get(week_key, 0) + 1
+    
+    def _trim_active(self, today: int):
+        """活跃用户数和按天计数保留同样长的时间"""
+        day_cutoff = date.fromordinal(today - self.keep_days + 1).isoformat()
+        week_cutoff = date.fromordinal(today - 7 * self.keep_weeks).isoformat()
+        self.daily_active = {day: count for day, count in self.daily_active.items() if day >= day_cutoff}
+        self.weekly_active = {week: count for week, count in self.weekly_active.items() if week >= week_cutoff}
+    
+    def _init_group_window(self, today: int):
+        """启动时从按天计数算出最近几天每个群的消息数"""
+        for day in range(today - self.group_window_days + 1, today + 1):
+            counts = {chat_id: group.daily.get(day) for chat_id, group in self.groups.items() if group.daily.get(day)}
+            if counts:
+                self._group_days[day] = counts
+                for chat_id, count in counts.items():
+                    self._group_window[chat_id] = self._group_window.get(chat_id, 0) + count
+    
+    def _roll_group_window(self, today: int):
+        """把滑出窗口的那几天从群消息数里减掉（调用时需持有 self._lock）"""
+        cutoff = today - self.group_window_days + 1
+        for day in [day for day in self._group_days if day < cutoff]:
+            for chat_id, count in self._group_days.pop(day).items():
+                left = self._group_window[chat_id] - count
+                if left:
+                    self._group_window[chat_id] = left
+                else:
+                    del self._group_window[chat_id]
+    
+    def record_group_message(self, chat_id: int, title: str = ""):
+        """记录一条群消息（在事件循环中调用，只计数，由定时任务落盘）"""
+        today = date.today().toordinal()
+        with self._lock:
+            group = self.groups.get(chat_id)
+            if group is None:
+                group = self.groups[chat_id] = GroupStats()
+            if title:
+                group.title = title
+            group.daily.add(today)
+            group.daily.rollup(today, self.keep_days, self.keep_weeks)
+            
+            if today not in self._group_days:
+                self._roll_group_window(today)
+            counts = self._group_days.setdefault(today, {})
+            counts[chat_id] = counts.get(chat_id, 0) + 1
+            self._group_window[chat_id] = self._group_window.get(chat_id, 0) + 1
+            
+            self._dirty_groups.add(chat_id)
+            self._dirty = True
     
     def record_conversation(self, user_id: str):
         """记录一次对话（首次消息）"""
-        self._init_user_stats(user_id)
-        self.stats[user_id]["total_conversations"] += 1
-        self._save_stats()
+        with self._lock:
+            self._init_user_stats(user_id)
+            self.stats[user_id].total_conversations += 1
+            self._dirty_users.add(user_id)
+            due = self._mark_dirty()
+        
+        if due:
+            self._save_stats()
+    
+    def get_daily_totals(self, days: int = 30) -> list:
+        """所有用户最近 days 天每天的消息总数 [(日期, 条数)]"""
+        with self._lock:
+            return self.daily_totals.recent(date.today().toordinal(), days)
+    
+    def get_overview(self, days: int = 7, top_groups: int = 5) -> dict:
+        """全局概览（管理员看板）：活跃用户、消息量、人设分布、最活跃的群
+
+        最活跃的群按最近 group_window_days 天的消息数排，只在最近有消息的群里挑
+        """
+        today = date.today().toordinal()
+        monday = today - date.fromordinal(today).weekday()
+        window = range(today - days + 1, today + 1)
+        with self._lock:
+            self._roll_group_window(today)
+            top = heapq.nlargest(top_groups, self._group_window.items(), key=itemgetter(1))
+            return {
+                "total_users": len(self.stats),
+                "dau": self.daily_active.get(date.fromordinal(today).isoformat(), 0),
+                "wau": self.weekly_active.get(date.fromordinal(monday).isoformat(), 0),
+                "messages_today": self.daily_totals.get(today),
+                "messages_window": sum(self.daily_totals.get(day) for day in window),
+                "persona_usage": dict(sorted(self.persona_totals.items(), key=lambda x: x[1], reverse=True)),
+                "top_groups": [
+                    {"chat_id": chat_id, "title": self.groups[chat_id].title, "messages": count}
+                    for chat_id, count in top
+                ]
+            }
     
     def get_user_stats(self, user_id: str) -> dict:
         """获取用户统计"""
@@ -84,24 +322,20 @@ class StatsManager:
         user_stats = self.stats[user_id]
         
         # 计算使用天数
-        first_use = datetime.fromisoformat(user_stats["first_use"])
+        first_use = datetime.fromtimestamp(user_stats.first_use)
         days_used = (datetime.now() - first_use).days + 1
         
-        # 找出最常用的人设
-        persona_usage = user_stats.get("persona_usage", {})
-        favorite_persona = max(persona_usage.items(), key=lambda x: x[1])[0] if persona_usage else "未知"
-        
         # 计算平均每天消息数
-        avg_daily = user_stats["total_messages"] / days_used if days_used > 0 else 0
+        avg_daily = user_stats.total_messages / days_used if days_used > 0 else 0
         
         return {
-            "total_messages": user_stats["total_messages"],
-            "total_conversations": user_stats["total_conversations"],
+            "total_messages": user_stats.total_messages,
+            "total_conversations": user_stats.total_conversations,
             "days_used": days_used,
             "first_use": first_use.strftime("%Y-%m-%d"),
-            "last_use": datetime.fromisoformat(user_stats["last_use"]).strftime("%Y-%m-%d"),
-            "favorite_persona": favorite_persona,
-            "persona_usage": persona_usage,
+            "last_use": datetime.fromtimestamp(user_stats.last_use).strftime("%Y-%m-%d"),
+            "favorite_persona": user_stats.favorite_persona or "未知",
+            "persona_usage": dict(user_stats.persona_usage),
             "avg_daily_messages": round(avg_daily, 1)
         }
     
@@ -0,0 +1,135 @@
+"""
+存储工具模块
+崩溃安全的文件写入（临时文件 + fsync + 原子重命名）和预写日志
+"""
+import os
+import tempfile
+import threading
+from pathlib import Path
+from loguru import logger
+import serialization
+
+
+def safe_filename(name: str) -> str:
+    """转换为安全的文件名"""
+    return "".join(c if c.isalnum() or c in ('-', '_') else '_' for c in str(name))
+
+
+def _fsync_dir(directory: Path):
+    """同步目录项，确保重命名落盘（Windows 不支持，忽略）"""
+    if os.name != "posix":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path, data):
+    """原子写入文件：先写临时文件并 fsync，再重命名覆盖原文件"""
+    path = Path(path)
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+    _fsync_dir(path.parent)
+
+
+def atomic_write_json(path, obj, indent=None):
+    """原子写入 JSON 文件（indent 不为空时缩进 2 格）"""
+    atomic_write(path, serialization.dumps(obj, pretty=bool(indent)))
+
+
+class WriteAheadLog:
+    """预写日志（JSONL）
+
+    记录先写进文件缓冲区，后台线程按固定间隔 flush + fsync，
+    进程被强杀或机器断电最多丢失一个间隔的数据（interval 为 0 时每条都 fsync）
+    """
+
+    def __init__(self, path, fsync_interval: float = 1.0):
+        self.path = Path(path)
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._unsynced = False
+        self._closed = threading.Event()
+        self._thread = None
+        if fsync_interval > 0:
+            self._thread = threading.Thread(target=self._sync_loop, name=f"wal-{self.path.stem}", daemon=True)
+            self._thread.start()
+
+    def replay(self):
+        """读出日志中的所有记录（跳过崩溃时写了一半的最后一行）"""
+        with self._lock:
+            self._file.flush()
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    logger.warning(f"预写日志 {self.path.name} 末尾有不完整的记录，已跳过")
+                    break
+                try:
+                    yield serialization.loads(line)
+                except serialization.DecodeError:
+                    logger.warning(f"预写日志 {self.path.name} 有损坏的记录，已跳过")
+
+    def append(self, record: dict):
+        """追加一条记录"""
+        line = serialization.dumps_line(record)
+        with self._lock:
+            self._file.write(line)
+            if self._thread is None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            else:
+                self._unsynced = True
+
+    def sync(self):
+        """立即 fsync"""
+        with self._lock:
+            if self._unsynced and not self._file.closed:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._unsynced = False
+
+    def _sync_loop(self):
+        while not self._closed.wait(self.fsync_interval):
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"预写日志 fsync 失败: {e}")
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            return self._file.tell()
+
+    def truncate(self):
+        """清空日志（数据已经安全地写到别处之后调用）"""
+        with self._lock:
+            self._file.truncate(0)
+            self._file.seek(0)
+            os.fsync(self._file.fileno())
+            self._unsynced = False
+
+    def close(self):
+        self._closed.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self.sync()
+        with self._lock:
+            self._file.close()
@@ -1,31 +1,67 @@
 """
 群消息总结模块
 分析群消息并生成总结
+
+每个群保存一份增量总结状态（已总结到哪条消息 + 按话题整理的滚动总结），
+再次总结时只把水位线之后的新消息和之前的话题发给 AI
 """
-from datetime import datetime
+import re
+import threading
+from datetime import datetime, timedelta
 from collections import Counter
+from pathlib import Path
 from loguru import logger
 
+from config import SUMMARY_PROMPT_TOKENS
+from extractive import select_messages
+from models import to_epoch
+from storage import atomic_write_json
+import serialization
+from tracing import traced, span, set_attribute
+
+# AI 输出格式：话题：<关键词> | <一句话概括> | <MM-DD HH:MM>
+_TOPIC_LINE = re.compile(r"^\s*话题[:：]\s*(.+?)\s*\|\s*(.+?)\s*(?:\|\s*(\d{2}-\d{2} \d{2}:\d{2}))?\s*$")
+_CONCLUSION_LINE = re.compile(r"^\s*结论[:：]\s*(.+?)\s*$")
+
+_OUTPUT_FORMAT = """按以下格式输出，每行一项，不要输出其他内容：
+话题：<关键词> | <一句话概括> | <最后讨论时间 MM-DD HH:MM>
+结论：<关键结论，没有就写"无">
+
+要求：话题最多 5 个，按重要程度排序；每个概括不超过 30 字。"""
+
 
 class MessageSummarizer:
     """消息总结器"""
     
-    def __init__(self, ai_client):
+    def __init__(self, ai_client, state_dir="summary_state"):
         self.ai = ai_client
+        # 增量总结状态 {chat_id: state}，每个群一个文件
+        self.state_dir = Path(state_dir)
+        self.state_dir.mkdir(exist_ok=True)
+        self._states = {}
+        # 每个群一把锁（同一个群的总结状态不能同时更新，不同的群可以并发）
+        self._locks = {}
+        self._locks_guard = threading.Lock()
     
-    def generate_summary(self, chat_id: int, messages: list, chat_title: str = "群聊") -> str:
-        """生成群消息总结"""
+    @traced("summary.generate")
+    def generate_summary(self, chat_id: int, messages: list, chat_title: str = "群聊",
+                         strict: bool = False) -> str:
+        """生成群消息总结（有上次的总结状态时只总结新消息）
+
+        strict 为 True 时 AI 调用失败直接抛出异常，而不是返回提示文字（每日摘要用，失败的群稍后重试）
+        """
         if not messages:
             return "📊 暂无消息可总结"
         
         # 基础统计
         stats = self._calculate_stats(messages)
         
-        # 提取消息内容用于AI总结
-        message_text = self._format_messages_for_ai(messages)
-        
         # 调用AI生成总结
-        ai_summary = self._generate_ai_summary(message_text, stats)
+        with self._chat_lock(chat_id):
+            state = self._update_state(chat_id, messages)
+        if strict and not state["topics"] and not state.get("text"):
+            raise RuntimeError("AI总结生成失败")
+        ai_summary = self._render_state(state)
         
         # 格式化最终总结
         final_summary = self._format_final_summary(
@@ -36,17 +72,194 @@ class MessageSummarizer:
         
         return final_summary
     
+    def presummarize(self, chat_id: int, messages: list, min_new: int = 1) -> bool:
+        """预先总结新消息（空闲时由定时任务调用），新消息不足 min_new 条时跳过
+
+        返回是否调用了 AI
+        """
+        if not messages:
+            return False
+        with self._chat_lock(chat_id):
+            state = self._get_state(chat_id)
+            if state and self._can_resume(state, messages):
+                if len(self._new_messages(state, messages)) < min_new:
+                    return False
+            elif len(messages) < min_new:
+                return False
+            self._update_state(chat_id, messages)
+            return True
+    
+    def _update_state(self, chat_id: int, messages: list):
+        """把总结状态推进到最新消息，返回用于展示的状态"""
+        state, prompt, context = self._plan(chat_id, messages)
+        if prompt is None:
+            return state
+        
+        with span("summary.model", incremental=state is not None, messages=context["new"]):
+            text = self._generate_ai_summary(prompt)
+        if text is None:
+            return {"topics": [], "text": ""}
+        return self._apply(chat_id, text, context)
+    
+    def _plan(self, chat_id: int, messages: list) -> tuple:
+        """决定怎么更新总结，返回 (上次的状态, 提示词, 上下文)
+
+        提示词为 None 表示不用调用 AI，上次的状态（去掉过期话题后）就是结果
+        """
+        state = self._get_state(chat_id)
+        first_ts = messages[0].timestamp
+        
+        if state and self._can_resume(state, messages):
+            new_messages = self._new_messages(state, messages)
+            # 最后讨论时间已经不在本次时间范围内的话题去掉
+            topics = [t for t in state["topics"] if t["last_seen"] >= first_ts]
+            if not topics:
+                state = None
+            elif not new_messages:
+                if len(topics) != len(state["topics"]):
+                    state = dict(state, topics=topics, start=first_ts)
+                    self._save_state(chat_id, state)
+                return state, None, None
+            elif len(topics) != len(state["topics"]):
+                # 去掉了更早的话题，总结的范围也要跟着缩小，否则之后更长的时间范围会接着用这份不完整的总结
+                state = dict(state, topics=topics, start=first_ts)
+        else:
+            state = None
+        
+        if state is None:
+            new_messages = messages
+            prompt = self._build_full_prompt(messages)
+        else:
+            prompt = self._build_incremental_prompt(state, new_messages)
+        
+        watermark = messages[-1].timestamp
+        context = {
+            "start": first_ts if state is None else state["start"],
+            "watermark": watermark,
+            # 和水位线同一秒的消息有几条已经总结过（时间戳只精确到秒）
+            "at_watermark": sum(1 for msg in messages if msg.timestamp == watermark),
+            "new": len(new_messages),
+        }
+        return state, prompt, context
+    
+    def _apply(self, chat_id: int, text: str, context: dict) -> dict:
+        """解析 AI 输出并保存为新的总结状态"""
+        topics, conclusion = self._parse_summary(text, context["watermark"])
+        if not topics:
+            # 没按格式输出（或调用失败返回了提示语），原样展示，不保存状态
+            return {"topics": [], "text": text}
+        
+        new_state = {
+            "start": context["start"],
+            "watermark": context["watermark"],
+            "at_watermark": context["at_watermark"],
+            "topics": topics,
+            "conclusion": conclusion,
+            "updated": datetime.now().isoformat(),
+        }
+        self._save_state(chat_id, new_state)
+        logger.debug(f"群 {chat_id} 的总结已更新到 {context['watermark']}（新消息 {context['new']} 条）")
+        return new_state
+    
+    def batch_request(self, chat_id: int, messages: list):
+        """为批量任务准备总结请求，返回 (chat.completions 请求参数, 上下文)；不需要调用 AI 时返回 None"""
+        if not messages:
+            return None
+        with self._chat_lock(chat_id):
+            _, prompt, context = self._plan(chat_id, messages)
+        if prompt is None:
+            return None
+        body = {
+            "model": self.ai.model_name,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": 1000,
+            "temperature": 0.7,
+        }
+        return body, context
+    
+    def apply_batch_result(self, chat_id: int, text: str, context: dict) -> bool:
+        """写回批量任务的总结结果（期间已经有更新的总结时丢弃），返回是否采用"""
+        with self._chat_lock(chat_id):
+            current = self._get_state(chat_id)
+            # 升级前提交的批量任务，上下文里的时间还是 ISO 字符串
+            context = dict(context, start=int(to_epoch(context["start"])),
+                           watermark=int(to_epoch(context["watermark"])))
+            if current and current["watermark"] >= context["watermark"]:
+                return False
+            return bool(self._apply(chat_id, text, context)["topics"])
+    
+    @staticmethod
+    def _can_resume(state: dict, messages: list) -> bool:
+        """上次的总结能否接着用：要覆盖本次范围的开头（更早的话题可以按时间去掉），且水位线还在范围内"""
+        first_ts = messages[0].timestamp
+        return state["start"] <= first_ts <= state["watermark"]
+    
+    @staticmethod
+    def _new_messages(state: dict, messages: list) -> list:
+        """水位线之后的新消息"""
+        watermark = state["watermark"]
+        skip = state["at_watermark"]
+        new_messages = []
+        for msg in messages:
+            if msg.timestamp > watermark:
+                new_messages.append(msg)
+            elif msg.timestamp == watermark:
+                if skip > 0:
+                    skip -= 1
+                else:
+                    new_messages.append(msg)
+        return new_messages
+    
+    def _chat_lock(self, chat_id: int) -> threading.Lock:
+        with self._locks_guard:
+            lock = self._locks.get(chat_id)
+            if lock is None:
+                lock = self._locks[chat_id] = threading.Lock()
+            return lock
+    
+    def _state_file(self, chat_id: int) -> Path:
+        return self.state_dir / f"{chat_id}.json"
+    
+    def _get_state(self, chat_id: int):
+        if chat_id not in self._states:
+            state = None
+            state_file = self._state_file(chat_id)
+            if state_file.exists():
+                try:
+                    state = self._upgrade_state(serialization.load_file(state_file))
+                except Exception as e:
+                    logger.warning(f"读取群 {chat_id} 的总结状态失败: {e}")
+            self._states[chat_id] = state
+        return self._states[chat_id]
+    
+    @staticmethod
+    def _upgrade_state(state: dict) -> dict:
+        """旧版本的状态文件里时间是 ISO 字符串，转成 epoch 秒"""
+        if isinstance(state["watermark"], str):
+            state["start"] = int(to_epoch(state["start"]))
+            state["watermark"] = int(to_epoch(state["watermark"]))
+            for topic in state["topics"]:
+                topic["last_seen"] = int(to_epoch(topic["last_seen"]))
+        return state
+    
+    def _save_state(self, chat_id: int, state: dict):
+        self._states[chat_id] = state
+        try:
+            atomic_write_json(self._state_file(chat_id), state)
+        except Exception as e:
+            logger.error(f"保存群 {chat_id} 的总结状态失败: {e}")
+    
     def _calculate_stats(self, messages: list) -> dict:
         """计算统计信息"""
         # 用户消息数统计
         user_counts = Counter()
         for msg in messages:
-            user_counts[msg["username"]] += 1
+            user_counts[msg.username] += 1
         
         # 获取时间范围
         if messages:
-            start_time = datetime.fromisoformat(messages[0]["timestamp"])
-            end_time = datetime.fromisoformat(messages[-1]["timestamp"])
+            start_time = datetime.fromtimestamp(messages[0].timestamp)
+            end_time = datetime.fromtimestamp(messages[-1].timestamp)
             time_range = f"{start_time.strftime('%H:%M')} - {end_time.strftime('%H:%M')}"
         else:
             time_range = "未知"
@@ -58,61 +271,104 @@ class MessageSummarizer:
             "time_range": time_range
         }
     
-    def _format_messages_for_ai(self, messages: list, max_messages: int = 100) -> str:
-        """格式化消息供AI分析"""
-        # 如果消息太多，采样
-        if len(messages) > max_messages:
-            # 均匀采样
-            step = len(messages) // max_messages
-            sampled = messages[::step][:max_messages]
-        else:
-            sampled = messages
-        
-        # 格式化为文本
-        lines = []
-        for msg in sampled:
-            time = datetime.fromisoformat(msg["timestamp"]).strftime("%H:%M")
-            lines.append(f"[{time}] {msg['username']}: {msg['message']}")
+    @staticmethod
+    def _format_line(msg) -> str:
+        time = datetime.fromtimestamp(msg.timestamp).strftime("%m-%d %H:%M")
+        text = msg.message or ""
+        if len(text) > 200:
+            text = text[:200] + "…"
+        return f"[{time}] {msg.username}: {text}"
+    
+    def _format_messages_for_ai(self, messages: list, token_budget: int = SUMMARY_PROMPT_TOKENS) -> str:
+        """格式化消息供AI分析（先在本地去重、过滤水消息，再在 token 预算内挑出最有代表性的）"""
+        with span("summary.extract", messages=len(messages)):
+            selected = select_messages(messages, token_budget, self._format_line)
+            set_attribute("selected", len(selected))
         
-        return "\n".join(lines)
+        return "\n".join(self._format_line(msg) for msg in selected)
     
-    def _generate_ai_summary(self, message_text: str, stats: dict) -> str:
-        """使用AI生成总结"""
-        prompt = f"""请总结以下群聊消息的重点内容：
+    def _build_full_prompt(self, messages: list) -> str:
+        """从头总结的提示词"""
+        users = len({msg.username for msg in messages})
+        return f"""请总结以下群聊消息的重点内容：
 
-消息数：{stats['total_messages']}条
-参与人数：{stats['active_users']}人
+消息数：{len(messages)}条
+参与人数：{users}人
 
 聊天记录：
-{message_text}
-
-请提供简洁的总结，包含：
-1. 🔥 主要话题（2-3个关键词）
-2. 💬 重要内容（一句话概括）
-3. 📌 关键结论（如果有）
+{self._format_messages_for_ai(messages)}
 
-要求：简洁明了，总共不超过100字。
+{_OUTPUT_FORMAT}
 """
+    
+    def _build_incremental_prompt(self, state: dict, new_messages: list) -> str:
+        """在上次总结的基础上合并新消息的提示词"""
+        previous = "\n".join(
+            f"话题：{t['topic']} | {t['summary']} | "
+            f"{datetime.fromtimestamp(t['last_seen']).strftime('%m-%d %H:%M')}"
+            for t in state["topics"]
+        )
+        previous += f"\n结论：{state['conclusion'] or '无'}"
         
+        return f"""下面是一个群聊之前的总结，以及之后的新消息，请合并成新的总结。
+
+之前的总结：
+{previous}
+
+新消息（{len(new_messages)}条）：
+{self._format_messages_for_ai(new_messages)}
+
+旧话题如果在新消息里继续讨论，请更新它的概括和最后讨论时间；没有继续讨论的原样保留。
+
+{_OUTPUT_FORMAT}
+"""
+    
+    @staticmethod
+    def _parse_summary(text: str, watermark: int) -> tuple:
+        """解析 AI 输出，返回 ([话题], 结论)；不符合格式时话题为空"""
+        latest = datetime.fromtimestamp(watermark)
+        topics = []
+        conclusion = ""
+        for line in text.splitlines():
+            match = _TOPIC_LINE.match(line)
+            if match:
+                topic, summary, last_seen = match.groups()
+                # "MM-DD HH:MM" 没有年份，取不晚于最新消息的那一年
+                seen = latest
+                if last_seen:
+                    try:
+                        seen = datetime.strptime(f"{latest.year}-{last_seen}", "%Y-%m-%d %H:%M")
+                        if seen > latest + timedelta(days=1):
+                            seen = seen.replace(year=latest.year - 1)
+                        seen = min(seen, latest)
+                    except ValueError:
+                        seen = latest
+                topics.append({"topic": topic, "summary": summary, "last_seen": int(seen.timestamp())})
+                continue
+            match = _CONCLUSION_LINE.match(line)
+            if match and match.group(1) != "无":
+                conclusion = match.group(1)
+        return topics[:5], conclusion
+    
+    @staticmethod
+    def _render_state(state: dict) -> str:
+        """把总结状态转成展示给用户的文字"""
+        if not state["topics"]:
+            return state["text"] or "⚠️ AI总结生成失败，请稍后再试"
+        lines = [f"🔥 {'、'.join(t['topic'] for t in state['topics'][:3])}"]
+        lines.extend(f"💬 {t['topic']}：{t['summary']}" for t in state["topics"])
+        if state["conclusion"]:
+            lines.append(f"📌 {state['conclusion']}")
+        return "\n".join(lines)
+    
+    def _generate_ai_summary(self, prompt: str):
+        """使用AI生成总结（失败返回 None）"""
         try:
-            # 使用临时用户ID生成总结（不保存历史）
-            temp_user_id = "summary_bot_temp"
-            
-            # 清空临时用户的历史（确保每次都是新的总结）
-            if temp_user_id in self.ai.conversations:
-                self.ai.conversations[temp_user_id] = []
-            
-            # 调用AI生成总结
-            summary = self.ai.chat(temp_user_id, prompt)
-            
-            # 清空临时用户的历史（不保存）
-            if temp_user_id in self.ai.conversations:
-                self.ai.conversations[temp_user_id] = []
-            
-            return summary
+            # 单次补全，不经过对话历史，多个群可以同时生成
+            return self.ai.complete(prompt, feature="summary")
         except Exception as e:
             logger.error(f"AI总结生成失败: {e}")
-            return "⚠️ AI总结生成失败，请稍后再试"
+            return None
     
     def _format_final_summary(self, chat_title: str, stats: dict, ai_summary: str) -> str:
         """格式化最终总结"""
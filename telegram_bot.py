@@ -3,29 +3,146 @@ Telegram AI 机器人
 基于 python-telegram-bot + AI 的智能对话机器人，支持多人设切换
 """
 import asyncio
+import functools
+import os
+import time
+
+# 开始导入模块的时间（用于启动耗时分析）
+_IMPORT_START = time.perf_counter()
+
 from telegram import Update, BotCommand, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from loguru import logger
 
 from ai_client import AIClient
-from config import TELEGRAM_BOT_TOKEN, BOT_NAME
-from personas import get_persona_list, is_valid_persona, get_persona
+from config import TELEGRAM_BOT_TOKEN, BOT_NAME, VISION_TARGET_SIZE, VISION_MAX_IMAGE_BYTES
+from config import METRICS_HOST, METRICS_PORT
+from config import TRACE_SAMPLE_RATE, TRACE_EXPORTER, TRACE_FILE
+from config import ADMIN_USER_IDS, SLOW_REQUEST_MS, PROFILE_ON_START, PROFILE_INTERVAL_MS, PROFILE_DIR
+from config import STATS_FLUSH_INTERVAL, SHUTDOWN_DRAIN_SECONDS
+from config import SUMMARY_PRESUMMARIZE_INTERVAL, SUMMARY_PRESUMMARIZE_MIN_MESSAGES
+from config import BATCH_MODE, BATCH_POLL_INTERVAL, BATCH_SUMMARY_HOUR
+from config import DIGEST_HOUR, DIGEST_WINDOW_MINUTES, DIGEST_CONCURRENCY
+from config import SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_GROUP_RATE_PER_MIN, SEND_BURST
+from personas import get_persona_list, is_valid_persona, get_persona, get_pacing
 from group_monitor import GroupMonitor
 from summarizer import MessageSummarizer
+from batch import BatchRunner
+from digest import DigestManager
+from sender import SendScheduler
+from profiler import SamplingProfiler
+from lifecycle import Lifecycle
+from metrics import HANDLER_LATENCY, MODEL_LATENCY, IN_FLIGHT, ERRORS, REQUEST_START, start_metrics_server
+from tracing import TRACER, start_trace, span, run_in_executor
+from lazy import INIT_TIMES, is_initialized, format_timings
+from usage import BUDGET_EXCEEDED_REPLY
+
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_START
+
+
+def instrumented(name: str):
+    """处理器装饰器：记录端到端耗时、并发数和未捕获的错误，开启追踪，并计入在途请求（退出时等待）"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, update, context):
+            start = time.perf_counter()
+            token = REQUEST_START.set(start)
+            IN_FLIGHT.inc(handler=name)
+            user = update.effective_user
+            try:
+                with self.lifecycle.track(), start_trace(f"handler.{name}", user_id=user.id if user else None):
+                    return await func(self, update, context)
+            except Exception as e:
+                ERRORS.inc(where=name, type=type(e).__name__)
+                raise
+            finally:
+                IN_FLIGHT.dec(handler=name)
+                HANDLER_LATENCY.observe(time.perf_counter() - start, handler=name)
+                REQUEST_START.reset(token)
+        return wrapper
+    return decorator
+
+
+def _seconds_until(hour: int) -> float:
+    """距离下一个整点 hour:00 的秒数"""
+    from datetime import datetime, timedelta, time as dt_time
+    now = datetime.now()
+    target_time = datetime.combine(now.date(), dt_time(hour, 0))
+    if target_time < now:
+        target_time += timedelta(days=1)
+    return (target_time - now).total_seconds()
 
 
 class TelegramBot:
     """Telegram AI 机器人"""
     
     def __init__(self):
+        init_start = time.perf_counter()
+        # AIClient 里的重量级组件都是延迟加载的，这里很快
         self.ai = AIClient()
         self.app = None
         # 群消息监听器
         self.group_monitor = GroupMonitor()
         # 消息总结器
         self.summarizer = MessageSummarizer(self.ai)
+        # 上次预总结的时间（启动时从头开始，已有的总结状态会被复用）
+        self._presummarized_at = 0
+        # 批量任务（夜间群总结、后台记忆提取），结果按类型写回对应的群和用户
+        self.batch = None
+        if BATCH_MODE in ("api", "local"):
+            self.batch = BatchRunner(lambda: self.ai.client, mode=BATCH_MODE, usage_getter=lambda: self.ai.usage)
+            self.batch.register("summary", self._apply_batch_summary)
+            self.batch.register("memory", self._apply_batch_memory)
+            self.ai.batch_runner = self.batch
+        # 每日摘要（按群订阅）
+        self.digest = DigestManager()
+        # 消息发送调度器（限流 + 分条发送）
+        self.sender = SendScheduler(
+            global_rate=SEND_GLOBAL_RATE,
+            chat_rate=SEND_CHAT_RATE,
+            group_rate_per_min=SEND_GROUP_RATE_PER_MIN,
+            burst=SEND_BURST
+        )
+        # 采样分析器（/profile）
+        self.profiler = SamplingProfiler(interval=PROFILE_INTERVAL_MS / 1000, output_dir=PROFILE_DIR)
+        self._profile_task = None
+        # 生命周期：在途请求统计 + 退出时按顺序落盘
+        self.lifecycle = Lifecycle()
+        self._register_flushers()
+        # 启动耗时明细 {阶段: 秒}
+        self.startup_timings = {
+            "导入模块": _IMPORT_SECONDS,
+            "初始化": time.perf_counter() - init_start,
+        }
         logger.info("✓ 机器人初始化完成")
     
+    def _register_flushers(self):
+        """注册退出时的落盘步骤（按顺序执行，没用过的组件直接跳过）"""
+        def flush_memory():
+            if is_initialized(self.ai, "memory"):
+                # 先处理完排队中的记忆提取，再合并修改日志
+                if self.ai.memory.extractor:
+                    self.ai.memory.extractor.stop()
+                self.ai.memory.flush()
+        
+        def flush_stats():
+            if is_initialized(self.ai, "stats"):
+                self.ai.stats.flush()
+            if is_initialized(self.ai, "usage"):
+                self.ai.usage.flush()
+        
+        def stop_profiler():
+            if self.profiler.running:
+                self.profiler.stop()
+        
+        self.lifecycle.register("群消息", self.group_monitor.close)
+        self.lifecycle.register("记忆", flush_memory)
+        self.lifecycle.register("统计", flush_stats)
+        self.lifecycle.register("语音线程池", lambda: self.ai.transcribe_executor.shutdown(cancel_futures=True))
+        self.lifecycle.register("追踪", TRACER.shutdown)
+        self.lifecycle.register("采样", stop_profiler)
+    
+    @instrumented("start")
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理 /start 命令"""
         user = update.effective_user
@@ -62,6 +179,7 @@ class TelegramBot:
         await update.message.reply_text(welcome_msg, reply_markup=reply_markup)
         logger.info(f"用户 {user.id} ({user.first_name}) 启动了机器人")
     
+    @instrumented("help")
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理 /help 命令"""
         help_msg = (
@@ -82,6 +200,9 @@ class TelegramBot:
             f"  /summary - 总结群聊（仅群聊）\n"
             f"  /summary 1h - 总结最近1小时\n"
             f"  /summary 快速 - 快速统计（不用AI）\n"
+            f"  /find 关键词 - 搜索群聊记录（仅群聊）\n"
+            f"  /digest - 每日摘要订阅（仅群聊）\n"
+            f"  /retention - 群消息保留天数（仅群聊）\n"
             f"  /clear - 清空对话历史\n\n"
             f"✨ 特点：\n"
             f"  • 多种人设可选，风格各异\n"
@@ -92,6 +213,7 @@ class TelegramBot:
         )
         await update.message.reply_text(help_msg)
     
+    @instrumented("clear")
     async def clear_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理 /clear 命令"""
         user_id = str(update.effective_user.id)
@@ -99,6 +221,7 @@ class TelegramBot:
         await update.message.reply_text("✅ 对话历史已清空")
         logger.info(f"用户 {user_id} 清空了对话历史")
     
+    @instrumented("persona")
     async def persona_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理 /persona 命令"""
         user_id = str(update.effective_user.id)
@@ -166,13 +289,21 @@ class TelegramBot:
             # 从命令调用，发送新消息
             await update.message.reply_text(msg, reply_markup=reply_markup)
     
+    def _format_user_stats(self, user_id: str) -> str:
+        """使用统计（开启了每日额度时附上今天的用量）"""
+        stats_text = self.ai.stats.format_stats(user_id)
+        budget_text = self.ai.usage.format_budget(user_id)
+        return f"{stats_text}\n{budget_text}" if budget_text else stats_text
+    
+    @instrumented("stats")
     async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理 /stats 命令"""
         user_id = str(update.effective_user.id)
-        stats_text = self.ai.stats.format_stats(user_id)
+        stats_text = self._format_user_stats(user_id)
         await update.message.reply_text(stats_text)
         logger.info(f"用户 {user_id} 查看了统计信息")
     
+    @instrumented("memory")
     async def memory_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理 /memory 命令"""
         user_id = str(update.effective_user.id)
@@ -189,6 +320,7 @@ class TelegramBot:
             memory_text = self.ai.memory.format_memories(user_id)
             await update.message.reply_text(memory_text)
     
+    @instrumented("forget")
     async def forget_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理 /forget 命令"""
         user_id = str(update.effective_user.id)
@@ -203,6 +335,7 @@ class TelegramBot:
         else:
             await update.message.reply_text("请指定要忘记的内容，例如：/forget 名字")
     
+    @instrumented("search")
     async def search_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理 /search 命令"""
         user_id = str(update.effective_user.id)
@@ -215,20 +348,23 @@ class TelegramBot:
         logger.info(f"用户 {user_id} 搜索: {query}")
         
         # 发送"正在输入"状态
-        await update.message.chat.send_action("typing")
+        await self._send_typing(update)
         
         try:
             # 执行搜索
-            results = self.ai.search.search_web(query, max_results=3)
+            with span("search.web"):
+                results = self.ai.search.search_web(query, max_results=3)
             result_text = self.ai.search.format_search_results(results)
             
             await update.message.reply_text(result_text)
             logger.success(f"搜索完成: {query}")
             
         except Exception as e:
+            ERRORS.inc(where="search", type=type(e).__name__)
             logger.error(f"搜索失败: {e}")
             await update.message.reply_text("抱歉，搜索失败了，请稍后再试~")
     
+    @instrumented("summary")
     async def summary_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理 /summary 命令"""
         chat_id = update.message.chat.id
@@ -271,7 +407,7 @@ class TelegramBot:
         logger.info(f"生成群 {chat_id} 的总结，时间范围: {hours}小时, AI: {use_ai}")
         
         # 发送"正在输入"状态
-        await update.message.chat.send_action("typing")
+        await self._send_typing(update)
         
         try:
             # 获取消息
@@ -284,7 +420,9 @@ class TelegramBot:
             
             # 生成总结
             if use_ai:
-                summary = self.summarizer.generate_summary(chat_id, messages, chat_title)
+                summary = await run_in_executor(
+                    None, self.summarizer.generate_summary, chat_id, messages, chat_title
+                )
             else:
                 summary = self.summarizer.generate_quick_summary(messages)
             
@@ -293,9 +431,206 @@ class TelegramBot:
             logger.success(f"已生成群 {chat_id} 的总结")
             
         except Exception as e:
+            ERRORS.inc(where="summary", type=type(e).__name__)
             logger.error(f"生成总结失败: {e}")
             await update.message.reply_text("❌ 总结生成失败了，请稍后再试")
     
+    @instrumented("find")
+    async def find_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理 /find 命令：在本群的聊天记录中搜索关键词"""
+        chat_id = update.message.chat.id
+        
+        if update.message.chat.type not in ["group", "supergroup"]:
+            await update.message.reply_text("🔎 聊天记录搜索只能在群聊中使用哦")
+            return
+        
+        if not context.args:
+            await update.message.reply_text("请输入关键词，例如：/find 周末 聚餐")
+            return
+        
+        query = " ".join(context.args)
+        start = time.perf_counter()
+        # 第一次搜索时可能要补建索引，放到线程池里做
+        results = await run_in_executor(None, self.group_monitor.search_messages, chat_id, query, 10)
+        elapsed = (time.perf_counter() - start) * 1000
+        logger.info(f"群 {chat_id} 搜索记录: {query}（{len(results)} 条，{elapsed:.1f}ms）")
+        
+        if not results:
+            await update.message.reply_text(f"🔎 没有找到包含「{query}」的消息")
+            return
+        
+        lines = [f"🔎 「{query}」最近的 {len(results)} 条消息：\n"]
+        for msg in results:
+            text = msg["message"] if len(msg["message"]) <= 80 else msg["message"][:80] + "…"
+            # "2025-01-01T13:05:00" -> "01-01 13:05"
+            when = msg["timestamp"][5:16].replace("T", " ")
+            lines.append(f"[{when}] {msg['username']}: {text}")
+        await update.message.reply_text("\n".join(lines))
+    
+    @instrumented("profile")
+    async def profile_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理 /profile 命令（仅管理员）：采样分析 N 秒"""
+        user_id = update.effective_user.id
+        if user_id not in ADMIN_USER_IDS:
+            await update.message.reply_text("❌ 只有管理员可以使用这个命令")
+            return
+        
+        if self.profiler.running:
+            await update.message.reply_text("⏳ 正在采样中，请等这次结束后再试")
+            return
+        
+        seconds = 30
+        if context.args and context.args[0].isdigit():
+            seconds = max(1, min(int(context.args[0]), 600))
+        
+        self.profiler.start(seconds)
+        await update.message.reply_text(f"🔬 开始采样 {seconds} 秒，结束后会把结果发给你")
+        logger.info(f"管理员 {user_id} 开启采样分析 {seconds}s")
+        
+        # 不占用处理器，采样结束后再回复
+        self._profile_task = asyncio.get_running_loop().create_task(self._report_profile(update, seconds))
+    
+    async def _report_profile(self, update: Update, seconds: int):
+        """采样结束后发送热点函数和折叠栈文件"""
+        await asyncio.sleep(seconds)
+        while self.profiler.running:
+            await asyncio.sleep(0.5)
+        
+        lines = [f"{share:6.1%}  {name}" for name, share in self.profiler.top_functions(10)]
+        text = "🔬 采样完成\n\n🔥 热点函数（自身耗时占比）：\n" + "\n".join(lines)
+        try:
+            await update.message.reply_text(text)
+            with open(self.profiler.output_file, "rb") as f:
+                await update.message.reply_document(f, filename=os.path.basename(self.profiler.output_file))
+        except Exception as e:
+            logger.error(f"发送采样结果失败: {e}")
+    
+    @instrumented("admin_stats")
+    async def admin_stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理 /admin_stats 命令（仅管理员）：全局使用概览（都是写入时预先汇总好的计数）"""
+        if update.effective_user.id not in ADMIN_USER_IDS:
+            await update.message.reply_text("❌ 只有管理员可以使用这个命令")
+            return
+        
+        overview = self.ai.stats.get_overview(days=7)
+        lines = [
+            "📊 全局统计\n",
+            f"👥 用户总数: {overview['total_users']}",
+            f"📅 今日活跃: {overview['dau']}　本周活跃: {overview['wau']}",
+            f"💬 今日消息: {overview['messages_today']}　近 7 天: {overview['messages_window']}",
+        ]
+        
+        persona_total = sum(overview["persona_usage"].values())
+        if persona_total:
+            lines.append("\n🎭 人设分布:")
+            for persona, count in list(overview["persona_usage"].items())[:8]:
+                lines.append(f"  • {persona}: {count}次（{count / persona_total:.0%}）")
+        
+        if overview["top_groups"]:
+            lines.append("\n🏆 近 7 天最活跃的群:")
+            for group in overview["top_groups"]:
+                lines.append(f"  • {group['title'] or group['chat_id']}: {group['messages']}条")
+        
+        def format_seconds(seconds: float) -> str:
+            if seconds == float("inf"):
+                return f">{MODEL_LATENCY.buckets[-1]:g}s"
+            return f"{seconds * 1000:.0f}ms" if seconds < 1 else f"{seconds:g}s"
+        
+        # 模型耗时是进程内的指标，重启后从零开始；token 用量取自按天落盘的用量统计
+        latency_lines = []
+        for labels in MODEL_LATENCY.label_sets():
+            count = MODEL_LATENCY.snapshot(**labels)[2]
+            p50, p95, p99 = (format_seconds(MODEL_LATENCY.percentile(q, **labels)) for q in (0.5, 0.95, 0.99))
+            latency_lines.append(f"  • {labels['model']}: p50 {p50} / p95 {p95} / p99 {p99}（{count}次）")
+        if latency_lines:
+            lines.append("\n⏱ 模型耗时（自启动以来）:")
+            lines.extend(latency_lines)
+        
+        usage = self.ai.usage.get_today()
+        calls, prompt, completion = usage["total"]
+        if calls:
+            lines.append(f"\n🪙 今日 Token: {prompt + completion}（输入 {prompt} / 输出 {completion}，{calls}次调用）")
+            for title, key in (("按模型", "model"), ("按功能", "feature")):
+                parts = [f"{name or '未知'} {p + c}" for name, (_, p, c) in
+                         sorted(usage[key].items(), key=lambda x: x[1][1] + x[1][2], reverse=True)]
+                lines.append(f"  • {title}: " + "，".join(parts))
+        
+        await update.message.reply_text("\n".join(lines))
+    
+    async def _is_chat_admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """是否是群管理员（机器人管理员也算）"""
+        user_id = update.effective_user.id
+        if user_id in ADMIN_USER_IDS:
+            return True
+        member = await context.bot.get_chat_member(update.message.chat.id, user_id)
+        return member.status in ("administrator", "creator")
+    
+    @instrumented("retention")
+    async def retention_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理 /retention 命令：查看或设置本群消息保留天数"""
+        chat_id = update.message.chat.id
+        
+        if update.message.chat.type not in ["group", "supergroup"]:
+            await update.message.reply_text("🗂 保留天数只能在群聊中设置哦")
+            return
+        
+        if not context.args:
+            days = self.group_monitor.get_retention(chat_id)
+            await update.message.reply_text(
+                f"🗂 本群消息保留 {days} 天\n"
+                f"过期后只保留按小时的活跃度统计\n\n"
+                f"群管理员可以用 /retention 30 修改"
+            )
+            return
+        
+        if not await self._is_chat_admin(update, context):
+            await update.message.reply_text("❌ 只有群管理员可以修改保留天数")
+            return
+        
+        arg = context.args[0]
+        if not arg.isdigit() or not 1 <= int(arg) <= 365:
+            await update.message.reply_text("请输入 1~365 之间的天数，例如：/retention 30")
+            return
+        
+        days = int(arg)
+        self.group_monitor.set_retention(chat_id, days)
+        await update.message.reply_text(f"✅ 本群消息保留天数已设为 {days} 天")
+    
+    @instrumented("digest")
+    async def digest_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理 /digest 命令：查看或开关本群的每日摘要"""
+        chat_id = update.message.chat.id
+        
+        if update.message.chat.type not in ["group", "supergroup"]:
+            await update.message.reply_text("🗞 每日摘要只能在群聊中订阅哦")
+            return
+        
+        if not context.args:
+            status = "已开启" if self.digest.is_subscribed(chat_id) else "未开启"
+            await update.message.reply_text(
+                f"🗞 本群每日摘要：{status}\n"
+                f"开启后每天 {DIGEST_HOUR}:00 左右发送最近一天的群聊总结\n\n"
+                f"群管理员可以用 /digest on 或 /digest off 开关"
+            )
+            return
+        
+        arg = context.args[0].lower()
+        if arg not in ("on", "开启", "off", "关闭"):
+            await update.message.reply_text("用法：/digest on 开启，/digest off 关闭")
+            return
+        
+        if not await self._is_chat_admin(update, context):
+            await update.message.reply_text("❌ 只有群管理员可以开关每日摘要")
+            return
+        
+        if arg in ("on", "开启"):
+            self.digest.subscribe(chat_id, update.message.chat.title or str(chat_id))
+            await update.message.reply_text(f"✅ 已开启每日摘要，每天 {DIGEST_HOUR}:00 左右发送")
+        else:
+            self.digest.unsubscribe(chat_id)
+            await update.message.reply_text("✅ 已关闭每日摘要")
+    
+    @instrumented("button")
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理按钮回调"""
         query = update.callback_query
@@ -324,7 +659,7 @@ class TelegramBot:
                 logger.info(f"用户 {user_id} 切换人设为: {persona_key}")
         
         elif data == "stats":
-            stats_text = self.ai.stats.format_stats(user_id)
+            stats_text = self._format_user_stats(user_id)
             await query.message.edit_text(stats_text)
         
         elif data == "memory":
@@ -360,6 +695,18 @@ class TelegramBot:
             await query.message.edit_text("✅ 对话历史已清空")
             logger.info(f"用户 {user_id} 清空了对话历史")
     
+    async def _send_typing(self, update: Update):
+        """发送"正在输入"状态"""
+        with span("telegram.send_action"):
+            await update.message.chat.send_action("typing")
+    
+    async def _send_reply(self, update: Update, user_id: str, reply: str):
+        """按用户人设的节奏发送回复（自动分条、限流）"""
+        pacing = get_pacing(self.ai.get_user_persona(user_id))
+        with span("telegram.send_reply"):
+            await self.sender.send_reply(update.message, reply, pacing)
+    
+    @instrumented("message")
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理普通消息"""
         user = update.effective_user
@@ -377,6 +724,7 @@ class TelegramBot:
                 username=username,
                 message=message_text
             )
+            self.ai.stats.record_group_message(chat_id, update.message.chat.title or "")
         
         # 群聊判断：只在被 @ 或回复时响应
         if chat_type in ["group", "supergroup"]:
@@ -395,29 +743,19 @@ class TelegramBot:
         logger.info(f"收到消息 [{user.first_name}]: {message_text[:50]}...")
         
         # 发送"正在输入"状态
-        await update.message.chat.send_action("typing")
+        await self._send_typing(update)
         
         try:
-            # 在异步环境中运行同步的 AI 调用
-            import asyncio
-            loop = asyncio.get_event_loop()
-            
-            # 使用 run_in_executor 避免阻塞
-            reply = await loop.run_in_executor(
+            # 在线程池中运行同步的 AI 调用，避免阻塞（追踪上下文会一起带过去）
+            reply = await run_in_executor(
                 None,  # 使用默认线程池
                 self.ai.chat,
                 user_id,
                 message_text
             )
             
-            # 处理分条发送（用 ||| 分隔）
-            if "|||" in reply:
-                parts = [p.strip() for p in reply.split("|||") if p.strip()]
-                for part in parts:
-                    await update.message.reply_text(part)
-                    await asyncio.sleep(0.5)  # 分条发送间隔
-            else:
-                await update.message.reply_text(reply)
+            # 分条发送（用 ||| 分隔）
+            await self._send_reply(update, user_id, reply)
             
             logger.success(f"已回复 [{user.first_name}]: {reply[:50]}...")
             
@@ -426,6 +764,7 @@ class TelegramBot:
             await update.message.reply_text("网络有点慢|||稍后再试试吧")
         except Exception as e:
             error_type = type(e).__name__
+            ERRORS.inc(where="message", type=error_type)
             logger.error(f"处理消息失败 [{user.first_name}]: {error_type} - {e}")
             
             # 根据错误类型给出不同提示
@@ -434,6 +773,7 @@ class TelegramBot:
             else:
                 await update.message.reply_text("出了点问题|||等会再试试吧")
     
+    @instrumented("photo")
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理图片消息"""
         user = update.effective_user
@@ -453,11 +793,15 @@ class TelegramBot:
         logger.info(f"收到图片 [{user.first_name}]")
         
         # 发送"正在输入"状态
-        await update.message.chat.send_action("typing")
+        await self._send_typing(update)
+        
+        from image_utils import choose_photo_size, ImageTooLargeError
         
         try:
-            # 获取图片
-            photo = update.message.photo[-1]  # 获取最大尺寸的图片
+            # 按目标分辨率选择图片尺寸（不总是下载最大的）
+            photo = choose_photo_size(update.message.photo, VISION_TARGET_SIZE)
+            if photo.file_size and photo.file_size > VISION_MAX_IMAGE_BYTES:
+                raise ImageTooLargeError(f"图片大小 {photo.file_size} 字节，超过上限")
             photo_file = await photo.get_file()
             
             # 下载图片
@@ -472,21 +816,20 @@ class TelegramBot:
             # 调用 AI 识别图片
             reply = await self.ai.chat_with_image(user_id, caption, photo_bytes)
             
-            # 处理分条发送
-            if "|||" in reply:
-                parts = [p.strip() for p in reply.split("|||") if p.strip()]
-                for part in parts:
-                    await update.message.reply_text(part)
-                    await asyncio.sleep(0.5)
-            else:
-                await update.message.reply_text(reply)
+            # 分条发送
+            await self._send_reply(update, user_id, reply)
             
             logger.success(f"已回复图片 [{user.first_name}]")
             
+        except ImageTooLargeError as e:
+            logger.warning(f"图片过大 [{user.first_name}]: {e}")
+            await update.message.reply_text("图片太大了，换张小一点的试试吧~")
         except Exception as e:
+            ERRORS.inc(where="photo", type=type(e).__name__)
             logger.error(f"处理图片失败: {e}")
             await update.message.reply_text("抱歉，图片识别失败了，请稍后再试~")
     
+    @instrumented("voice")
     async def handle_voice(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理语音消息"""
         user = update.effective_user
@@ -503,15 +846,24 @@ class TelegramBot:
         
         logger.info(f"收到语音 [{user.first_name}]")
         
+        # 额度用完了就不用下载和转写了
+        if not self.ai.usage.check_budget(user_id):
+            await self._send_reply(update, user_id, BUDGET_EXCEEDED_REPLY)
+            return
+        
         # 发送"正在输入"状态
-        await update.message.chat.send_action("typing")
+        await self._send_typing(update)
         
         try:
             # 获取语音文件
             if update.message.voice:
-                voice_file = await update.message.voice.get_file()
+                voice = update.message.voice
+                filename = "voice.ogg"
             else:
-                voice_file = await update.message.audio.get_file()
+                voice = update.message.audio
+                filename = voice.file_name or "audio.mp3"
+            mime_type = voice.mime_type or "audio/ogg"
+            voice_file = await voice.get_file()
             
             # 下载语音
             import io
@@ -520,7 +872,13 @@ class TelegramBot:
             voice_bytes.seek(0)
             
             # 转换语音为文字
-            text = await self.ai.transcribe_audio(voice_bytes)
+            text = await self.ai.transcribe_audio(
+                voice_bytes,
+                duration=voice.duration or 0,
+                filename=filename,
+                mime_type=mime_type,
+                user_id=user_id
+            )
             
             if not text:
                 await update.message.reply_text("抱歉，没有识别到语音内容~")
@@ -531,18 +889,13 @@ class TelegramBot:
             # 调用 AI 生成回复
             reply = self.ai.chat(user_id, text)
             
-            # 处理分条发送
-            if "|||" in reply:
-                parts = [p.strip() for p in reply.split("|||") if p.strip()]
-                for part in parts:
-                    await update.message.reply_text(part)
-                    await asyncio.sleep(0.5)
-            else:
-                await update.message.reply_text(reply)
+            # 分条发送
+            await self._send_reply(update, user_id, reply)
             
             logger.success(f"已回复语音 [{user.first_name}]")
             
         except Exception as e:
+            ERRORS.inc(where="voice", type=type(e).__name__)
             logger.error(f"处理语音失败: {e}")
             await update.message.reply_text("抱歉，语音识别失败了，请稍后再试~")
     
@@ -550,6 +903,7 @@ class TelegramBot:
         """处理错误"""
         error = context.error
         error_type = type(error).__name__
+        ERRORS.inc(where="dispatcher", type=error_type)
         
         # 网络相关错误，只记录警告，不打扰用户
         network_errors = ["RemoteProtocolError", "NetworkError", "TimedOut", "TimeoutError"]
@@ -579,6 +933,8 @@ class TelegramBot:
         logger.info(f"🤖 {BOT_NAME} Telegram Bot 启动中...")
         logger.info("=" * 70)
         
+        build_start = time.perf_counter()
+        
         # 创建应用，增加连接配置和代理支持
         from config import PROXY_URL
         builder = (
@@ -597,6 +953,17 @@ class TelegramBot:
         
         self.app = builder.build()
         
+        # 启动指标服务（/metrics）
+        start_metrics_server(METRICS_PORT, METRICS_HOST)
+        
+        # 请求追踪
+        TRACER.configure(TRACE_SAMPLE_RATE, TRACE_EXPORTER, TRACE_FILE)
+        TRACER.set_slow_threshold(SLOW_REQUEST_MS)
+        
+        # 启动时采样分析
+        if PROFILE_ON_START > 0:
+            self.profiler.start(PROFILE_ON_START)
+        
         # 注册命令处理器
         self.app.add_handler(CommandHandler("start", self.start_command))
         self.app.add_handler(CommandHandler("help", self.help_command))
@@ -607,6 +974,11 @@ class TelegramBot:
         self.app.add_handler(CommandHandler("search", self.search_command))
         self.app.add_handler(CommandHandler("summary", self.summary_command))
         self.app.add_handler(CommandHandler("clear", self.clear_command))
+        self.app.add_handler(CommandHandler("find", self.find_command))
+        self.app.add_handler(CommandHandler("digest", self.digest_command))
+        self.app.add_handler(CommandHandler("retention", self.retention_command))
+        self.app.add_handler(CommandHandler("profile", self.profile_command))
+        self.app.add_handler(CommandHandler("admin_stats", self.admin_stats_command))
         
         # 注册按钮回调处理器
         self.app.add_handler(CallbackQueryHandler(self.button_callback))
@@ -630,13 +1002,32 @@ class TelegramBot:
                 BotCommand("forget", "忘记某个信息"),
                 BotCommand("search", "联网搜索"),
                 BotCommand("summary", "总结群聊消息"),
+                BotCommand("find", "搜索群聊记录"),
+                BotCommand("digest", "每日摘要订阅"),
+                BotCommand("retention", "群消息保留天数"),
                 BotCommand("clear", "清空对话历史")
             ]
             await app.bot.set_my_commands(commands)
             logger.info("✓ 已设置机器人命令列表")
         
-        # 在启动后设置命令
-        self.app.post_init = set_commands
+        async def post_init(app):
+            # 此时已经连上 Telegram（getMe），post_init 返回后立即开始轮询
+            self.startup_timings["连接 Telegram"] = time.perf_counter() - connect_start
+            total = sum(self.startup_timings.values())
+            logger.info(f"⏱ 启动耗时 {total * 1000:.0f}ms：{format_timings(self.startup_timings)}")
+            
+            # 设置命令列表和预热都放到后台，不耽误开始接收消息
+            app.create_task(set_commands(app))
+            asyncio.get_running_loop().run_in_executor(None, self._warm_up)
+            
+            # 收到 SIGINT / SIGTERM 时先停止接收，等处理中的请求完成再退出
+            self.lifecycle.install_signal_handlers(asyncio.get_running_loop(), self._graceful_shutdown)
+            
+            # 今天的每日摘要发到一半被重启，或者启动时正处在发送窗口内，接着发
+            if self._digest_due():
+                app.create_task(self._send_digests(None))
+        
+        self.app.post_init = post_init
         
         # 添加心跳日志（每小时记录一次）
         from datetime import datetime
@@ -649,24 +1040,44 @@ class TelegramBot:
         if job_queue:
             job_queue.run_repeating(heartbeat, interval=3600, first=3600)  # 3600秒 = 1小时
             
-            # 定时清理过期消息（每天凌晨3点）
+            # 定时把统计数据写盘（空闲时也不会丢太多）
+            async def flush_stats(context):
+                if is_initialized(self.ai, "stats"):
+                    await asyncio.get_running_loop().run_in_executor(None, self.ai.stats.flush)
+                if is_initialized(self.ai, "usage"):
+                    await asyncio.get_running_loop().run_in_executor(None, self.ai.usage.flush)
+            
+            job_queue.run_repeating(flush_stats, interval=STATS_FLUSH_INTERVAL, first=STATS_FLUSH_INTERVAL)
+            
+            # 定时清理过期消息（每天凌晨3点，在工作线程中执行，不阻塞事件循环）
             async def cleanup_messages(context):
                 logger.info("🧹 开始清理过期群消息...")
                 try:
-                    self.group_monitor.cleanup_old_messages()
-                    logger.info("✓ 过期消息清理完成")
+                    result = await asyncio.get_running_loop().run_in_executor(
+                        None, self.group_monitor.cleanup_old_messages
+                    )
+                    logger.info(f"✓ 过期消息清理完成：{result['chats']} 个群，{result['files']} 个文件")
                 except Exception as e:
                     logger.error(f"清理过期消息失败: {e}")
             
-            # 计算到凌晨3点的秒数
-            from datetime import datetime, time as dt_time
-            now = datetime.now()
-            target_time = datetime.combine(now.date(), dt_time(3, 0))
-            if target_time < now:
-                target_time = target_time.replace(day=target_time.day + 1)
-            first_run = (target_time - now).total_seconds()
+            job_queue.run_repeating(cleanup_messages, interval=86400, first=_seconds_until(3))  # 86400秒 = 24小时
+            
+            # 空闲时预先总结活跃的群，/summary 时只需合并少量新消息
+            if SUMMARY_PRESUMMARIZE_INTERVAL > 0:
+                interval = SUMMARY_PRESUMMARIZE_INTERVAL * 60
+                job_queue.run_repeating(self._presummarize_groups, interval=interval, first=interval)
+            
+            # 批量任务：定时提交攒下的任务、查询结果；每天夜里提交活跃群的总结
+            if self.batch:
+                async def run_batches(context):
+                    await run_in_executor(None, self._run_batches)
+                
+                job_queue.run_repeating(run_batches, interval=BATCH_POLL_INTERVAL, first=BATCH_POLL_INTERVAL)
+                job_queue.run_repeating(self._queue_nightly_summaries, interval=86400,
+                                        first=_seconds_until(BATCH_SUMMARY_HOUR))
             
-            job_queue.run_repeating(cleanup_messages, interval=86400, first=first_run)  # 86400秒 = 24小时
+            # 每日摘要
+            job_queue.run_repeating(self._send_digests, interval=86400, first=_seconds_until(DIGEST_HOUR))
         
         logger.info("")
         logger.info("✨ 功能特性:")
@@ -688,9 +1099,13 @@ class TelegramBot:
         logger.info("=" * 70)
         logger.info("")
         
+        self.startup_timings["创建应用"] = time.perf_counter() - build_start
+        connect_start = time.perf_counter()
+        
         # 启动轮询，增加健壮性配置
         try:
             self.app.run_polling(
+                stop_signals=None,  # 信号由 Lifecycle 处理
                 allowed_updates=Update.ALL_TYPES,
                 drop_pending_updates=True,  # 跳过启动前的旧消息
                 poll_interval=1.0,  # 轮询间隔（秒）
@@ -705,10 +1120,107 @@ class TelegramBot:
             logger.error(f"轮询出错: {e}")
             raise
     
+    async def _presummarize_groups(self, context):
+        """预先总结上次运行以来有新消息的群（有用户请求时让出，下次继续）"""
+        since = self._presummarized_at
+        started = time.time()
+        count = 0
+        for chat_id in self.group_monitor.active_chats(since):
+            if self.lifecycle.in_flight or self.lifecycle.stopping:
+                logger.debug("有请求在处理，预总结推迟到下次")
+                return
+            messages = await run_in_executor(None, self.group_monitor.get_messages, chat_id, 24)
+            try:
+                if await run_in_executor(None, self.summarizer.presummarize, chat_id, messages,
+                                         SUMMARY_PRESUMMARIZE_MIN_MESSAGES):
+                    count += 1
+            except Exception as e:
+                logger.error(f"预总结群 {chat_id} 失败: {e}")
+        self._presummarized_at = started
+        if count:
+            logger.info(f"📝 已预先总结 {count} 个群")
+    
+    def _apply_batch_summary(self, payload: dict, text):
+        """夜间总结结果写回对应群的总结状态"""
+        if text is not None:
+            self.summarizer.apply_batch_result(payload["chat_id"], text, payload["context"])
+    
+    def _apply_batch_memory(self, payload: dict, text):
+        """记忆提取结果写回对应用户的记忆"""
+        if self.ai.memory.extractor:
+            self.ai.memory.extractor.apply_batch_result(payload, text)
+    
+    async def _queue_nightly_summaries(self, context):
+        """把最近一天活跃的群的总结加入批量任务，并立即提交"""
+        count = 0
+        for chat_id in self.group_monitor.active_chats(time.time() - 86400):
+            messages = await run_in_executor(None, self.group_monitor.get_messages, chat_id, 24)
+            request = await run_in_executor(None, self.summarizer.batch_request, chat_id, messages)
+            if request:
+                body, summary_context = request
+                self.batch.add("summary", body, {"chat_id": chat_id, "context": summary_context})
+                count += 1
+        if count:
+            logger.info(f"📦 已加入 {count} 个群的夜间总结")
+        await run_in_executor(None, self.batch.submit)
+    
+    def _digest_due(self) -> bool:
+        """今天的每日摘要是否该发（或者没发完）"""
+        from datetime import datetime
+        now = datetime.now()
+        if self.digest.has_run(now.strftime("%Y-%m-%d")):
+            return True
+        started = now.replace(hour=DIGEST_HOUR, minute=0, second=0, microsecond=0)
+        return 0 <= (now - started).total_seconds() < DIGEST_WINDOW_MINUTES * 60
+    
+    async def _send_digests(self, context):
+        """给订阅的群发送每日摘要（限制并发，发送时间在窗口内错开，进度可以在重启后继续）"""
+        from datetime import datetime
+        from telegram.error import Forbidden
+        
+        async def build(chat_id: int, title: str):
+            messages = await run_in_executor(None, self.group_monitor.get_messages, chat_id, 24)
+            if not messages:
+                return None
+            summary = await run_in_executor(None, self.summarizer.generate_summary,
+                                            chat_id, messages, title, True)
+            return f"🗞 每日摘要\n\n{summary}"
+        
+        async def send(chat_id: int, text: str):
+            try:
+                await self.sender.send_message(self.app.bot, chat_id, text)
+            except Forbidden:
+                # 机器人被移出群了，不再发送
+                self.digest.unsubscribe(chat_id)
+                raise
+        
+        await self.digest.run(datetime.now().strftime("%Y-%m-%d"), build, send,
+                              concurrency=DIGEST_CONCURRENCY, window=DIGEST_WINDOW_MINUTES * 60)
+    
+    def _run_batches(self):
+        """提交攒下的批量任务并查询结果（在工作线程中执行）"""
+        try:
+            self.batch.submit()
+            self.batch.poll()
+        except Exception as e:
+            logger.error(f"批量任务处理失败: {e}")
+    
+    def _warm_up(self):
+        """后台预热（在线程池中运行）：加载 OpenAI 客户端、人设、统计、记忆等"""
+        start = time.perf_counter()
+        self.ai.warm_up()
+        logger.info(f"✓ 后台预热完成 {(time.perf_counter() - start) * 1000:.0f}ms：{format_timings(INIT_TIMES)}")
+    
+    async def _graceful_shutdown(self):
+        """停止拉取新消息 -> 等待处理中的请求（有截止时间）-> 结束轮询"""
+        if self.app.updater and self.app.updater.running:
+            await self.app.updater.stop()
+        await self.lifecycle.drain(SHUTDOWN_DRAIN_SECONDS)
+        self.app.stop_running()
+    
     def stop(self):
-        """停止机器人"""
-        # 保存所有缓存的消息
-        self.group_monitor.save_all()
+        """停止机器人：把所有缓冲数据落盘"""
+        self.lifecycle.flush_all()
         logger.info("🛑 机器人已停止")
 
 
@@ -718,9 +1230,10 @@ def main():
         bot.start()
     except KeyboardInterrupt:
         logger.info("\n收到停止信号")
-        bot.stop()
     except Exception as e:
         logger.error(f"机器人运行出错: {e}")
+    finally:
+        # 不管怎么退出都要落盘
         bot.stop()
 
 
@@ -0,0 +1,50 @@
+"""
+文本工具模块
+中英文混合分词、token 估算与分段文字拼接
+"""
+import re
+
+# 连续的中日韩字符 / 连续的字母数字
+_CJK_RUN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+")
+_WORD = re.compile(r"[a-z0-9]+")
+# 前后不需要空格的字符：中文、日文和全角标点（韩文词之间有空格，不算在内）
+_NO_SPACE = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+
+def tokenize(text: str) -> list:
+    """分词：中文按二元组（bigram）切分，英文和数字按单词切分"""
+    if not text:
+        return []
+
+    text = text.lower()
+    tokens = _WORD.findall(text)
+
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+
+    return tokens
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数（中文约 1 字 1 token，其余约 4 字符 1 token）"""
+    if not text:
+        return 0
+
+    cjk_chars = sum(len(run) for run in _CJK_RUN.findall(text))
+    return cjk_chars + (len(text) - cjk_chars + 3) // 4
+
+
+def join_segments(parts) -> str:
+    """拼接分段转写出来的文字：接缝两边都是中文（日文）时直接相连，否则加一个空格"""
+    result = ""
+    for part in parts:
+        part = part.strip()
+        if not part:
+            continue
+        if result and not (_NO_SPACE.match(result[-1]) and _NO_SPACE.match(part[0])):
+            result += " "
+        result += part
+    return result
@@ -0,0 +1,284 @@
+"""
+请求追踪模块
+轻量级的 span 追踪：每个处理器开启一个 trace，沿调用链（包括线程池）传递，记录各阶段耗时
+
+导出方式：
+- jsonl：写入本地 JSONL 文件（每行一个 trace）
+- otel：转交给 OpenTelemetry SDK（需要安装 opentelemetry-sdk 并自行配置 exporter）
+
+设置了慢请求阈值时，所有请求都会记录 span（不导出），超过阈值的请求会把各阶段耗时写进日志
+"""
+import asyncio
+import contextvars
+import functools
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from loguru import logger
+import serialization
+
+# 当前 span
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """一个追踪片段"""
+
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start", "end", "attrs")
+
+    def __init__(self, trace, name: str, parent_id, attrs: dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.end = None
+        self.attrs = attrs
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end if self.end is not None else time.time()
+        return (end - self.start) * 1000
+
+    def to_dict(self) -> dict:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "duration_ms": round(self.duration_ms, 3),
+            "attrs": self.attrs,
+        }
+
+
+class Trace:
+    """一次请求的所有 span"""
+
+    __slots__ = ("trace_id", "spans", "sampled", "_lock")
+
+    def __init__(self, sampled: bool = True):
+        self.trace_id = os.urandom(16).hex()
+        self.spans = []
+        self.sampled = sampled
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    @property
+    def root(self) -> Span:
+        return self.spans[0]
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = [s.to_dict() for s in self.spans]
+        return {"trace_id": self.trace_id, "name": self.root.name, "spans": spans}
+
+    def format(self) -> str:
+        """按调用层级格式化各阶段耗时（用于日志）"""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        depth = {}
+        lines = []
+        for s in spans:
+            depth[s.span_id] = depth.get(s.parent_id, -1) + 1
+            attrs = " ".join(f"{k}={v}" for k, v in s.attrs.items())
+            lines.append(f"{'  ' * depth[s.span_id]}{s.name} {s.duration_ms:.1f}ms {attrs}".rstrip())
+        return "\n".join(lines)
+
+
+class JsonlExporter:
+    """写入 JSONL 文件（后台线程写盘，不阻塞请求）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue = queue.Queue(maxsize=10000)
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, trace: Trace):
+        try:
+            self._queue.put_nowait(serialization.dumps_line(trace.to_dict()))
+        except queue.Full:
+            logger.debug("追踪导出队列已满，丢弃一条 trace")
+
+    def _run(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                line = self._queue.get()
+                if line is None:
+                    break
+                f.write(line)
+                # 队列空了再刷盘，减少系统调用
+                if self._queue.empty():
+                    f.flush()
+
+    def shutdown(self):
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+
+class OtelExporter:
+    """转交给 OpenTelemetry（trace 结束后按记录的时间补建 span）"""
+
+    def __init__(self):
+        from opentelemetry import trace as otel_trace
+        self._otel = otel_trace
+        self._tracer = otel_trace.get_tracer("telegram-ai-bot")
+
+    def export(self, trace: Trace):
+        created = {}
+        for span in sorted(trace.spans, key=lambda s: s.start):
+            parent = created.get(span.parent_id)
+            context = self._otel.set_span_in_context(parent) if parent else None
+            otel_span = self._tracer.start_span(
+                span.name,
+                context=context,
+                start_time=int(span.start * 1e9),
+                attributes={k: v for k, v in span.attrs.items() if isinstance(v, (str, int, float, bool))}
+            )
+            otel_span.end(end_time=int((span.end or span.start) * 1e9))
+            created[span.span_id] = otel_span
+
+    def shutdown(self):
+        pass
+
+
+class Tracer:
+    """追踪器：负责采样和导出"""
+
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.exporter = None
+        # 慢请求阈值（毫秒，0 为不记录）
+        self.slow_request_ms = 0
+
+    def configure(self, sample_rate: float, exporter: str = "jsonl", path: str = "traces.jsonl"):
+        """配置采样率和导出方式"""
+        self.shutdown()
+        self.sample_rate = sample_rate
+        if sample_rate <= 0:
+            return
+
+        if exporter == "otel":
+            try:
+                self.exporter = OtelExporter()
+            except ImportError:
+                logger.warning("未安装 opentelemetry，改为写入 JSONL 文件")
+        if self.exporter is None:
+            self.exporter = JsonlExporter(path)
+        logger.info(f"✓ 请求追踪已开启（采样率 {sample_rate:.0%}，导出：{type(self.exporter).__name__}）")
+
+    def should_sample(self) -> bool:
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def set_slow_threshold(self, slow_request_ms: float):
+        """超过该耗时的请求会把各阶段耗时写进日志"""
+        self.slow_request_ms = slow_request_ms
+        if slow_request_ms > 0:
+            logger.info(f"✓ 慢请求记录已开启（阈值 {slow_request_ms:.0f}ms）")
+
+    def finish(self, trace: Trace):
+        if trace.sampled and self.exporter:
+            self.exporter.export(trace)
+        if self.slow_request_ms and trace.root.duration_ms >= self.slow_request_ms:
+            logger.warning(f"🐢 慢请求 {trace.root.duration_ms:.0f}ms\n{trace.format()}")
+
+    def shutdown(self):
+        if self.exporter:
+            self.exporter.shutdown()
+            self.exporter = None
+        self.sample_rate = 0.0
+
+
+TRACER = Tracer()
+
+
+@contextmanager
+def start_trace(name: str, **attrs):
+    """开启一个新的 trace（通常在处理器入口），未被采样且没开慢请求记录时几乎没有开销"""
+    sampled = TRACER.should_sample()
+    if not sampled and not TRACER.slow_request_ms:
+        token = _current_span.set(None)
+        try:
+            yield None
+        finally:
+            _current_span.reset(token)
+        return
+
+    trace = Trace(sampled)
+    root = Span(trace, name, None, attrs)
+    trace.add(root)
+    token = _current_span.set(root)
+    try:
+        yield root
+    except BaseException as e:
+        root.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        root.end = time.time()
+        _current_span.reset(token)
+        TRACER.finish(trace)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """在当前 trace 下开启子 span；没有 trace 时什么也不做"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(parent.trace, name, parent.span_id, attrs)
+    parent.trace.add(child)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        child.end = time.time()
+        _current_span.reset(token)
+
+
+def set_attribute(key: str, value):
+    """给当前 span 设置属性"""
+    current = _current_span.get()
+    if current is not None:
+        current.attrs[key] = value
+
+
+def traced(name: str):
+    """函数装饰器：把整个函数调用记为一个 span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def run_in_executor(executor, func, *args):
+    """在线程池中执行，并把追踪上下文带过去；排队等待时间记为 executor.queue"""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    parent = _current_span.get()
+    if parent is None:
+        return await loop.run_in_executor(executor, context.run, func, *args)
+
+    submitted = time.time()
+
+    def call():
+        queue_span = Span(parent.trace, "executor.queue", parent.span_id, {})
+        queue_span.start = submitted
+        queue_span.end = time.time()
+        parent.trace.add(queue_span)
+        return func(*args)
+
+    return await loop.run_in_executor(executor, context.run, call)
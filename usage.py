@@ -0,0 +1,227 @@
+"""
+用量统计模块
+记录每次模型调用的 token 用量，按 用户 / 人设 / 模型 / 功能 汇总成每天的计数，并按用户限制每天的 token 额度
+"""
+import threading
+import time
+from datetime import date, timedelta
+from pathlib import Path
+from loguru import logger
+from config import STATS_FLUSH_INTERVAL, USER_DAILY_TOKEN_BUDGET, USAGE_DETAIL_DAYS, ADMIN_USER_IDS
+from storage import atomic_write, atomic_write_json
+import serialization
+from metrics import TOKENS
+
+# 用户当天的额度用完时的回复（||| 分条发送）
+BUDGET_EXCEEDED_REPLY = "今天的聊天额度用完啦|||明天再来找我吧"
+
+
+class UsageTracker:
+    """用量统计（和使用统计一样只在内存中累加，定期或关闭时落盘）
+
+    存储结构（chat_history/usage/）：
+    - YYYY-MM-DD.json  当天的明细 [[用户, 人设, 模型, 功能, 调用次数, 输入 token, 输出 token]]，保留 keep_days 天
+    - daily.json       每天的汇总 {日期: {"total", "feature", "model", "persona", "users"}}，一直保留
+    跨天后（或启动时发现还没汇总的明细）把前一天的明细汇总进 daily.json
+    """
+
+    def __init__(self, usage_dir, flush_interval=STATS_FLUSH_INTERVAL, daily_budget=USER_DAILY_TOKEN_BUDGET,
+                 keep_days=USAGE_DETAIL_DAYS, exempt_users=ADMIN_USER_IDS):
+        self.usage_dir = Path(usage_dir)
+        self.usage_dir.mkdir(exist_ok=True)
+        self.daily_file = self.usage_dir / "daily.json"
+        self.flush_interval = flush_interval
+        # 每个用户每天的 token 额度（0 为不限制，管理员不受限制）
+        self.daily_budget = daily_budget
+        self.keep_days = keep_days
+        self.exempt_users = {str(user_id) for user_id in exempt_users}
+
+        self._dirty = False
+        self._last_save = time.monotonic()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+        # 当天的明细 {(用户, 人设, 模型, 功能): [调用次数, 输入 token, 输出 token]}
+        self.day = date.today().isoformat()
+        self.counters = self._load_day(self.day)
+        # 当天每个用户用掉的 token（额度检查用）
+        self.user_tokens = {}
+        for (user_id, _, _, _), (_, prompt, completion) in self.counters.items():
+            if user_id:
+                self.user_tokens[user_id] = self.user_tokens.get(user_id, 0) + prompt + completion
+        # 已经跨天、还没写进汇总的明细 [(日期, 明细)]
+        self._closed = []
+
+        self.daily = self._load_daily()
+        self._rollup_pending()
+
+    def _day_file(self, day: str) -> Path:
+        return self.usage_dir / f"{day}.json"
+
+    def _load_day(self, day: str) -> dict:
+        """读取某天的明细"""
+        day_file = self._day_file(day)
+        if not day_file.exists():
+            return {}
+        try:
+            return {tuple(row[:4]): row[4:] for row in serialization.load_file(day_file)}
+        except Exception as e:
+            logger.warning(f"加载用量明细失败 [{day}]: {e}")
+            return {}
+
+    def _load_daily(self) -> dict:
+        if self.daily_file.exists():
+            try:
+                return serialization.load_file(self.daily_file)
+            except Exception as e:
+                logger.warning(f"加载每日用量汇总失败: {e}")
+        return {}
+
+    def _rollup_pending(self):
+        """把停机期间跨过的天（有明细但还没汇总）汇总进 daily.json"""
+        pending = [path.stem for path in self.usage_dir.glob("????-??-??.json")
+                   if path.stem < self.day and path.stem not in self.daily]
+        if not pending:
+            return
+        for day in sorted(pending):
+            self.daily[day] = self._summarize(self._load_day(day))
+        try:
+            atomic_write_json(self.daily_file, self.daily)
+            logger.info(f"已汇总 {len(pending)} 天的用量明细")
+        except Exception as e:
+            logger.error(f"保存每日用量汇总失败: {e}")
+        self._cleanup()
+
+    @staticmethod
+    def _summarize(counters: dict) -> dict:
+        """把明细汇总成按功能、模型、人设的 [调用次数, 输入 token, 输出 token]"""
+        summary = {"total": [0, 0, 0], "feature": {}, "model": {}, "persona": {}}
+        users = set()
+        for (user_id, persona, model, feature), values in counters.items():
+            buckets = (
+                summary["total"],
+                summary["feature"].setdefault(feature, [0, 0, 0]),
+                summary["model"].setdefault(model, [0, 0, 0]),
+                summary["persona"].setdefault(persona or "-", [0, 0, 0]),
+            )
+            for bucket in buckets:
+                for i, value in enumerate(values):
+                    bucket[i] += value
+            if user_id:
+                users.add(user_id)
+        summary["users"] = len(users)
+        return summary
+
+    def _roll_day(self):
+        """跨天时把当天的明细移到待汇总列表（调用时需持有 self._lock）"""
+        today = date.today().isoformat()
+        if today != self.day:
+            self._closed.append((self.day, self.counters))
+            self.day, self.counters, self.user_tokens = today, {}, {}
+            self._dirty = True
+
+    def record(self, feature: str, model: str, prompt_tokens: int = 0, completion_tokens: int = 0,
+               user_id: str = "", persona: str = ""):
+        """记录一次模型调用（后台任务没有具体用户时 user_id 为空）"""
+        TOKENS.inc(prompt_tokens, model=model, type="prompt")
+        TOKENS.inc(completion_tokens, model=model, type="completion")
+
+        with self._lock:
+            self._roll_day()
+            key = (user_id, persona, model, feature)
+            values = self.counters.get(key)
+            if values is None:
+                values = self.counters[key] = [0, 0, 0]
+            values[0] += 1
+            values[1] += prompt_tokens
+            values[2] += completion_tokens
+            if user_id:
+                self.user_tokens[user_id] = self.user_tokens.get(user_id, 0) + prompt_tokens + completion_tokens
+
+            self._dirty = True
+            due = time.monotonic() - self._last_save >= self.flush_interval
+
+        if due:
+            self.flush()
+
+    def record_response(self, response, feature: str, model: str, user_id: str = "", persona: str = ""):
+        """记录一次 chat.completions 调用（从响应中取 token 用量）"""
+        usage = getattr(response, "usage", None)
+        self.record(feature, model, usage.prompt_tokens if usage else 0, usage.completion_tokens if usage else 0,
+                    user_id, persona)
+
+    def remaining(self, user_id: str):
+        """用户今天剩余的 token 额度，None 表示不限制"""
+        if not self.daily_budget or user_id in self.exempt_users:
+            return None
+        with self._lock:
+            self._roll_day()
+            used = self.user_tokens.get(user_id, 0)
+        return max(self.daily_budget - used, 0)
+
+    def check_budget(self, user_id: str) -> bool:
+        """发请求之前检查：用户今天的额度是否还没用完（最后一次请求可能会略微超出）"""
+        return self.remaining(user_id) != 0
+
+    def format_budget(self, user_id: str) -> str:
+        """用户今天的额度使用情况（不限制时为空）"""
+        remaining = self.remaining(user_id)
+        if remaining is None:
+            return ""
+        return f"🪙 今日额度: 已用 {self.daily_budget - remaining} / {self.daily_budget} tokens"
+
+    def get_today(self) -> dict:
+        """当天的汇总（管理员看板用）"""
+        with self._lock:
+            self._roll_day()
+            return self._summarize(self.counters)
+
+    def get_daily(self, days: int = 7) -> list:
+        """最近 days 天（含今天）每天的汇总 [(日期, 汇总)]"""
+        today = date.today()
+        past = [(today - timedelta(days=i)).isoformat() for i in range(days - 1, 0, -1)]
+        summary = self.get_today()
+        with self._lock:
+            result = [(day, self.daily[day]) for day in past if day in self.daily]
+        return result + [(today.isoformat(), summary)]
+
+    def flush(self):
+        """把未保存的明细写入磁盘，跨过的天顺带汇总"""
+        with self._save_lock:
+            with self._lock:
+                self._roll_day()
+                if not self._dirty:
+                    return
+                closed, self._closed = self._closed, []
+                day = self.day
+                rows = [[*key, *values] for key, values in self.counters.items()]
+                self._dirty = False
+                self._last_save = time.monotonic()
+
+            try:
+                if closed:
+                    for closed_day, counters in closed:
+                        atomic_write_json(self._day_file(closed_day), [[*key, *values] for key, values in counters.items()])
+                    summaries = {closed_day: self._summarize(counters) for closed_day, counters in closed}
+                    with self._lock:
+                        self.daily.update(summaries)
+                        data = serialization.dumps(self.daily)
+                    atomic_write(self.daily_file, data)
+                    self._cleanup()
+                if rows:
+                    atomic_write_json(self._day_file(day), rows)
+            except Exception as e:
+                with self._lock:
+                    self._closed = closed + self._closed
+                    self._dirty = True
+                logger.error(f"保存用量统计失败: {e}")
+
+    def _cleanup(self):
+        """删除超过保留天数的明细（汇总一直保留）"""
+        cutoff = (date.today() - timedelta(days=self.keep_days)).isoformat()
+        for path in self.usage_dir.glob("????-??-??.json"):
+            if path.stem < cutoff:
+                try:
+                    path.unlink()
+                except OSError as e:
+                    logger.warning(f"删除用量明细失败 [{path.name}]: {e}")